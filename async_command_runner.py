@@ -0,0 +1,108 @@
+# async_command_runner.py
+import asyncio
+import os
+import shlex
+import signal
+from command_runner import ACTIVE_PROCESS_GROUPS, STOP_REQUESTED, terminate_active_commands, track_process_group
+from i18n import _
+
+class AsyncCommandRunner:
+    """
+    Class to run commands concurrently with asyncio and log the output.
+    Commands are argument lists executed without a shell.
+    """
+    def __init__(self, logger, max_concurrency=4):
+        """
+        Initialize the AsyncCommandRunner class.
+        :param logger: Logger object for logging messages.
+        :param max_concurrency: Maximum number of commands running at the same time.
+        """
+        self.logger = logger
+        logger.add_sigterm_handler(terminate_active_commands)
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def _get_semaphore(self):
+        """
+        Get the concurrency limiter for the running event loop.
+        :return: asyncio.Semaphore instance.
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    @staticmethod
+    def _kill(process):
+        """
+        Kill a command together with every process it started.
+        :param process: asyncio subprocess to kill.
+        """
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    async def run(self, argv, verbose=False, timeout=3600):
+        """
+        Run a command.
+        :param argv: Command and arguments as a list.
+        :param verbose: Whether to print command output to stdout.
+        :param timeout: Timeout for the command execution.
+        :return: Tuple containing return code, stdout, and stderr.
+        """
+        command = " ".join(shlex.quote(arg) for arg in argv)
+        async with self._get_semaphore():
+            if STOP_REQUESTED.is_set():
+                self.logger.log(_("Not started, the backup is being terminated: {}").format(command))
+                return 143, "", "Terminated"
+            self.logger.log(_("Running command: {}").format(command))
+            # Each command gets its own process group so a timeout or cancellation can kill all of it
+            try:
+                process = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE,
+                                                               stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            except OSError as e:
+                # A missing or non-executable binary fails like it does under a shell
+                return 127, "", str(e)
+            track_process_group(process.pid)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                self._kill(process)
+                await process.wait()
+                self.logger.log(_("Command timed out: {}").format(command))
+                return 1, "", "TimeoutExpired"
+            except asyncio.CancelledError:
+                self._kill(process)
+                await process.wait()
+                raise
+            finally:
+                ACTIVE_PROCESS_GROUPS.discard(process.pid)
+        stdout = stdout.decode(errors="replace")
+        stderr = stderr.decode(errors="replace")
+        if verbose or self.logger.verbose:
+            print(stdout)
+            print(stderr)
+        return process.returncode, stdout, stderr
+
+    async def gather(self, commands, verbose=False, timeout=3600):
+        """
+        Run several commands concurrently, subject to the concurrency limit.
+        :param commands: List of argument lists.
+        :param verbose: Whether to print command output to stdout.
+        :param timeout: Timeout for each command.
+        :return: List of (return code, stdout, stderr) tuples in the order of the commands.
+        """
+        return await asyncio.gather(*(self.run(argv, verbose, timeout) for argv in commands))
+
+    def run_all(self, commands, verbose=False, timeout=3600):
+        """
+        Run several commands concurrently from synchronous code.
+        :param commands: List of argument lists.
+        :param verbose: Whether to print command output to stdout.
+        :param timeout: Timeout for each command.
+        :return: List of (return code, stdout, stderr) tuples in the order of the commands.
+        """
+        return asyncio.run(self.gather(commands, verbose, timeout))
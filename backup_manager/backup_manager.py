@@ -1,13 +1,24 @@
 # backup_manager/backup_manager.py
 
 import os
-from datetime import datetime
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
 from .database_backup import DatabaseBackup
 from .email_notifier import EmailNotifier
+from .log_attachment import LogAttachment
 from .log_cleaner import LogCleaner
+from .metrics import BackupMetrics
+from .phase_scheduler import PhaseScheduler
 from .restic_backup import ResticBackup
+from .run_history import RunHistory
 from .software_list_generator import SoftwareListGenerator
-from utils import format_duration
+from .trend_analysis import TrendAnalyzer, metric_label
+from utils import format_bytes, format_duration, log_and_email
 from i18n import get_translation
 
 _ = get_translation()
@@ -26,15 +37,112 @@ class BackupManager:
         self.config = config
         self.logger = logger
         self.command_runner = command_runner
-        self.email_body = ""
+        self._local = threading.local()
+        self._email_body = ""
+        self._phase_sections = {}
+        self.failed_phases = set()
         self.error_lines = []
-        self.backup_success = True
+        self._backup_success = True
+        self.restic_summary = None
+        self.metrics = BackupMetrics(config, logger, self)
 
         self.database_backup = DatabaseBackup(config, logger, command_runner, self)
         self.restic_backup = ResticBackup(config, logger, command_runner, self)
         self.software_list_generator = SoftwareListGenerator(config, logger, command_runner, self)
         self.log_cleaner = LogCleaner(config, logger)
 
+    @property
+    def current_phase(self):
+        """
+        Name of the phase running in the calling thread, or None outside of the phases.
+        """
+        return getattr(self._local, "phase", None)
+
+    @property
+    def email_body(self):
+        """
+        Email body being built. Inside a phase this is the phase's own section, so phases running at the
+        same time do not interleave their output.
+        """
+        phase = self.current_phase
+        return self._phase_sections[phase] if phase else self._email_body
+
+    @email_body.setter
+    def email_body(self, value):
+        phase = self.current_phase
+        if phase:
+            self._phase_sections[phase] = value
+        else:
+            self._email_body = value
+
+    @property
+    def backup_success(self):
+        """
+        Whether the backup has succeeded so far. Setting it to False inside a phase marks the phase as failed.
+        """
+        return self._backup_success
+
+    @backup_success.setter
+    def backup_success(self, value):
+        self._backup_success = value
+        if not value and self.current_phase:
+            self.failed_phases.add(self.current_phase)
+
+    def _build_phases(self):
+        """
+        Build the phase graph of a backup run.
+        Restic backs up the dumps and the software list, so it waits for both; the size report and the
+        retention policy only need the new snapshot, and pruning waits for both of them. The log cleanup
+        runs in the background from the start.
+        :return: PhaseScheduler holding the phases.
+        """
+        scheduler = PhaseScheduler(getattr(self.config, "BACKUP_MAX_PARALLEL_PHASES", 1))
+        scheduler.add("database_backup", self.database_backup.backup)
+        scheduler.add("software_list", self.software_list_generator.generate)
+        scheduler.add("log_cleanup", lambda: self.log_cleaner.clean(self.config.LOG_DIR), background=True)
+        scheduler.add("restic_backup", self.restic_backup.run_backup, ["database_backup", "software_list"])
+        scheduler.add("size_calculation", self.restic_backup.log_backup_size_info, ["restic_backup"])
+        scheduler.add("retention", self.restic_backup.apply_retention_policy, ["restic_backup"])
+        scheduler.add("prune", self.restic_backup.prune_if_due, ["retention", "size_calculation"])
+        return scheduler
+
+    def _run_phase(self, phase, function):
+        """
+        Run one phase in the calling thread, collecting its email section and timing it.
+        :param phase: Name of the phase.
+        :param function: Callable running the phase.
+        :return: Result of the callable.
+        """
+        self._local.phase = phase
+        try:
+            with self.metrics.span(phase):
+                return function()
+        finally:
+            self._local.phase = None
+
+    def _run_phases(self):
+        """
+        Run the phases and append their email sections in graph order, whatever order they finished in.
+        """
+        scheduler = self._build_phases()
+        self._phase_sections = {phase: "" for phase in scheduler.phases}
+        try:
+            status = scheduler.run(self._run_phase)
+        finally:
+            for section in self._phase_sections.values():
+                self._email_body += section
+            self._phase_sections = {}
+        for phase, exception in scheduler.errors.items():
+            self.backup_success = False
+            self.failed_phases.add(phase)
+            error_message = _("Phase {} failed: {}").format(phase, exception)
+            log_and_email(self, self.logger, error_message, error=True)
+            self.logger.log("".join(traceback.format_exception(type(exception), exception,
+                                                               exception.__traceback__)).rstrip())
+        for phase, phase_status in status.items():
+            if phase_status == PhaseScheduler.SKIPPED:
+                self.logger.log(_("Skipped phase {} because an earlier phase failed.").format(phase))
+
     def backup(self):
         """
         Perform the backup process.
@@ -46,14 +154,12 @@ class BackupManager:
         self.email_body = f"<html><body><h2>{_('Backup Summary for')} {self.config.SERVER_NAME} - {current_time}</h2>"
         self.logger.log(f"{_('Backup started at')} {current_time}")
 
-        self.database_backup.backup()
-        self.restic_backup.run_backup()
-        self.software_list_generator.generate()
-
-        self.log_cleaner.clean(self.config.LOG_DIR, self.config.RETENTION_DAYS)
+        self._run_phases()
 
         end_time = datetime.now()
         total_duration = format_duration(end_time - start_time)
+        self.logger.event("backup_run", "backup", duration=(end_time - start_time).total_seconds(),
+                          success=self.backup_success)
         end_time_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
 
         self.logger.log(_("Backup Process Completed"), section=True)
@@ -64,6 +170,14 @@ class BackupManager:
         self.email_body += f"<p>{_('Backup started at')}: {current_time}</p>"
         self.email_body += f"<p>{_('Backup completed at')}: {end_time_str}</p>"
         self.email_body += f"<p>{_('Total backup duration')}: {total_duration}</p>"
+        self._report_trends(start_time, end_time)
+
+        attachment_dir = attachment_path = None
+        if not self.backup_success:
+            # The attached log must hold everything queued so far
+            self.logger.sync()
+            attachment_dir = tempfile.mkdtemp(prefix="backup-log-")
+            attachment_path = self._build_log_attachment(attachment_dir)
         self.email_body += "</body></html>"
 
         with open(self.config.EMAIL_BODY_PATH, "w") as email_file:
@@ -71,30 +185,105 @@ class BackupManager:
 
         email_subject = f"{_('Backup')} {'Success' if self.backup_success else _('Failed')} {_('for')} {self.config.SERVER_NAME} - {datetime.now().strftime('%Y-%m-%d')}"
 
-        email_notifier = EmailNotifier(self.config.SMTP_SERVER, self.config.SMTP_PORT, self.config.SMTP_USERNAME, self.config.SMTP_PASSWORD)
+        email_notifier = EmailNotifier.from_config(self.config)
 
-        if not self.backup_success:
-            email_notifier.send_email(email_subject, self.config.EMAIL_TO, self.config.EMAIL_FROM, self.config.EMAIL_BODY_PATH, self.config.LOG_FILE)
-        else:
-            email_notifier.send_email(email_subject, self.config.EMAIL_TO, self.config.EMAIL_FROM, self.config.EMAIL_BODY_PATH)
+        try:
+            with self.metrics.span("email"):
+                email_start = time.monotonic()
+                try:
+                    delivered, queued = email_notifier.send_email(email_subject, self.config.EMAIL_TO, self.config.EMAIL_FROM, self.config.EMAIL_BODY_PATH, attachment_path)
+                except RuntimeError as e:
+                    # E.g. a failed SMTP login; the run is still recorded
+                    self.logger.log(_("Could not send the email: {}").format(e), error=True)
+                    delivered, queued = 0, email_notifier.spool.count() if email_notifier.spool else 1
+                self.logger.event("email_flush", "email", duration=time.monotonic() - email_start,
+                                  delivered=delivered, queued=queued, success=queued == 0)
+                if queued and email_notifier.spool:
+                    self.logger.log(_("{} emails are waiting in the mail spool {} for the next run.").format(
+                        queued, email_notifier.spool.spool_dir))
+        finally:
+            self.metrics.write_textfile((end_time - start_time).total_seconds(), self.backup_success)
+            if attachment_dir:
+                shutil.rmtree(attachment_dir, ignore_errors=True)
 
         os.remove(self.config.EMAIL_BODY_PATH)
-        self._write_status_file(start_time, end_time, total_duration)
+        self._record_run(start_time, end_time)
 
-    def _write_status_file(self, start_time, end_time, total_duration):
+    def _build_log_attachment(self, directory):
+        """
+        Build the log attachment of a failure email, within LOG_ATTACHMENT_MAX_BYTES, and tell in the email
+        body what was attached and where the full log is.
+        :param directory: Directory for the attachment.
+        :return: Path to the attachment.
+        """
+        log_attachment = LogAttachment(self.config, self.config.LOG_FILE, self.logger.index_file,
+                                       self.logger.anchor()[0] - 1)
+        attachment_path, mode = log_attachment.build(directory)
+        self.email_body += "<p>" + _("Attached: {}.").format(LogAttachment.describe(mode)) + \
+            f" {log_attachment.location_note}</p>"
+        return attachment_path
+
+    def _open_run_history(self):
+        """
+        Open the run history.
+        :return: RunHistory object.
         """
-        Write the status of the backup to a file.
+        history_file = getattr(self.config, "RUN_HISTORY_DB",
+                               os.path.join(self.config.STATUS_FILE_DIR, "run-history.sqlite"))
+        return RunHistory(history_file, getattr(self.config, "RUN_HISTORY_RETENTION_DAYS", 730))
+
+    def _report_trends(self, start_time, end_time):
+        """
+        Compare the run with the earlier successful runs and report durations and sizes far off the usual.
+        The report is optional: if the run history cannot be read, this is logged and the email goes out without it.
         :param start_time: The start time of the backup.
         :param end_time: The end time of the backup.
-        :param total_duration: The total duration of the backup.
-        """
-        status = "Success" if self.backup_success else "Failed"
-        status_file_path = os.path.join(self.config.STATUS_FILE_DIR, f"backup_status_{self.config.SERVER_NAME}_{start_time.strftime('%Y%m%d%H%M%S')}.txt")
-
-        with open(status_file_path, "w") as status_file:
-            status_file.write(f"Server: {self.config.SERVER_NAME}\n")
-            status_file.write(f"Status: {status}\n")
-            status_file.write(f"Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            status_file.write(f"End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            status_file.write(f"Duration: {total_duration}\n")
-            status_file.write(f"Log File: {self.config.LOG_FILE}\n")
+        """
+        try:
+            run_history = self._open_run_history()
+            try:
+                analyzer = TrendAnalyzer(run_history, getattr(self.config, "TREND_WINDOW_RUNS", 30),
+                                         getattr(self.config, "TREND_THRESHOLD", 3.5),
+                                         getattr(self.config, "TREND_MIN_CHANGE", 0.5),
+                                         getattr(self.config, "TREND_MIN_RUNS", 5))
+                values = analyzer.run_values((end_time - start_time).total_seconds(),
+                                             self.restic_summary.bytes_added if self.restic_summary else None,
+                                             self.metrics.phase_results())
+                anomalies = analyzer.check(values,
+                                           analyzer.baseline(self.config.SERVER_NAME, start_time.timestamp()))
+            finally:
+                run_history.close()
+        except sqlite3.Error as e:
+            self.logger.log(_("Could not compare the run with the run history: {}").format(e), error=True)
+            return
+        if not anomalies:
+            return
+
+        self.email_body += f"<h2>{_('Unusual Values')}</h2>"
+        for anomaly in anomalies:
+            label = metric_label(anomaly.metric, _)
+            if anomaly.kind == "bytes":
+                value, usual = format_bytes(anomaly.value), format_bytes(anomaly.median)
+            else:
+                value = format_duration(timedelta(seconds=anomaly.value))
+                usual = format_duration(timedelta(seconds=anomaly.median))
+            message = _("Unusual {}: {} against a median of {} over the last {} runs.").format(
+                label, value, usual, anomaly.runs)
+            self.logger.log(message)
+            self.logger.event("anomaly", "backup", name=anomaly.metric, value=anomaly.value, median=anomaly.median,
+                              score=round(anomaly.score, 1))
+            self.email_body += f"<p style='color: orange;'>{message}</p>"
+
+    def _record_run(self, start_time, end_time):
+        """
+        Record the run and its phases in the run history read by backup_summary.py.
+        :param start_time: The start time of the backup.
+        :param end_time: The end time of the backup.
+        """
+        run_history = self._open_run_history()
+        try:
+            run_history.record_run(self.config.SERVER_NAME, start_time.timestamp(), end_time.timestamp(),
+                                   self.backup_success, self.config.LOG_FILE, self.restic_summary,
+                                   self.metrics.phase_results())
+        finally:
+            run_history.close()
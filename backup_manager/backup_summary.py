@@ -1,44 +1,80 @@
 # backup_summary.py
+import argparse
 import os
 import re
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import smtplib
-import socket
-import importlib.util
+import sys
 
-def load_config(server_name):
+from datetime import datetime, timedelta
+from statistics import median
+
+if __package__:
+    from .email_notifier import EmailNotifier
+    from .run_history import RunHistory
+    from .trend_analysis import TrendAnalyzer, metric_label
+else:
+    # Run as a script from the backup_manager directory; config_loader and utils live one level up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from email_notifier import EmailNotifier
+    from run_history import RunHistory
+    from trend_analysis import TrendAnalyzer, metric_label
+from config_loader import ConfigLoader
+from utils import format_bytes, format_duration
+
+def format_time_without_seconds(timestamp):
     """
-    Load the configuration module based on the server's FQDN.
-    :param server_name: The server's fully qualified domain name (FQDN).
-    :return: Configuration object.
+    Format a Unix time without seconds.
+    :param timestamp: Unix time.
+    :return: Formatted time string without seconds.
     """
-    config_path = f'/root/backup_config_{server_name}.py'
-    if not os.path.exists(config_path):
-        raise FileNotFoundError(
-            f"Configuration file {config_path} does not exist. Ensure the correct config file is present.")
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
 
-    spec = importlib.util.spec_from_file_location("config", config_path)
-    config = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(config)
-    return config
+def import_status_files(status_dir, history):
+    """
+    Move the status text files written by older versions into the run history.
+    :param status_dir: Directory holding the backup_status_* files.
+    :param history: RunHistory object.
+    """
+    for entry in sorted(os.listdir(status_dir)):
+        if not entry.startswith("backup_status_"):
+            continue
+        status_file = os.path.join(status_dir, entry)
+        with open(status_file, "r") as file:
+            content = file.read()
+        start_time = datetime.strptime(re.search(r'Start Time:\s*(.*)', content).group(1), '%Y-%m-%d %H:%M:%S')
+        end_time = datetime.strptime(re.search(r'End Time:\s*(.*)', content).group(1), '%Y-%m-%d %H:%M:%S')
+        log_file = re.search(r'Log File:\s*(.*)', content)
+        history.record_run(re.search(r'Server:\s*(.*)', content).group(1), start_time.timestamp(),
+                           end_time.timestamp(), re.search(r'Status:\s*(.*)', content).group(1) == "Success",
+                           log_file.group(1) if log_file else None)
+        os.remove(status_file)
 
-def format_time_without_seconds(time_str):
+def format_anomaly(anomaly):
     """
-    Format the time string to remove seconds.
-    :param time_str: The original time string with seconds.
-    :return: Formatted time string without seconds.
+    Describe an anomaly in a few words.
+    :param anomaly: Anomaly object.
+    :return: Description such as 'duration of restic_backup 3 hours 2 minutes 0 seconds (usually 58 minutes 3 seconds)'.
     """
-    return time_str.rsplit(':', 1)[0]
+    if anomaly.kind == "bytes":
+        return f"{metric_label(anomaly.metric)} {format_bytes(anomaly.value)} (usually {format_bytes(anomaly.median)})"
+    return (f"{metric_label(anomaly.metric)} {format_duration(timedelta(seconds=anomaly.value))} "
+            f"(usually {format_duration(timedelta(seconds=anomaly.median))})")
 
-def send_summary_email(status_files, config):
+def send_summary_email(runs, history, config):
     """
-    Send a summary email with the backup status of all servers.
-    :param status_files: List of status files.
+    Send a summary email with the backup status of all servers through the mail spool.
+    Each run is compared with the successful runs of its server before it, showing the trend of the run
+    durations and flagging durations and sizes far off the usual.
+    :param runs: List of run rows from the run history.
+    :param history: RunHistory object, used to look up the phases and earlier runs.
     :param config: Configuration object.
     """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     print("Sending summary email")  # Debug print
 
+    analyzer = TrendAnalyzer(history, getattr(config, "TREND_WINDOW_RUNS", 30), getattr(config, "TREND_THRESHOLD", 3.5),
+                             getattr(config, "TREND_MIN_CHANGE", 0.5), getattr(config, "TREND_MIN_RUNS", 5))
     summary_body = """
     <html>
     <body>
@@ -50,27 +86,37 @@ def send_summary_email(status_files, config):
         <th>Start Time</th>
         <th>End Time</th>
         <th>Duration</th>
+        <th>Trend</th>
+        <th>Data Added</th>
+        <th>Failed Phases</th>
+        <th>Unusual Values</th>
     </tr>
     """
-    for status_file in status_files:
-        with open(status_file, "r") as file:
-            content = file.read()
-            server_name = re.search(r'Server:\s*(.*)', content).group(1)
-            status = re.search(r'Status:\s*(.*)', content).group(1)
-            start_time = format_time_without_seconds(re.search(r'Start Time:\s*(.*)', content).group(1))
-            end_time = format_time_without_seconds(re.search(r'End Time:\s*(.*)', content).group(1))
-            duration = re.search(r'Duration:\s*(.*)', content).group(1)
-
-            row_color = "style='color: red;'" if status == "Failed" else ""
-            summary_body += f"""
-            <tr {row_color}>
-                <td>{server_name}</td>
-                <td>{status}</td>
-                <td>{start_time}</td>
-                <td>{end_time}</td>
-                <td>{duration}</td>
-            </tr>
-            """
+    for run in runs:
+        status = "Success" if run["success"] else "Failed"
+        phases = history.phases(run["id"])
+        failed_phases = ", ".join(phase["phase"] for phase in phases if not phase["success"])
+        baseline = analyzer.baseline(run["server"], run["start_time"])
+        anomalies = analyzer.check(analyzer.run_values(run["duration"], run["bytes_added"], phases), baseline)
+        durations = [past["run"] for past in baseline]
+        trend = analyzer.sparkline(durations + [run["duration"]])
+        if durations:
+            usual = median(durations)
+            trend += f" {(run['duration'] - usual) / usual:+.0%}" if usual else ""
+        row_color = "style='color: red;'" if status == "Failed" else "style='color: darkorange;'" if anomalies else ""
+        summary_body += f"""
+        <tr {row_color}>
+            <td>{run["server"]}</td>
+            <td>{status}</td>
+            <td>{format_time_without_seconds(run["start_time"])}</td>
+            <td>{format_time_without_seconds(run["end_time"])}</td>
+            <td>{format_duration(timedelta(seconds=run["duration"]))}</td>
+            <td>{trend}</td>
+            <td>{format_bytes(run["bytes_added"]) if run["bytes_added"] is not None else ""}</td>
+            <td>{failed_phases}</td>
+            <td>{"<br>".join(format_anomaly(anomaly) for anomaly in anomalies)}</td>
+        </tr>
+        """
     summary_body += """
     </table>
     <p>Note: Separate emails were sent for failed backups.</p>
@@ -85,28 +131,33 @@ def send_summary_email(status_files, config):
 
     msg.attach(MIMEText(summary_body, 'html'))
 
-    with smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as server:
-        server.starttls()
-        server.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
-        server.sendmail(config.EMAIL_FROM, config.SUMMARY_EMAIL_TO, msg.as_string())
+    # Queued with any backup emails still in the spool and delivered together with them
+    EmailNotifier.from_config(config).send_message(msg, config.EMAIL_FROM, config.SUMMARY_EMAIL_TO)
 
 def main():
     """
-    Main function to read backup status files and send a summary email.
+    Main function to send a summary email of the runs recorded since the last summary.
     """
     script_dir = os.path.dirname(os.path.abspath(__file__))
     os.chdir(script_dir)
 
-    server_name = socket.getfqdn()
-    config = load_config(server_name)
-
-    status_files = [os.path.join(config.STATUS_FILE_DIR, f) for f in os.listdir(config.STATUS_FILE_DIR) if f.startswith("backup_status_")]
+    parser = argparse.ArgumentParser(description="Send a summary of the recorded backup runs")
+    parser.add_argument("--server-name", help="Name of this server, instead of looking up its FQDN")
+    parser.add_argument("--config", help="Configuration file, instead of /root/backup_config_<server name>.py")
+    args = parser.parse_args()
+    config = ConfigLoader.for_this_server(args.server_name, args.config).config
 
-    send_summary_email(status_files, config)
+    history = RunHistory(getattr(config, "RUN_HISTORY_DB", os.path.join(config.STATUS_FILE_DIR, "run-history.sqlite")),
+                         getattr(config, "RUN_HISTORY_RETENTION_DAYS", 730))
+    try:
+        import_status_files(config.STATUS_FILE_DIR, history)
+        runs = history.unreported_runs()
+        send_summary_email(runs, history, config)
 
-    # Delete status files after sending the summary email
-    for status_file in status_files:
-        os.remove(status_file)
+        # The runs stay in the history; they are only left out of the next summary
+        history.mark_reported(run["id"] for run in runs)
+    finally:
+        history.close()
 
 if __name__ == "__main__":
     main()
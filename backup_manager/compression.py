@@ -0,0 +1,140 @@
+# backup_manager/compression.py
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from i18n import _
+
+
+class Compressor:
+    """
+    Class describing a compression backend for database dump output.
+    """
+    BACKENDS = {
+        "gzip": ("gzip", ".gz"),
+        "pigz": ("pigz", ".gz"),
+        "zstd": ("zstd", ".zst"),
+        "none": (None, ""),
+    }
+
+    def __init__(self, backend="gzip", threads=None, level=None):
+        """
+        Initialize the Compressor class.
+        :param backend: Name of the backend ('gzip', 'pigz', 'zstd' or 'none').
+        :param threads: Number of compression threads for pigz and zstd (defaults to all cores).
+        :param level: Compression level, or None for the backend's default.
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError(_("Unknown compression backend: {}").format(backend))
+        self.backend = backend
+        self.threads = threads or os.cpu_count() or 1
+        self.level = level
+
+    @property
+    def binary(self):
+        """
+        Name of the executable used by this backend, or None for no compression.
+        """
+        return self.BACKENDS[self.backend][0]
+
+    @property
+    def extension(self):
+        """
+        File extension appended to '.sql' for dumps written by this backend.
+        """
+        return self.BACKENDS[self.backend][1]
+
+    def is_available(self):
+        """
+        Check whether the backend's executable is installed.
+        :return: Boolean indicating if the backend can be used.
+        """
+        return self.binary is None or shutil.which(self.binary) is not None
+
+    def arguments(self):
+        """
+        Build the argument list compressing stdin to stdout.
+        :return: List of arguments, or an empty list for no compression.
+        """
+        if self.binary is None:
+            return []
+        args = [self.binary]
+        if self.backend == "pigz":
+            args.append(f"-p{self.threads}")
+        elif self.backend == "zstd":
+            args += ["-q", f"-T{self.threads}"]
+        if self.level is not None:
+            args.append(f"-{self.level}")
+        return args
+
+    def pipeline_suffix(self, target_file):
+        """
+        Build the shell pipeline suffix writing compressed output to a file.
+        :param target_file: Path of the compressed output file.
+        :return: Shell fragment to append to the producing command.
+        """
+        args = self.arguments()
+        if not args:
+            return f" > {target_file}"
+        return f" | {' '.join(args)} > {target_file}"
+
+
+def get_compressor(config, logger):
+    """
+    Create the compressor configured for database dumps, falling back to gzip if it is not installed.
+    :param config: Configuration object.
+    :param logger: Logger instance.
+    :return: Compressor instance.
+    """
+    compressor = Compressor(getattr(config, "MYSQL_DUMP_COMPRESSION", "gzip"),
+                            getattr(config, "MYSQL_DUMP_COMPRESSION_THREADS", None),
+                            getattr(config, "MYSQL_DUMP_COMPRESSION_LEVEL", None))
+    if not compressor.is_available():
+        logger.log(_("Compression backend {} is not installed, falling back to gzip.").format(compressor.backend))
+        compressor = Compressor("gzip", level=compressor.level)
+    return compressor
+
+
+def benchmark_compressors(sample_path, threads=None, level=None):
+    """
+    Compress a sample dump with every installed backend and measure throughput and ratio.
+    :param sample_path: Path to a sample dump, either plain SQL or gzip-compressed.
+    :param threads: Number of compression threads for pigz and zstd.
+    :param level: Compression level, or None for each backend's default.
+    :return: List of tuples containing backend, MB/s and compression ratio; MB/s and ratio are None for a
+             backend that exited with an error, e.g. on an unsupported level or thread count.
+    """
+    temp_path = None
+    if sample_path.endswith(".gz"):
+        # Benchmarking already compressed data would say nothing, so unpack it first
+        with gzip.open(sample_path, "rb") as source, tempfile.NamedTemporaryFile(delete=False, suffix=".sql") as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+            temp_path = target.name
+    input_path = temp_path or sample_path
+    input_size = os.path.getsize(input_path)
+
+    results = []
+    try:
+        for backend in Compressor.BACKENDS:
+            compressor = Compressor(backend, threads, level)
+            if compressor.binary is None or not compressor.is_available():
+                continue
+            output_size = 0
+            start_time = time.monotonic()
+            with open(input_path, "rb") as source:
+                process = subprocess.Popen(compressor.arguments(), stdin=source, stdout=subprocess.PIPE)
+                for chunk in iter(lambda: process.stdout.read(1024 * 1024), b""):
+                    output_size += len(chunk)
+                return_code = process.wait()
+            if return_code != 0:
+                results.append((backend, None, None))
+                continue
+            elapsed = max(time.monotonic() - start_time, 1e-6)
+            ratio = input_size / output_size if output_size else 0.0
+            results.append((backend, input_size / (1024 * 1024) / elapsed, ratio))
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+    return results
@@ -1,11 +1,17 @@
 # backup_manager/database_backup.py
+import hashlib
 import os
 import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from i18n import _
 
 from logger import Logger
 from .base_backup import BaseBackup
+from .compression import get_compressor
+from .db_change_cache import DatabaseChangeCache
 
 
 class DatabaseBackup(BaseBackup):
@@ -23,6 +29,11 @@ class DatabaseBackup(BaseBackup):
         """
         super().__init__(config, logger, backup_manager)
         self.command_runner = command_runner
+        self.compressor = get_compressor(config, logger)
+        self.stream_to_restic = getattr(config, "MYSQL_DUMP_TARGET", "files") == "restic"
+        self.backup_date = None
+        self.mysql_binary = getattr(config, "MYSQL_BINARY", "/usr/bin/mysql")
+        self.mysqldump_binary = getattr(config, "MYSQLDUMP_BINARY", "/usr/bin/mysqldump")
 
     def backup(self):
         """
@@ -31,9 +42,10 @@ class DatabaseBackup(BaseBackup):
         self.logger.log(_("Database Backup"), section=True)
         self.backup_manager.email_body += "<h2>" + _("Database Backup") + "</h2>\n"
         self.logger.log(_("Starting database backup..."))
-        backup_date = datetime.now().strftime("%Y-%m-%d")
-        db_backup_dir = os.path.join(self.config.MYSQL_BACKUP_DIR, backup_date)
-        os.makedirs(db_backup_dir, exist_ok=True)
+        self.backup_date = datetime.now().strftime("%Y-%m-%d")
+        db_backup_dir = os.path.join(self.config.MYSQL_BACKUP_DIR, self.backup_date)
+        if not self.stream_to_restic:
+            os.makedirs(db_backup_dir, exist_ok=True)
 
         # Simulate failure
         simulate_failure = self.config.SIMULATE_FAILURES
@@ -44,7 +56,7 @@ class DatabaseBackup(BaseBackup):
             return
 
         return_code, stdout, stderr = self.command_runner.run(
-            f"/usr/bin/mysql -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} -e 'SHOW DATABASES;'")
+            f"{self.mysql_binary} -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} -e 'SHOW DATABASES;'")
         if return_code != 0:
             self._handle_error("Error: Cannot list databases!", stderr)
         else:
@@ -56,12 +68,100 @@ class DatabaseBackup(BaseBackup):
         :param db_backup_dir: Directory where the backup files would be stored.
         """
         non_existent_db = "non_existent_db"
+        os.makedirs(db_backup_dir, exist_ok=True)
         self.logger.log(_("Simulating failure for database: {}").format(non_existent_db))
-        backup_file = os.path.join(db_backup_dir, f"{non_existent_db}.sql.gz")
+        backup_file = os.path.join(db_backup_dir, f"{non_existent_db}.sql{self.compressor.extension}")
         return_code, stdout, stderr = self.command_runner.run(
-            f"/usr/bin/mysqldump -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} {non_existent_db} | gzip > {backup_file}")
+            f"{self.mysqldump_binary} -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} {non_existent_db}"
+            f"{self.compressor.pipeline_suffix(backup_file)}")
         self._handle_error(f"Error: Database backup failed for {non_existent_db}!", stderr)
 
+    def _run_query(self, query):
+        """
+        Run a query with the mysql client in batch mode.
+        :param query: SQL query, which must not contain single quotes.
+        :return: Tuple containing return code, list of rows split into columns, and stderr.
+        """
+        return_code, stdout, stderr = self.command_runner.run(
+            f"{self.mysql_binary} -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} -N -B -e '{query}'")
+        return return_code, [line.split("\t") for line in stdout.splitlines()], stderr
+
+    def _get_database_sizes(self):
+        """
+        Get the on-disk size of each database from information_schema.
+        :return: Dictionary mapping database names to their size in bytes.
+        """
+        return_code, rows, stderr = self._run_query(
+            "SELECT table_schema, SUM(data_length + index_length) FROM information_schema.tables GROUP BY table_schema;")
+        if return_code != 0:
+            self.logger.log(_("Could not determine database sizes, dumping in listed order: {}").format(stderr))
+            return {}
+        return {row[0]: int(float(row[1])) for row in rows if len(row) == 2 and row[1] != "NULL"}
+
+    def _get_database_fingerprints(self, databases):
+        """
+        Fingerprint each database from its table metadata.
+        Tables without an UPDATE_TIME are covered by CHECKSUM TABLE if they are no larger than
+        MYSQL_CHECKSUM_MAX_BYTES; otherwise the database cannot be fingerprinted and is always dumped.
+        :param databases: List of databases to fingerprint.
+        :return: Dictionary mapping database names to a fingerprint, or None if it cannot be fingerprinted.
+        """
+        return_code, rows, stderr = self._run_query(
+            "SELECT table_schema, table_name, engine, create_time, update_time, table_rows, data_length, index_length "
+            "FROM information_schema.tables WHERE engine IS NOT NULL;")
+        if return_code != 0:
+            self.logger.log(_("Could not fingerprint databases, dumping all of them: {}").format(stderr))
+            return {}
+        tables = {}
+        for row in rows:
+            if len(row) == 8:
+                tables.setdefault(row[0], []).append(row)
+
+        checksum_max_bytes = int(getattr(self.config, "MYSQL_CHECKSUM_MAX_BYTES", 0))
+        fingerprints = {}
+        for db in databases:
+            db_tables = sorted(tables.get(db, []), key=lambda row: row[1])
+            untimed = [row for row in db_tables if row[4] == "NULL"]
+            checksums = {}
+            if untimed:
+                if any(int(row[6]) + int(row[7]) > checksum_max_bytes for row in untimed if row[6] != "NULL"):
+                    fingerprints[db] = None
+                    continue
+                checksums = self._checksum_tables(db, [row[1] for row in untimed])
+                if checksums is None:
+                    fingerprints[db] = None
+                    continue
+            digest = hashlib.sha256()
+            for row in db_tables:
+                digest.update("\t".join(row[1:] + [checksums.get(row[1], "")]).encode() + b"\n")
+            fingerprints[db] = digest.hexdigest()
+        return fingerprints
+
+    def _checksum_tables(self, db, table_names):
+        """
+        Checksum tables whose modification time the server does not track.
+        :param db: Name of the database.
+        :param table_names: List of table names.
+        :return: Dictionary mapping table names to checksums, or None if the checksum failed.
+        """
+        table_list = ", ".join(f"`{db}`.`{table}`" for table in table_names)
+        return_code, rows, stderr = self._run_query(f"CHECKSUM TABLE {table_list};")
+        if return_code != 0:
+            self.logger.log(_("Could not checksum tables of database {}: {}").format(db, stderr))
+            return None
+        return {row[0].split(".", 1)[-1]: row[1] for row in rows if len(row) == 2}
+
+    def _get_change_cache(self):
+        """
+        Create the change-detection cache if skipping unchanged databases is enabled.
+        :return: DatabaseChangeCache instance, or None if the feature is disabled.
+        """
+        if not getattr(self.config, "MYSQL_SKIP_UNCHANGED", False):
+            return None
+        cache_file = getattr(self.config, "MYSQL_CHANGE_CACHE_FILE",
+                             os.path.join(self.config.BASE_BACKUP_DIR, "db-change-cache.json"))
+        return DatabaseChangeCache(cache_file, getattr(self.config, "MYSQL_FULL_DUMP_INTERVAL_DAYS", 7), self.logger)
+
     def _backup_databases(self, databases, db_backup_dir):
         """
         Backup the databases.
@@ -69,15 +169,137 @@ class DatabaseBackup(BaseBackup):
         :param db_backup_dir: Directory to store the backup files.
         """
         exclude_dbs = {"information_schema", "performance_schema"}
+        dump_dbs = []
         for db in databases:
             if db in exclude_dbs:
                 self.logger.log(_("Skipping backup for database: {}").format(db))
                 continue
-            backup_file = os.path.join(db_backup_dir, f"{db}.sql.gz")
-            return_code, stdout, stderr = self.command_runner.run(
-                f"/usr/bin/mysqldump -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} {db} | gzip > {backup_file}")
-            if return_code != 0 or _("mysqldump: Got error:") in stderr:
-                self._handle_error(f"Error: Database backup failed for {db}!", stderr)
-            else:
-                self.backup_manager.email_body += _("Database {} backed up successfully.").format(db) + "<br>\n"
-                self.logger.log(_("Database {} backed up successfully to {}.").format(db, backup_file))
+            dump_dbs.append(db)
+
+        change_cache = self._get_change_cache()
+        fingerprints = {}
+        skipped_dbs = []
+        if change_cache:
+            fingerprints = self._get_database_fingerprints(dump_dbs)
+            skipped_dbs = [db for db in dump_dbs if change_cache.is_unchanged(db, fingerprints.get(db))]
+            dump_dbs = [db for db in dump_dbs if db not in skipped_dbs]
+        dump_time = datetime.now()
+
+        workers = max(1, int(getattr(self.config, "MYSQL_DUMP_WORKERS", 1)))
+        succeeded_dbs = []
+        if workers == 1 or len(dump_dbs) < 2:
+            for db in dump_dbs:
+                if self._report_dump_result(db, *self._dump_database(db, db_backup_dir)):
+                    succeeded_dbs.append(db)
+        else:
+            results = self._dump_databases_concurrently(dump_dbs, db_backup_dir, workers)
+            # Report in the listed order so the log and email read the same on every run
+            for db in dump_dbs:
+                if self._report_dump_result(db, *results[db]):
+                    succeeded_dbs.append(db)
+
+        if change_cache:
+            for db in succeeded_dbs:
+                change_cache.record_dump(db, fingerprints.get(db), dump_time)
+            change_cache.save()
+            self._report_skipped_databases(skipped_dbs, change_cache)
+
+    def _dump_databases_concurrently(self, databases, db_backup_dir, workers):
+        """
+        Dump several databases at once, starting with the largest ones.
+        :param databases: List of databases to dump.
+        :param db_backup_dir: Directory to store the backup files.
+        :param workers: Maximum number of concurrent dumps.
+        :return: Dictionary mapping database names to their dump result.
+        """
+        sizes = self._get_database_sizes()
+        # Largest first so a big schema started last does not dominate the wall time
+        schedule = sorted(databases, key=lambda db: sizes.get(db, 0), reverse=True)
+        self.logger.log(_("Dumping {} databases with {} workers.").format(len(schedule), workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {db: executor.submit(self._dump_database, db, db_backup_dir) for db in schedule}
+            return {db: future.result() for db, future in futures.items()}
+
+    def _dump_database(self, db, db_backup_dir):
+        """
+        Dump a single database to a file compressed with the configured backend, or into Restic.
+        :param db: Name of the database.
+        :param db_backup_dir: Directory to store the backup file.
+        :return: Tuple containing backup target, return code, stderr and duration in seconds.
+        """
+        start = time.monotonic()
+        if self.stream_to_restic:
+            return (*self._dump_database_to_restic(db), time.monotonic() - start)
+        backup_file = os.path.join(db_backup_dir, f"{db}.sql{self.compressor.extension}")
+        return_code, stdout, stderr = self.command_runner.run(
+            f"{self.mysqldump_binary} -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} {db}"
+            f"{self.compressor.pipeline_suffix(backup_file)}")
+        return backup_file, return_code, stderr, time.monotonic() - start
+
+    def _dump_database_to_restic(self, db):
+        """
+        Stream a database dump straight into its own Restic snapshot without staging it on disk.
+        :param db: Name of the database.
+        :return: Tuple containing backup target, return code and stderr.
+        """
+        tag = getattr(self.config, "MYSQL_RESTIC_TAG", "mysqldump")
+        stdin_filename = f"{db}.sql"
+        restic_command = (f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} "
+                          f"backup --stdin --stdin-filename {stdin_filename} --tag {tag} --tag {tag}-{self.backup_date}")
+        return_code, stdout, stderr = self.command_runner.run_pipeline(
+            [f"{self.mysqldump_binary} -u {self.config.MYSQL_USER} -p{self.config.MYSQL_PASSWORD} {db}", restic_command])
+        if return_code != 0 or _("mysqldump: Got error:") in stderr:
+            self._forget_partial_snapshot(db, stdout)
+        return f"{self.config.RESTIC_REPOSITORY}:{stdin_filename}", return_code, stderr
+
+    def _forget_partial_snapshot(self, db, restic_output):
+        """
+        Remove the snapshot Restic saved from an incomplete dump, so it cannot be mistaken for a good one.
+        :param db: Name of the database.
+        :param restic_output: Standard output of the Restic backup command.
+        """
+        match = re.search(r"snapshot (\w+) saved", restic_output)
+        if not match:
+            return
+        return_code, stdout, stderr = self.command_runner.run(
+            f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} forget {match.group(1)}")
+        if return_code == 0:
+            self.logger.log(_("Removed incomplete snapshot {} of database {}.").format(match.group(1), db))
+        else:
+            self.logger.log(_("Could not remove incomplete snapshot {} of database {}: {}").format(match.group(1), db, stderr))
+
+    def _report_dump_result(self, db, backup_file, return_code, stderr, duration):
+        """
+        Report the result of a database dump to the log and email body.
+        :param db: Name of the database.
+        :param backup_file: Path to the backup file, or the Restic target of a streamed dump.
+        :param return_code: Return code of the dump command.
+        :param stderr: Error output of the dump command.
+        :param duration: Duration of the dump in seconds.
+        :return: Boolean indicating if the dump succeeded.
+        """
+        succeeded = return_code == 0 and _("mysqldump: Got error:") not in stderr
+        dump_size = os.path.getsize(backup_file) if not self.stream_to_restic and os.path.exists(backup_file) else None
+        self.logger.event("database_dump", "database_backup", name=db, duration=duration, byte_count=dump_size,
+                          return_code=return_code, success=succeeded)
+        if not succeeded:
+            self._handle_error(f"Error: Database backup failed for {db}!", stderr)
+            return False
+        self.backup_manager.email_body += _("Database {} backed up successfully.").format(db) + "<br>\n"
+        self.logger.log(_("Database {} backed up successfully to {}.").format(db, backup_file))
+        return True
+
+    def _report_skipped_databases(self, skipped_dbs, change_cache):
+        """
+        List the databases skipped because they did not change since their last dump.
+        :param skipped_dbs: List of skipped databases.
+        :param change_cache: DatabaseChangeCache holding the last dump times.
+        """
+        if not skipped_dbs:
+            return
+        self.backup_manager.email_body += "<h3>" + _("Unchanged Databases (Skipped)") + "</h3>\n"
+        for db in skipped_dbs:
+            message = _("Database {} unchanged since its last dump on {}, skipped.").format(
+                db, change_cache.last_dump(db).strftime("%Y-%m-%d %H:%M"))
+            self.backup_manager.email_body += message + "<br>\n"
+            self.logger.log(message)
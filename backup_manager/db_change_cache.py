@@ -0,0 +1,77 @@
+# backup_manager/db_change_cache.py
+import json
+import os
+from datetime import datetime, timedelta
+from i18n import _
+
+
+class DatabaseChangeCache:
+    """
+    Class to remember per-database fingerprints so unchanged databases can be skipped.
+    """
+    def __init__(self, cache_file, full_dump_interval_days, logger):
+        """
+        Initialize the DatabaseChangeCache class.
+        :param cache_file: Path to the JSON state file.
+        :param full_dump_interval_days: Maximum number of days a database may go without a dump.
+        :param logger: Logger object.
+        """
+        self.cache_file = cache_file
+        self.full_dump_interval = timedelta(days=full_dump_interval_days)
+        self.logger = logger
+        self.databases = self._load()
+
+    def _load(self):
+        """
+        Load the state file.
+        :return: Dictionary mapping database names to their last recorded state.
+        """
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, "r") as cache:
+                return json.load(cache).get("databases", {})
+        except (OSError, ValueError) as e:
+            self.logger.log(_("Ignoring unreadable database change cache {}: {}").format(self.cache_file, e))
+            return {}
+
+    def is_unchanged(self, db, fingerprint, now=None):
+        """
+        Check whether a database can be skipped.
+        :param db: Name of the database.
+        :param fingerprint: Current fingerprint, or None if the database cannot be fingerprinted.
+        :param now: Current time.
+        :return: Boolean indicating if the fingerprint matches the last successful dump and a full dump is not due.
+        """
+        entry = self.databases.get(db)
+        if fingerprint is None or entry is None or entry.get("fingerprint") != fingerprint:
+            return False
+        last_dump = datetime.fromisoformat(entry["last_dump"])
+        return (now or datetime.now()) - last_dump < self.full_dump_interval
+
+    def last_dump(self, db):
+        """
+        Get the time of the last successful dump of a database.
+        :param db: Name of the database.
+        :return: Datetime of the last dump, or None if it was never dumped.
+        """
+        entry = self.databases.get(db)
+        return datetime.fromisoformat(entry["last_dump"]) if entry else None
+
+    def record_dump(self, db, fingerprint, dump_time):
+        """
+        Record a successful dump of a database.
+        :param db: Name of the database.
+        :param fingerprint: Fingerprint taken before the dump started.
+        :param dump_time: Time the dump started.
+        """
+        self.databases[db] = {"fingerprint": fingerprint, "last_dump": dump_time.isoformat(timespec="seconds")}
+
+    def save(self):
+        """
+        Write the state file atomically.
+        """
+        temp_file = f"{self.cache_file}.tmp"
+        with open(temp_file, "w") as cache:
+            json.dump({"databases": self.databases}, cache, indent=1, sort_keys=True)
+        os.replace(temp_file, self.cache_file)
@@ -1,27 +1,206 @@
 # backup_manager/email_notifier.py
+import fcntl
+import json
 import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class MailSpool:
+    """
+    Class to keep outgoing messages in a local directory until they are delivered.
+    Each message is stored as <id>.eml with its envelope and delivery attempts in <id>.json; the envelope is
+    written last, so a message only counts as queued once both files are complete.
+    Messages the relay rejects permanently, or that failed too often, are moved to the failed/ subdirectory.
+    Deliveries hold an flock on .lock, so a backup and the summary flushing at the same time do not both send
+    a message.
+    """
+    def __init__(self, spool_dir, max_attempts=20, retry_delay=60):
+        """
+        Initialize the MailSpool class.
+        :param spool_dir: Directory holding the queued messages.
+        :param max_attempts: Delivery attempts before a message is moved to failed/.
+        :param retry_delay: Seconds to wait before retrying a message; doubled after each failed attempt.
+        """
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay = float(retry_delay)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def enqueue(self, msg, from_address, to_addresses):
+        """
+        Queue a message.
+        :param msg: Email message object.
+        :param from_address: Envelope sender.
+        :param to_addresses: List of envelope recipients.
+        :return: ID of the queued message.
+        """
+        # The time prefix keeps the messages in the order they were queued
+        message_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self._write_atomic(f"{message_id}.eml", msg.as_bytes())
+        self._write_envelope(message_id, {"from": from_address, "to": list(to_addresses), "attempts": 0,
+                                          "next_attempt": 0, "queued": time.time()})
+        return message_id
+
+    def pending(self, now=None):
+        """
+        List the queued messages that are due for delivery.
+        :param now: Unix time to compare the retry times against.
+        :return: List of (message ID, envelope) tuples in the order they were queued.
+        """
+        now = time.time() if now is None else now
+        messages = []
+        for entry in sorted(os.listdir(self.spool_dir)):
+            if not entry.endswith(".json"):
+                continue
+            message_id = entry[:-len(".json")]
+            try:
+                with open(os.path.join(self.spool_dir, entry), "r") as envelope_file:
+                    envelope = json.load(envelope_file)
+            except (OSError, ValueError):
+                continue
+            if envelope.get("next_attempt", 0) <= now:
+                messages.append((message_id, envelope))
+        return messages
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the spool lock for a delivery, waiting for another process delivering from the spool.
+        """
+        with open(os.path.join(self.spool_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def count(self):
+        """
+        Count the queued messages, due or not.
+        :return: Number of queued messages.
+        """
+        return sum(1 for entry in os.listdir(self.spool_dir) if entry.endswith(".json"))
+
+    def read_message(self, message_id):
+        """
+        Read a queued message.
+        :param message_id: ID of the message.
+        :return: The message as bytes.
+        """
+        with open(os.path.join(self.spool_dir, f"{message_id}.eml"), "rb") as message_file:
+            return message_file.read()
+
+    def delivered(self, message_id):
+        """
+        Remove a delivered message from the spool.
+        :param message_id: ID of the message.
+        """
+        for suffix in (".json", ".eml"):
+            try:
+                os.remove(os.path.join(self.spool_dir, message_id + suffix))
+            except FileNotFoundError:
+                pass
+
+    def deferred(self, message_id, envelope, error):
+        """
+        Record a failed delivery attempt. The message is retried later, or moved to failed/ after max_attempts.
+        :param message_id: ID of the message.
+        :param envelope: Envelope of the message.
+        :param error: Description of the error.
+        :return: Boolean indicating if the message stays queued.
+        """
+        envelope["attempts"] = envelope.get("attempts", 0) + 1
+        envelope["last_error"] = str(error)
+        envelope["next_attempt"] = time.time() + self.retry_delay * 2 ** (envelope["attempts"] - 1)
+        self._write_envelope(message_id, envelope)
+        if envelope["attempts"] >= self.max_attempts:
+            self.rejected(message_id, envelope, error)
+            return False
+        return True
+
+    def rejected(self, message_id, envelope, error):
+        """
+        Move a message the relay will not accept to failed/.
+        :param message_id: ID of the message.
+        :param envelope: Envelope of the message.
+        :param error: Description of the error.
+        """
+        envelope["last_error"] = str(error)
+        self._write_envelope(message_id, envelope)
+        os.replace(os.path.join(self.spool_dir, f"{message_id}.eml"),
+                   os.path.join(self.failed_dir, f"{message_id}.eml"))
+        os.replace(os.path.join(self.spool_dir, f"{message_id}.json"),
+                   os.path.join(self.failed_dir, f"{message_id}.json"))
+
+    def _write_envelope(self, message_id, envelope):
+        """
+        Write the envelope of a message.
+        :param message_id: ID of the message.
+        :param envelope: Envelope dictionary.
+        """
+        self._write_atomic(f"{message_id}.json", json.dumps(envelope).encode("utf-8"))
+
+    def _write_atomic(self, name, data):
+        """
+        Write a spool file so that it is either complete or absent, even after a crash.
+        :param name: File name inside the spool directory.
+        :param data: Content as bytes.
+        """
+        path = os.path.join(self.spool_dir, name)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as spool_file:
+            spool_file.write(data)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(temp_path, path)
+
 
 class EmailNotifier:
     """
     Class to handle sending emails.
+    With a spool, messages are queued first and flush() delivers everything queued over one connection,
+    so a slow or unreachable relay delays a notification instead of losing it.
+    smtplib and the email package are only imported when a message is sent, keeping them out of the startup.
     """
-    def __init__(self, smtp_server, smtp_port, smtp_username, smtp_password):
+    def __init__(self, smtp_server, smtp_port, smtp_username, smtp_password, spool=None, timeout=30,
+                 connect_attempts=3, connect_backoff=5, starttls=True):
         """
         Initialize the EmailNotifier class.
         :param smtp_server: SMTP server address.
         :param smtp_port: SMTP server port.
-        :param smtp_username: SMTP server username.
+        :param smtp_username: SMTP server username; no login when empty.
         :param smtp_password: SMTP server password.
+        :param spool: Optional MailSpool to queue messages in.
+        :param timeout: Seconds to wait for the SMTP server before giving up on a connection.
+        :param connect_attempts: Connection attempts per flush.
+        :param connect_backoff: Seconds to wait after the first failed connection; doubled after each one.
+        :param starttls: Whether to switch the connection to TLS.
         """
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
         self.smtp_username = smtp_username
         self.smtp_password = smtp_password
+        self.spool = spool
+        self.timeout = timeout
+        self.connect_attempts = max(1, int(connect_attempts))
+        self.connect_backoff = connect_backoff
+        self.starttls = starttls
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create an EmailNotifier from the configuration, spooling to MAIL_SPOOL_DIR.
+        :param config: Configuration object.
+        :return: EmailNotifier object.
+        """
+        spool_dir = getattr(config, "MAIL_SPOOL_DIR", None)
+        if spool_dir is None and getattr(config, "BASE_BACKUP_DIR", None):
+            spool_dir = os.path.join(config.BASE_BACKUP_DIR, "mail-spool")
+        spool = MailSpool(spool_dir, getattr(config, "MAIL_SPOOL_MAX_ATTEMPTS", 20),
+                          getattr(config, "MAIL_SPOOL_RETRY_DELAY", 60)) if spool_dir else None
+        return cls(config.SMTP_SERVER, config.SMTP_PORT, config.SMTP_USERNAME, config.SMTP_PASSWORD, spool,
+                   getattr(config, "SMTP_TIMEOUT", 30), getattr(config, "SMTP_CONNECT_ATTEMPTS", 3),
+                   getattr(config, "SMTP_CONNECT_BACKOFF", 5), getattr(config, "SMTP_STARTTLS", True))
 
     def send_email(self, subject, to_addresses, from_address, body_path, attachment_path=None):
         """
@@ -31,7 +210,13 @@ class EmailNotifier:
         :param from_address: Sender email address.
         :param body_path: Path to the email body file.
         :param attachment_path: Path to the attachment file.
+        :return: Tuple containing the number of messages delivered and the number still queued.
         """
+        from email import encoders
+        from email.mime.base import MIMEBase
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
         # Ensure to_addresses is a list and correctly formatted
         if isinstance(to_addresses, str):
             to_addresses = [to_addresses]
@@ -60,8 +245,104 @@ class EmailNotifier:
                 part.add_header("Content-Disposition", f"attachment; filename= {os.path.basename(attachment_path)}")
                 msg.attach(part)
 
-        # Send the email
-        self._send(msg, from_address, to_addresses_list)
+        return self.send_message(msg, from_address, to_addresses_list)
+
+    def send_message(self, msg, from_address, to_addresses):
+        """
+        Send a prepared message. With a spool it is queued and delivered with everything else queued.
+        :param msg: Email message object.
+        :param from_address: Sender email address.
+        :param to_addresses: List of recipient email addresses.
+        :return: Tuple containing the number of messages delivered and the number still queued.
+        """
+        if self.spool is None:
+            self._send(msg, from_address, to_addresses)
+            return 1, 0
+        self.spool.enqueue(msg, from_address, to_addresses)
+        return self.flush()
+
+    def flush(self):
+        """
+        Deliver the queued messages that are due over one connection.
+        A connection that drops is re-established once. Messages the relay refuses for good are moved to failed/;
+        the others stay queued for a later flush. A failed login is raised, as retrying cannot fix it.
+        :return: Tuple containing the number of messages delivered and the number still queued.
+        """
+        with self.spool.locked():
+            return self._flush()
+
+    def _flush(self):
+        """
+        Deliver the queued messages that are due; the spool lock must be held.
+        :return: Tuple containing the number of messages delivered and the number still queued.
+        """
+        import smtplib
+
+        delivered = 0
+        server = None
+        try:
+            for message_id, envelope in self.spool.pending():
+                for attempt in range(2):
+                    if server is None:
+                        server = self._connect()
+                    try:
+                        server.sendmail(envelope["from"], envelope["to"], self.spool.read_message(message_id))
+                    except smtplib.SMTPRecipientsRefused as e:
+                        self.spool.rejected(message_id, envelope, f"Failed to send email: {e.recipients}")
+                    except smtplib.SMTPResponseException as e:
+                        if 500 <= e.smtp_code < 600:
+                            self.spool.rejected(message_id, envelope, f"SMTP error occurred: {e}")
+                        else:
+                            self.spool.deferred(message_id, envelope, f"SMTP error occurred: {e}")
+                    except OSError as e:
+                        # The relay dropped the connection; reconnect and retry once
+                        server = None
+                        if attempt == 0:
+                            continue
+                        self.spool.deferred(message_id, envelope, f"SMTP error occurred: {e}")
+                        raise
+                    else:
+                        self.spool.delivered(message_id)
+                        delivered += 1
+                    break
+        except smtplib.SMTPAuthenticationError as e:
+            raise RuntimeError(f"SMTP authentication failed, the emails stay in the mail spool: {e}")
+        except OSError:
+            # The relay is unreachable; the remaining messages wait for the next flush
+            pass
+        finally:
+            if server is not None:
+                try:
+                    server.quit()
+                except OSError:
+                    server.close()
+        return delivered, self.spool.count()
+
+    def _connect(self):
+        """
+        Open an SMTP connection, retrying with exponential backoff.
+        :return: Connected smtplib.SMTP object.
+        """
+        import smtplib
+
+        for attempt in range(self.connect_attempts):
+            try:
+                server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+                try:
+                    if self.starttls:
+                        server.starttls()
+                    if self.smtp_username:
+                        server.login(self.smtp_username, self.smtp_password)
+                except BaseException:
+                    server.close()
+                    raise
+                return server
+            except smtplib.SMTPAuthenticationError:
+                raise
+            except OSError:
+                if attempt == self.connect_attempts - 1:
+                    raise
+                time.sleep(self.connect_backoff * 2 ** attempt)
 
     def _send(self, msg, from_address, to_addresses):
         """
@@ -70,10 +351,11 @@ class EmailNotifier:
         :param from_address: Sender email address.
         :param to_addresses: List of recipient email addresses.
         """
+        import smtplib
+
         try:
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.smtp_username, self.smtp_password)
+            server = self._connect()
+            with server:
                 server.sendmail(from_address, to_addresses, msg.as_string())
         except smtplib.SMTPRecipientsRefused as e:
             raise RuntimeError(f"Failed to send email: {e.recipients}")
@@ -0,0 +1,228 @@
+# backup_manager/log_attachment.py
+import gzip
+import os
+from i18n import _
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# How far back from an error to look for its context lines
+CONTEXT_WINDOW_BYTES = 256 * 1024
+
+
+class LogAttachment:
+    """
+    Class to turn the log of a failed run into an email attachment no larger than a configured limit.
+    Depending on LOG_ATTACHMENT_MODE the log is attached as it is ('full'), gzipped ('gzip') or as excerpts
+    around each recorded error plus its last lines ('excerpt'). A form that does not fit falls back to the next
+    one in that order; the excerpts are cut to fit as a last resort.
+    """
+    MODES = ("full", "gzip", "excerpt")
+
+    def __init__(self, config, log_file, index_file, line_count):
+        """
+        Initialize the LogAttachment class.
+        :param config: Configuration object.
+        :param log_file: Path to the log file.
+        :param index_file: Path to the error index written next to the log file.
+        :param line_count: Number of lines in the log file.
+        """
+        self.log_file = log_file
+        self.index_file = index_file
+        self.line_count = line_count
+        self.server_name = config.SERVER_NAME
+        mode = getattr(config, "LOG_ATTACHMENT_MODE", "gzip")
+        self.modes = self.MODES[self.MODES.index(mode):] if mode in self.MODES else self.MODES[1:]
+        self.max_bytes = int(getattr(config, "LOG_ATTACHMENT_MAX_BYTES", 5 * 1024 * 1024))
+        self.context_lines = int(getattr(config, "LOG_ATTACHMENT_CONTEXT_LINES", 20))
+        self.tail_lines = int(getattr(config, "LOG_ATTACHMENT_TAIL_LINES", 200))
+
+    @property
+    def location_note(self):
+        """
+        Sentence telling where the full log is.
+        """
+        return _("The full log is at {} on {}.").format(self.log_file, self.server_name)
+
+    @staticmethod
+    def describe(mode):
+        """
+        Describe what a mode attaches.
+        :param mode: Mode returned by build().
+        :return: Translated description.
+        """
+        return {"full": _("the complete log"), "gzip": _("the complete log, gzipped"),
+                "excerpt": _("excerpts around each error and the end of the log")}[mode]
+
+    def build(self, directory):
+        """
+        Write the attachment into a directory.
+        :param directory: Directory for the attachment, e.g. a temporary one.
+        :return: Tuple containing the path of the attachment and the mode used.
+        """
+        name = os.path.basename(self.log_file)
+        for mode in self.modes:
+            if mode == "full" and os.path.getsize(self.log_file) <= self.max_bytes:
+                return self.log_file, mode
+            if mode == "gzip":
+                path = os.path.join(directory, f"{name}.gz")
+                if self._write_gzip(path):
+                    return path, mode
+        path = os.path.join(directory, f"{name}.excerpt.txt")
+        self._write_excerpt(path)
+        return path, "excerpt"
+
+    def _write_gzip(self, path):
+        """
+        Compress the log chunk by chunk, giving up as soon as the output exceeds the limit.
+        :param path: Path of the compressed file.
+        :return: Boolean indicating if the compressed log fits.
+        """
+        with open(self.log_file, "rb") as source, open(path, "wb") as target:
+            with gzip.GzipFile(filename=os.path.basename(self.log_file), mode="wb", fileobj=target) as compressed:
+                for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+                    compressed.write(chunk)
+                    if target.tell() > self.max_bytes:
+                        break
+        if os.path.getsize(path) <= self.max_bytes:
+            return True
+        os.remove(path)
+        return False
+
+    def _error_positions(self):
+        """
+        Read the line numbers and byte offsets of the recorded errors.
+        :return: List of (line, offset) tuples.
+        """
+        if not os.path.exists(self.index_file):
+            return []
+        positions = []
+        with open(self.index_file, "r", encoding="utf-8") as index:
+            for entry in index:
+                fields = entry.split("\t", 2)
+                if len(fields) == 3 and fields[0].isdigit() and fields[1].isdigit():
+                    positions.append((int(fields[0]), int(fields[1])))
+        return positions
+
+    def _excerpt_ranges(self, log, size):
+        """
+        Find the byte ranges to excerpt: the context around each error and the tail of the log.
+        Overlapping ranges are merged.
+        :param log: Log file opened in binary mode.
+        :param size: Size of the log in bytes.
+        :return: List of (start, end) byte ranges in file order.
+        """
+        ranges = []
+        for _line, offset in self._error_positions():
+            if offset >= size:
+                continue
+            ranges.append((self._lines_before(log, offset, self.context_lines),
+                           self._lines_after(log, offset, self.context_lines + 1)))
+        ranges.append((self._lines_before(log, size, self.tail_lines), size))
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def _line_number(log, offset, anchors):
+        """
+        Get the line number of the line starting at an offset, counting from the nearest known position.
+        :param log: Log file opened in binary mode.
+        :param offset: Byte offset at the start of a line.
+        :param anchors: List of (line, offset) tuples of known line starts.
+        :return: 1-based line number.
+        """
+        line, anchor = min(anchors, key=lambda known: abs(known[1] - offset))
+        log.seek(min(anchor, offset))
+        newlines = 0
+        remaining = abs(anchor - offset)
+        while remaining > 0:
+            chunk = log.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            newlines += chunk.count(b"\n")
+            remaining -= len(chunk)
+        return line + newlines if offset >= anchor else line - newlines
+
+    @staticmethod
+    def _lines_before(log, offset, count):
+        """
+        Find the start of the line lying a number of lines before an offset.
+        :param log: Log file opened in binary mode.
+        :param offset: Byte offset at the start of a line.
+        :param count: Number of lines to go back.
+        :return: Byte offset of that line's start.
+        """
+        window_start = max(0, offset - CONTEXT_WINDOW_BYTES)
+        log.seek(window_start)
+        window = log.read(offset - window_start)
+        position = len(window)
+        for _unused in range(count):
+            newline = window.rfind(b"\n", 0, max(position - 1, 0))
+            if newline < 0:
+                # Back at the start of the file, or of the window when the lines are very long
+                return window_start if window_start == 0 else window_start + window.find(b"\n") + 1
+            position = newline + 1
+        return window_start + position
+
+    @staticmethod
+    def _lines_after(log, offset, count):
+        """
+        Find the end of the line lying a number of lines after an offset.
+        :param log: Log file opened in binary mode.
+        :param offset: Byte offset at the start of a line.
+        :param count: Number of lines to include.
+        :return: Byte offset just after those lines.
+        """
+        log.seek(offset)
+        for _unused in range(count):
+            if not log.readline(CONTEXT_WINDOW_BYTES):
+                break
+        return log.tell()
+
+    def _write_excerpt(self, path):
+        """
+        Write the excerpts, dropping the earliest ones and then cutting the tail if they do not fit.
+        :param path: Path of the excerpt file.
+        """
+        header = (_("Excerpt of {}: {} lines around each error and the last {} lines.").format(
+            self.log_file, self.context_lines, self.tail_lines) + f" {self.location_note}\n").encode("utf-8")
+        with open(self.log_file, "rb") as log:
+            size = os.fstat(log.fileno()).st_size
+            ranges = self._excerpt_ranges(log, size)
+            # Room for the note on omitted excerpts is kept whether or not it is needed
+            omitted_note = f"[{len(ranges)} earlier excerpts omitted]\n".encode("utf-8")
+            budget = self.max_bytes - len(header) - len(omitted_note)
+            kept = []
+            for start, end in reversed(ranges):
+                # Later excerpts and the tail matter most, so the budget goes to them first
+                length = min(end - start, budget - 64)
+                if length <= 0:
+                    break
+                kept.append((end - length, end))
+                budget -= length + 64
+            anchors = [(1, 0), (self.line_count + 1, size)] + self._error_positions()
+            with open(path, "wb") as excerpt:
+                excerpt.write(header)
+                if len(kept) < len(ranges):
+                    excerpt.write(f"[{len(ranges) - len(kept)} earlier excerpts omitted]\n".encode("utf-8"))
+                for start, end in reversed(kept):
+                    # A range cut to fit may start mid-line; it is numbered from the next full line
+                    first_line = start
+                    if start > 0:
+                        log.seek(start - 1)
+                        if log.read(1) != b"\n":
+                            log.readline(CONTEXT_WINDOW_BYTES)
+                            first_line = log.tell()
+                    excerpt.write(f"\n----- from line {self._line_number(log, first_line, anchors)} -----\n"
+                                  .encode("utf-8"))
+                    log.seek(start)
+                    remaining = end - start
+                    while remaining > 0:
+                        chunk = log.read(min(COPY_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        excerpt.write(chunk)
+                        remaining -= len(chunk)
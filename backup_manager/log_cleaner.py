@@ -1,11 +1,24 @@
 # backup_manager/log_cleaner.py
+import gzip
 import os
-from datetime import datetime, timedelta
+import time
 from i18n import _
 
+COPY_CHUNK_SIZE = 1024 * 1024
+# Files written next to each log; they are kept, compressed and removed together with it
+SIDECAR_SUFFIXES = (".gz", ".idx", ".jsonl")
+# Sidecars that stay readable uncompressed; the error index is tiny and holds offsets into the plain log
+UNCOMPRESSED_SUFFIXES = (".idx",)
+
+
 class LogCleaner:
     """
     Class to handle cleaning old log files.
+    A log and its sidecars (.idx, .jsonl and their gzipped forms) are handled as one group. One pass over the log
+    directory gzips the groups older than LOG_COMPRESS_AFTER_DAYS, then removes the groups older than
+    LOG_RETENTION_DAYS and, oldest first, as many more as needed to fit LOG_RETENTION_MAX_BYTES.
+    The log of the running backup is never touched. A file that cannot be read, compressed or removed is
+    logged and skipped, so the cleanup never fails the backup.
     """
     def __init__(self, config, logger):
         """
@@ -15,16 +28,139 @@ class LogCleaner:
         """
         self.config = config
         self.logger = logger
+        self.retention_days = getattr(config, "LOG_RETENTION_DAYS", config.RETENTION_DAYS)
+        self.max_bytes = getattr(config, "LOG_RETENTION_MAX_BYTES", None)
+        self.compress_after_days = getattr(config, "LOG_COMPRESS_AFTER_DAYS", 7)
 
-    def clean(self, directory, days):
+    def clean(self, directory):
         """
-        Clean log files older than the specified number of days.
+        Compress and remove old log files.
         :param directory: Directory containing log files.
-        :param days: Number of days to retain log files.
-        """
-        cutoff_date = datetime.now() - timedelta(days=days)
-        logs = sorted(os.listdir(directory), key=lambda x: os.path.getmtime(os.path.join(directory, x)))
-        for log in logs[:-days]:
-            log_path = os.path.join(directory, log)
-            os.remove(log_path)
-            self.logger.log(_("Removed old log file: {}").format(log_path))
+        """
+        now = time.time()
+        current_log = os.path.basename(self.config.LOG_FILE)
+        groups = self._scan(directory)
+        current = groups.pop(current_log, {"files": []})
+
+        retention_cutoff = now - self.retention_days * 86400
+        compressed = compressed_bytes = 0
+        if self.compress_after_days is not None:
+            compress_cutoff = now - self.compress_after_days * 86400
+            for group in groups.values():
+                # Logs about to be removed are not worth compressing
+                if not retention_cutoff <= group["mtime"] < compress_cutoff:
+                    continue
+                for index, (path, size, mtime) in enumerate(group["files"]):
+                    if path.endswith(".gz") or path.endswith(UNCOMPRESSED_SUFFIXES):
+                        continue
+                    try:
+                        new_size = self._compress(path, mtime)
+                    except OSError as e:
+                        self._log_skipped(path, e)
+                        continue
+                    group["files"][index] = (f"{path}.gz", new_size, mtime)
+                    compressed += 1
+                    compressed_bytes += size - new_size
+
+        # Oldest first, so the byte budget is met by dropping the oldest logs
+        ordered = sorted(groups.values(), key=lambda group: group["mtime"])
+        total = sum(size for group in ordered for _path, size, _mtime in group["files"])
+        # The running backup's log is kept but counts towards the byte budget
+        total += sum(size for _path, size, _mtime in current["files"])
+        removed = removed_bytes = 0
+        for group in ordered:
+            group_size = sum(size for _path, size, _mtime in group["files"])
+            too_old = group["mtime"] < retention_cutoff
+            over_budget = self.max_bytes is not None and total > self.max_bytes
+            if not too_old and not over_budget:
+                break
+            group_removed = 0
+            for path, size, _mtime in group["files"]:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    self._log_skipped(path, e)
+                    continue
+                self.logger.log(_("Removed old log file: {}").format(path))
+                group_removed += size
+            total -= group_removed
+            removed += 1 if group_removed == group_size else 0
+            removed_bytes += group_removed
+
+        self.logger.log(_("Log cleanup: compressed {} files, saving {} bytes; removed {} logs ({} bytes); "
+                          "{} bytes of logs left.").format(compressed, compressed_bytes, removed, removed_bytes,
+                                                            total))
+
+    def _log_skipped(self, path, error):
+        """
+        Log a file the cleanup could not handle.
+        :param path: Path of the file.
+        :param error: OSError raised.
+        """
+        self.logger.log(_("Log cleanup skipped {}: {}").format(path, error), error=True)
+
+    @staticmethod
+    def _group_name(name):
+        """
+        Get the name of the log a file belongs to, e.g. 'x-backup-log.txt' for 'x-backup-log.txt.jsonl.gz'.
+        :param name: File name.
+        :return: Name of the log.
+        """
+        while name.endswith(SIDECAR_SUFFIXES):
+            name = name[:name.rindex(".")]
+        return name
+
+    def _scan(self, directory):
+        """
+        List the log directory in one pass, grouping each log with its sidecars.
+        Temporary files left by an interrupted compression are removed.
+        :param directory: Directory containing log files.
+        :return: Dictionary mapping log names to dictionaries with the newest mtime and a list of
+                 (path, size, mtime) tuples.
+        """
+        groups = {}
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            self._log_skipped(directory, e)
+            return groups
+        with entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if entry.name.endswith(".gz.tmp"):
+                        os.remove(entry.path)
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    self._log_skipped(entry.path, e)
+                    continue
+                group = groups.setdefault(self._group_name(entry.name), {"mtime": 0, "files": []})
+                group["files"].append((entry.path, stat.st_size, stat.st_mtime))
+                group["mtime"] = max(group["mtime"], stat.st_mtime)
+        return groups
+
+    @staticmethod
+    def _compress(path, mtime):
+        """
+        Gzip a file chunk by chunk and replace it with the compressed copy, keeping its mtime so its age is kept.
+        :param path: Path to the file.
+        :param mtime: Modification time of the file.
+        :return: Size of the compressed file.
+        """
+        temp_path = f"{path}.gz.tmp"
+        try:
+            with open(path, "rb") as source, open(temp_path, "wb") as target:
+                with gzip.GzipFile(filename=os.path.basename(path), mode="wb", fileobj=target,
+                                   mtime=int(mtime)) as compressed:
+                    for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+                        compressed.write(chunk)
+            os.utime(temp_path, (mtime, mtime))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, f"{path}.gz")
+        os.remove(path)
+        return os.path.getsize(f"{path}.gz")
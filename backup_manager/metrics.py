@@ -0,0 +1,179 @@
+# backup_manager/metrics.py
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+class BackupMetrics:
+    """
+    Class to collect phase timings and command results of a backup run and export them as a
+    Prometheus node_exporter textfile.
+    Command results arrive as logger events; phases are timed with span().
+    """
+    def __init__(self, config, logger, backup_manager):
+        """
+        Initialize the BackupMetrics class.
+        :param config: Configuration object.
+        :param logger: Logger object; its events are recorded as command results.
+        :param backup_manager: BackupManager recording which phases failed.
+        """
+        self.logger = logger
+        self.backup_manager = backup_manager
+        self.textfile = getattr(config, "PROMETHEUS_TEXTFILE", None)
+        self.server_name = config.SERVER_NAME
+        self.phases = {}
+        self.commands = []
+        self._failures = {}
+        self._lock = threading.Lock()
+        logger.add_event_listener(self.record_event)
+
+    def record_event(self, record):
+        """
+        Record a logger event. Events with a duration are taken as command results,
+        except the phase and whole-run timings, which are not commands.
+        :param record: Event dictionary as written to the JSON-lines log.
+        """
+        if record["event"] in ("phase", "backup_run") or "duration" not in record:
+            return
+        failed = record.get("return_code", 0) != 0 or record.get("success") is False
+        with self._lock:
+            self.commands.append(record)
+            if failed:
+                self._failures[record["phase"]] = self._failures.get(record["phase"], 0) + 1
+
+    @contextmanager
+    def span(self, phase):
+        """
+        Time a backup phase.
+        A phase counts as failed if it raised, marked the run as failed or one of its commands failed.
+        :param phase: Name of the phase.
+        """
+        start = time.monotonic()
+        raised = False
+        try:
+            yield
+        except BaseException:
+            raised = True
+            raise
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                failed = (raised or phase in self.backup_manager.failed_phases
+                          or self._failures.get(phase, 0) > 0)
+                self.phases[phase] = (duration, not failed)
+            self.logger.event("phase", phase, duration=duration, success=not failed)
+
+    def phase_results(self):
+        """
+        Summarize each timed phase with the results of its commands.
+        :return: List of dictionaries with phase, duration, success, bytes (None if no command reported any),
+                 commands, failed_commands and max_return_code.
+        """
+        with self._lock:
+            phases = sorted(self.phases.items())
+            commands = list(self.commands)
+        results = []
+        for phase, (duration, ok) in phases:
+            records = [record for record in commands if record["phase"] == phase]
+            byte_counts = [record["bytes"] for record in records if "bytes" in record]
+            return_codes = [record["return_code"] for record in records if "return_code" in record]
+            results.append({"phase": phase, "duration": duration, "success": ok,
+                            "bytes": sum(byte_counts) if byte_counts else None, "commands": len(records),
+                            "failed_commands": self._failures.get(phase, 0),
+                            "max_return_code": max(return_codes) if return_codes else None})
+        return results
+
+    def write_textfile(self, run_duration, success, end_time=None):
+        """
+        Write the collected metrics to the Prometheus textfile, if one is configured.
+        The file is replaced atomically so node_exporter never reads a partial file.
+        The last success timestamp is carried over from the previous file after a failed run.
+        :param run_duration: Duration of the whole run in seconds.
+        :param success: Whether the run succeeded.
+        :param end_time: Unix time the run ended.
+        """
+        if not self.textfile:
+            return
+        end_time = end_time or time.time()
+        last_success = end_time if success else self._previous_last_success()
+        server = {"server": self.server_name}
+
+        lines = []
+        self._add_metric(lines, "backup_run_duration_seconds", "gauge", "Duration of the last backup run.",
+                         [(server, run_duration)])
+        self._add_metric(lines, "backup_run_success", "gauge", "Whether the last backup run succeeded.",
+                         [(server, int(success))])
+        self._add_metric(lines, "backup_last_run_timestamp_seconds", "gauge", "Time the last backup run ended.",
+                         [(server, end_time)])
+        if last_success is not None:
+            self._add_metric(lines, "backup_last_success_timestamp_seconds", "gauge",
+                             "Time the last successful backup run ended.", [(server, last_success)])
+
+        with self._lock:
+            phases = sorted(self.phases.items())
+            commands = list(self.commands)
+        self._add_metric(lines, "backup_phase_duration_seconds", "gauge", "Duration of each backup phase.",
+                         [({**server, "phase": phase}, duration) for phase, (duration, _ok) in phases])
+        self._add_metric(lines, "backup_phase_success", "gauge", "Whether each backup phase succeeded.",
+                         [({**server, "phase": phase}, int(ok)) for phase, (_duration, ok) in phases])
+
+        command_labels = [({**server, "phase": record["phase"], "event": record["event"],
+                            "name": record.get("name", "")}, record) for record in commands]
+        self._add_metric(lines, "backup_command_duration_seconds", "gauge", "Duration of each backup command.",
+                         [(labels, record["duration"]) for labels, record in command_labels])
+        self._add_metric(lines, "backup_command_bytes", "gauge", "Bytes written or added by each backup command.",
+                         [(labels, record["bytes"]) for labels, record in command_labels if "bytes" in record])
+        self._add_metric(lines, "backup_command_exit_code", "gauge", "Exit code of each backup command.",
+                         [(labels, record["return_code"]) for labels, record in command_labels
+                          if "return_code" in record])
+
+        temp_file = f"{self.textfile}.tmp"
+        with open(temp_file, "w") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(temp_file, self.textfile)
+
+    def _previous_last_success(self):
+        """
+        Read the last success timestamp from the previous textfile.
+        :return: Unix time of the last successful run, or None if unknown or unreadable.
+        """
+        try:
+            with open(self.textfile, "r") as textfile:
+                for line in textfile:
+                    if line.startswith("backup_last_success_timestamp_seconds"):
+                        return float(line.rsplit(" ", 1)[1])
+        except (OSError, ValueError, IndexError):
+            # A missing, truncated or hand-edited textfile must not fail the run
+            pass
+        return None
+
+    @staticmethod
+    def _add_metric(lines, name, metric_type, help_text, samples):
+        """
+        Append a metric family in the Prometheus text format.
+        :param lines: List of output lines.
+        :param name: Metric name.
+        :param metric_type: Prometheus metric type.
+        :param help_text: Description of the metric.
+        :param samples: List of (labels, value) tuples.
+        """
+        if not samples:
+            return
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        values = {}
+        for labels, value in samples:
+            # A command run twice with the same labels keeps its last value
+            values[",".join(f'{key}="{_escape_label(str(label))}"' for key, label in labels.items())] = value
+        lines.extend(f"{name}{{{label_text}}} {value}" for label_text, value in values.items())
+
+
+def _escape_label(value):
+    """
+    Escape a label value for the Prometheus text format.
+    :param value: Label value.
+    :return: Escaped label value.
+    """
+    return re.sub(r'[\\"\n]', lambda match: {"\\": "\\\\", '"': '\\"', "\n": "\\n"}[match.group(0)], value)
@@ -0,0 +1,81 @@
+# backup_manager/phase_scheduler.py
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class PhaseScheduler:
+    """
+    Class to run backup phases as a dependency graph, starting each phase as soon as the phases it depends on
+    have finished and a slot is free.
+    A phase that returns False or raises cancels every phase depending on it, directly or not; the other phases
+    carry on. The exceptions raised are kept in errors.
+    Background phases run outside the slots; run() still waits for them before it returns.
+    """
+    COMPLETED = "completed"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    def __init__(self, max_parallel=1):
+        """
+        Initialize the PhaseScheduler class.
+        :param max_parallel: Maximum number of phases running at once.
+        """
+        self.max_parallel = max(1, int(max_parallel))
+        self.phases = {}
+        self.errors = {}
+
+    def add(self, name, function, depends_on=(), background=False):
+        """
+        Add a phase. Phases must be added after the phases they depend on.
+        :param name: Name of the phase.
+        :param function: Callable running the phase; returning False cancels the dependent phases.
+        :param depends_on: Names of the phases that must finish first.
+        :param background: Run the phase on its own thread as soon as it is ready, without taking a slot,
+                           for housekeeping that should not delay the other phases.
+        """
+        unknown = [dependency for dependency in depends_on if dependency not in self.phases]
+        if unknown:
+            raise ValueError(f"Phase {name} depends on unknown phases: {', '.join(unknown)}")
+        self.phases[name] = (function, tuple(depends_on), background)
+
+    def run(self, runner=None):
+        """
+        Run every phase. When several phases are ready, they start in the order they were added,
+        so with a single slot the phases run in that order.
+        A phase that raises counts as failed and its exception is kept in errors; run() itself does not raise.
+        :param runner: Callable invoked as runner(name, function) in the worker thread, e.g. to time the phase;
+                       it must return the function's result.
+        :return: Dictionary mapping phase names to their status.
+        """
+        runner = runner or (lambda name, function: function())
+        status = {}
+        pending = list(self.phases)
+        running = {}
+        self.errors = {}
+        background_count = sum(1 for _function, _dependencies, background in self.phases.values() if background)
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor, \
+                ThreadPoolExecutor(max_workers=max(1, background_count)) as background_executor:
+            while pending or running:
+                busy = sum(1 for name in running.values() if not self.phases[name][2])
+                for name in list(pending):
+                    function, dependencies, background = self.phases[name]
+                    if not background and busy >= self.max_parallel:
+                        continue
+                    if any(status.get(dependency) in (self.FAILED, self.SKIPPED) for dependency in dependencies):
+                        status[name] = self.SKIPPED
+                        pending.remove(name)
+                    elif all(status.get(dependency) == self.COMPLETED for dependency in dependencies):
+                        pool = background_executor if background else executor
+                        running[pool.submit(runner, name, function)] = name
+                        pending.remove(name)
+                        busy += 0 if background else 1
+                if not running:
+                    continue
+                done, _unused = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = self.FAILED if future.result() is False else self.COMPLETED
+                    except Exception as exception:
+                        status[name] = self.FAILED
+                        self.errors[name] = exception
+        return status
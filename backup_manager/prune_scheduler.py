@@ -0,0 +1,73 @@
+# backup_manager/prune_scheduler.py
+import json
+import os
+from datetime import datetime, timedelta
+
+
+class PruneScheduler:
+    """
+    Class to decide when the expensive `restic prune` may run, separately from the nightly `forget`.
+    """
+    def __init__(self, config):
+        """
+        Initialize the PruneScheduler class.
+        :param config: Configuration object.
+        """
+        self.state_file = getattr(config, "RESTIC_PRUNE_STATE_FILE",
+                                  os.path.join(config.BASE_BACKUP_DIR, "restic-prune-state.json"))
+        self.interval = timedelta(days=getattr(config, "RESTIC_PRUNE_INTERVAL_DAYS", 7))
+        self.timeout = getattr(config, "RESTIC_PRUNE_TIMEOUT", 4 * 3600)
+        self.window = getattr(config, "RESTIC_PRUNE_WINDOW", None)
+
+    def last_prune(self):
+        """
+        Get the time of the last successful prune.
+        :return: Datetime of the last prune, or None if the repository was never pruned by this script.
+        """
+        if not os.path.exists(self.state_file):
+            return None
+        try:
+            with open(self.state_file, "r") as state:
+                return datetime.fromisoformat(json.load(state)["last_prune"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def record_prune(self, prune_time):
+        """
+        Record a successful prune.
+        :param prune_time: Time the prune started.
+        """
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, "w") as state:
+            json.dump({"last_prune": prune_time.isoformat(timespec="seconds")}, state)
+        os.replace(temp_file, self.state_file)
+
+    def is_interval_due(self, now=None):
+        """
+        Check whether the prune interval has passed since the last prune.
+        :param now: Current time.
+        :return: Boolean indicating if a prune is due by schedule.
+        """
+        last_prune = self.last_prune()
+        return last_prune is None or (now or datetime.now()) - last_prune >= self.interval
+
+    def available_time(self, now=None):
+        """
+        Get how long a prune started now may run.
+        :param now: Current time.
+        :return: Timeout in seconds, or None if now is outside the prune window.
+        """
+        if not self.window:
+            return self.timeout
+        now = now or datetime.now()
+        start, end = (datetime.combine(now.date(), datetime.strptime(value, "%H:%M").time()) for value in self.window)
+        if end <= start:
+            # The window spans midnight
+            if now >= start:
+                end += timedelta(days=1)
+            else:
+                start -= timedelta(days=1)
+        if not start <= now < end:
+            return None
+        remaining = (end - now).total_seconds()
+        return min(self.timeout, remaining) if remaining >= 60 else None
@@ -1,10 +1,14 @@
 # backup_manager/restic_backup.py
 import os
 import random
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from .base_backup import BaseBackup
+from .prune_scheduler import PruneScheduler
+from .restic_summary import ResticBackupSummary, ResticJsonParser
 from i18n import _
-from utils import format_duration, log_and_email, is_restic_locked, BackupSizeCalculator
+from utils import format_bytes, format_duration, log_and_email, is_restic_locked, parse_size, BackupSizeCalculator
 
 
 class ResticBackup(BaseBackup):
@@ -24,6 +28,7 @@ class ResticBackup(BaseBackup):
         self.command_runner = command_runner
         self.backup_paths = self.detect_services()
         self.size_calculator = BackupSizeCalculator(config, command_runner, logger)
+        self.prune_scheduler = PruneScheduler(config)
 
     def detect_services(self):
         """
@@ -36,19 +41,107 @@ class ResticBackup(BaseBackup):
                 backup_paths.update(paths)
         return list(backup_paths)
 
+    def detect_service_groups(self):
+        """
+        Detect the snapshot groups for per-service backups: the default paths plus one group per configured service.
+        A path shared by several services belongs to the first service listing it. Groups left without paths are
+        skipped, as restic refuses to back up nothing.
+        :return: List of tuples containing group name and list of paths.
+        """
+        groups = [("default", list(self.config.DEFAULT_PATHS))] if self.config.DEFAULT_PATHS else []
+        claimed_paths = set(self.config.DEFAULT_PATHS)
+        for service, paths in self.config.SERVICE_CONFIGS.items():
+            if not any(os.path.isdir(path) for path in paths):
+                continue
+            service_paths = [path for path in paths if path not in claimed_paths]
+            if service_paths:
+                groups.append((service, service_paths))
+                claimed_paths.update(service_paths)
+        return groups
+
     def apply_retention_policy(self):
         """
-        Apply the retention policy to the Restic repository.
+        Apply the retention policy to the Restic repository. Pruning is a separate step, see prune_if_due().
+        :return: Boolean indicating if the retention policy was applied.
         """
         log_and_email(self.backup_manager, self.logger, _("Applying retention policy..."))
 
         if is_restic_locked(self.config.RESTIC_REPOSITORY, self.config.RESTIC_PASSWORD_FILE, self.command_runner,
                             self.logger):
             self._handle_locked_repository("Error: Restic repository is locked! Cannot apply retention policy.")
+            return False
+
+        forget_command = f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} forget --keep-daily 7 --keep-weekly 4 --keep-monthly 12 --keep-yearly 1"
+        return self._run_retention_command(forget_command)
+
+    def _prune_options(self):
+        """
+        Build the options limiting how much work a prune does.
+        :return: Option string for `restic prune`.
+        """
+        options = f" --max-unused {getattr(self.config, 'RESTIC_PRUNE_MAX_UNUSED', '5%')}"
+        max_repack_size = getattr(self.config, "RESTIC_PRUNE_MAX_REPACK_SIZE", None)
+        if max_repack_size:
+            options += f" --max-repack-size {max_repack_size}"
+        return options
+
+    def _prune_due_reason(self, timeout):
+        """
+        Determine whether a prune is due.
+        :param timeout: Time available for the check, in seconds.
+        :return: Reason for pruning, or None if no prune is due.
+        """
+        if self.prune_scheduler.is_interval_due():
+            last_prune = self.prune_scheduler.last_prune()
+            if last_prune is None:
+                return _("no prune recorded yet")
+            return _("last prune on {}").format(last_prune.strftime("%Y-%m-%d"))
+
+        threshold = getattr(self.config, "RESTIC_PRUNE_UNUSED_THRESHOLD_PERCENT", None)
+        if threshold is None:
+            return None
+        dry_run_command = f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} prune --dry-run{self._prune_options()}"
+        return_code, stdout, stderr = self.command_runner.run(dry_run_command, verbose=True, timeout=timeout)
+        reclaimable = re.search(r"total prune:\s+\d+ blobs / ([\d.]+ \w+)", stdout)
+        remaining = re.search(r"remaining:\s+\d+ blobs / ([\d.]+ \w+)", stdout)
+        if return_code != 0 or not reclaimable or not remaining:
+            self.logger.log(_("Could not estimate unused repository space: {}").format(stderr))
+            return None
+        total = parse_size(reclaimable.group(1)) + parse_size(remaining.group(1))
+        unused_percent = 100 * parse_size(reclaimable.group(1)) / total if total else 0
+        if unused_percent < threshold:
+            return None
+        return _("{:.1f}% of the repository is reclaimable").format(unused_percent)
+
+    def prune_if_due(self):
+        """
+        Prune the repository if its schedule or unused space calls for it and the prune window is open.
+        """
+        timeout = self.prune_scheduler.available_time()
+        if timeout is None:
+            self.logger.log(_("Outside the prune window, skipping prune."))
             return
+        reason = self._prune_due_reason(timeout)
+        if reason is None:
+            self.logger.log(_("Prune not due."))
+            return
+
+        log_and_email(self.backup_manager, self.logger, _("Pruning repository ({})...").format(reason))
+        prune_start_time = datetime.now()
+        prune_command = f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} prune{self._prune_options()}"
+        return_code, stdout, stderr = self.command_runner.run_streaming(prune_command, verbose=True, timeout=timeout)
+        prune_end_time = datetime.now()
+        prune_duration = format_duration(prune_end_time - prune_start_time)
+        self.logger.event("restic_prune", "prune", duration=(prune_end_time - prune_start_time).total_seconds(),
+                          return_code=return_code, reason=reason)
 
-        forget_command = f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} forget --keep-daily 7 --keep-weekly 4 --keep-monthly 12 --keep-yearly 1 --prune"
-        self._run_retention_command(forget_command)
+        if return_code != 0:
+            error_message = _("Error: Prune failed or ran out of time! See log for details at line {}.").format(
+                self.logger.anchor()[0])
+            log_and_email(self.backup_manager, self.logger, error_message, error=True)
+        else:
+            self.prune_scheduler.record_prune(prune_start_time)
+            log_and_email(self.backup_manager, self.logger, _("Prune completed successfully in {}.").format(prune_duration))
 
     def _handle_locked_repository(self, message):
         """
@@ -63,20 +156,25 @@ class ResticBackup(BaseBackup):
         """
         Run the Restic forget command to apply the retention policy.
         :param forget_command: Command to apply the retention policy.
+        :return: Boolean indicating if the command succeeded.
         """
         retention_start_time = datetime.now()
-        return_code, stdout, stderr = self.command_runner.run(forget_command, verbose=True, timeout=3600)
+        return_code, stdout, stderr = self.command_runner.run_streaming(forget_command, verbose=True, timeout=3600)
         retention_end_time = datetime.now()
         retention_duration = format_duration(retention_end_time - retention_start_time)
+        self.logger.event("restic_forget", "retention",
+                          duration=(retention_end_time - retention_start_time).total_seconds(),
+                          return_code=return_code)
 
         if return_code != 0:
             error_message = _("Error: Retention policy application failed! See log for details at line {}.").format(
-                len(open(self.config.LOG_FILE).readlines()) + 1)
+                self.logger.anchor()[0])
             log_and_email(self.backup_manager, self.logger, error_message, error=True)
             self.backup_manager.backup_success = False
-        else:
-            log_and_email(self.backup_manager, self.logger,
-                          _("Retention policy applied successfully in {}.").format(retention_duration))
+            return False
+        log_and_email(self.backup_manager, self.logger,
+                      _("Retention policy applied successfully in {}.").format(retention_duration))
+        return True
 
     @staticmethod
     def should_run_backup():
@@ -94,16 +192,19 @@ class ResticBackup(BaseBackup):
 
     def run_backup(self):
         """
-        Run the Restic backup process.
+        Run the Restic backup process. Size reporting, retention and pruning are separate steps.
+        :return: Boolean indicating if the repository was usable, i.e. whether the later steps should run.
         """
         backup_type = self.should_run_backup()
-        if backup_type:
-            self._start_backup_process(backup_type)
+        if not backup_type:
+            return False
+        return self._start_backup_process(backup_type)
 
     def _start_backup_process(self, backup_type):
         """
         Start the Restic backup process for the specified backup type.
         :param backup_type: Type of backup to run.
+        :return: Boolean indicating if the repository was usable.
         """
         log_and_email(self.backup_manager, self.logger, f"Restic {backup_type.capitalize()} " + _("Backup"),
                       section=True)
@@ -112,33 +213,76 @@ class ResticBackup(BaseBackup):
         if is_restic_locked(self.config.RESTIC_REPOSITORY, self.config.RESTIC_PASSWORD_FILE, self.command_runner,
                             self.logger):
             self._handle_locked_repository("Error: Restic repository is locked! Cannot start backup.")
-            return
+            return False
 
         # Simulate failure
         simulate_failure = self.config.SIMULATE_FAILURES and False
 
         if simulate_failure:
             self._simulate_failure()
-            return
+            return False
 
+        if getattr(self.config, "RESTIC_SNAPSHOT_MODE", "single") == "per-service":
+            self._run_service_snapshots(backup_type)
+        else:
+            return_code, parser, restic_duration = self._run_snapshot(self.backup_paths)
+            if return_code != 0:
+                error_message = _("Error: Restic {} backup failed! See log for details at line {}.").format(backup_type,
+                                                                                                            self.logger.anchor()[0])
+                log_and_email(self.backup_manager, self.logger, error_message, error=True)
+                self.backup_manager.backup_success = False
+            else:
+                self._log_backup_success(parser, backup_type, restic_duration)
+                self.backup_manager.restic_summary = parser.summary
+        return True
+
+    def _run_snapshot(self, paths, tags=()):
+        """
+        Run a single `restic backup` over the given paths.
+        :param paths: List of paths to back up.
+        :param tags: Tags to attach to the snapshot.
+        :return: Tuple containing return code, ResticJsonParser holding the output, and formatted duration.
+        """
         restic_start_time = datetime.now()
-        backup_command = f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} backup {' '.join(self.backup_paths)}"
-        return_code, stdout, stderr = self.command_runner.run(backup_command, verbose=True, timeout=3600)
+        tag_options = "".join(f" --tag {tag}" for tag in tags)
+        # Progress messages are dropped unparsed, so ask restic for as few of them as possible
+        backup_command = f"RESTIC_PROGRESS_FPS=0.0167 restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} backup --json{tag_options} {' '.join(paths)}"
+        parser = ResticJsonParser()
+        return_code, stdout, stderr = self.command_runner.run_streaming(backup_command, [parser], verbose=True,
+                                                                        timeout=3600, log_filter=parser.is_loggable)
         restic_end_time = datetime.now()
-        restic_duration = format_duration(restic_end_time - restic_start_time)
+        summary = parser.summary
+        self.logger.event("restic_backup", "restic_backup", name=",".join(tags) or None,
+                          duration=(restic_end_time - restic_start_time).total_seconds(),
+                          byte_count=summary.bytes_added if summary else None, return_code=return_code,
+                          snapshot_id=summary.snapshot_id if summary else None)
+        return return_code, parser, format_duration(restic_end_time - restic_start_time)
 
-        if return_code != 0:
-            error_message = _("Error: Restic {} backup failed! See log for details at line {}.").format(backup_type,
-                                                                                                        len(open(
-                                                                                                            self.config.LOG_FILE).readlines()) + 1)
-            log_and_email(self.backup_manager, self.logger, error_message, error=True)
-            self.backup_manager.backup_success = False
-        else:
-            self._log_backup_success(stdout, backup_type, restic_duration)
-
-        self._log_backup_size_info()
+    def _run_service_snapshots(self, backup_type):
+        """
+        Run one tagged snapshot per service group, several at a time.
+        Restic backups only take non-exclusive locks, so they can share the repository.
+        :param backup_type: Type of backup to run.
+        """
+        groups = self.detect_service_groups()
+        workers = max(1, int(getattr(self.config, "RESTIC_BACKUP_WORKERS", 2)))
+        self.logger.log(_("Running {} service snapshots with {} workers.").format(len(groups), workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(name, executor.submit(self._run_snapshot, paths, [name])) for name, paths in groups]
+            results = [(name, future.result()) for name, future in futures]
 
-        self.apply_retention_policy()
+        summaries = []
+        for name, (return_code, parser, restic_duration) in results:
+            if return_code != 0:
+                error_message = _("Error: Restic {} backup of {} failed! See log for details at line {}.").format(
+                    backup_type, name, self.logger.anchor()[0])
+                log_and_email(self.backup_manager, self.logger, error_message, error=True)
+            else:
+                self._log_backup_success(parser, f"{backup_type} {name}", restic_duration)
+                if parser.summary:
+                    summaries.append(parser.summary)
+        if summaries:
+            self.backup_manager.restic_summary = ResticBackupSummary.combine(summaries)
 
     def _simulate_failure(self):
         """
@@ -152,34 +296,36 @@ class ResticBackup(BaseBackup):
         restic_end_time = datetime.now()
         self._handle_error("Error: Restic backup failed for simulated path!", stderr)
 
-    def _log_backup_success(self, stdout, backup_type, restic_duration):
+    def _log_backup_success(self, parser, backup_type, restic_duration):
         """
         Log the success of the Restic backup process.
-        :param stdout: Standard output from the backup command.
+        :param parser: ResticJsonParser that read the backup command's output.
         :param backup_type: Type of backup that was run.
         :param restic_duration: Duration of the backup process.
         """
         log_and_email(self.backup_manager, self.logger,
                       _("Restic {} backup completed successfully in {}.").format(backup_type, restic_duration))
-        files_processed = stdout.count("processed")
-        backup_size_line = next((line for line in stdout.splitlines() if "Added to the repository:" in line), None)
-        if backup_size_line:
-            data_transferred, data_stored = self.size_calculator.extract_backup_size(backup_size_line)
+        summary = parser.summary
+        if summary:
+            self.size_calculator.record_snapshot(summary)
+            log_and_email(self.backup_manager, self.logger,
+                          _("Snapshot {}: {} new, {} changed, {} unmodified files").format(
+                              summary.snapshot_id, summary.files_new, summary.files_changed, summary.files_unmodified))
             log_and_email(self.backup_manager, self.logger,
-                          _("Files processed: {}, Data transferred: {}, Data stored: {}").format(files_processed,
-                                                                                                 data_transferred,
-                                                                                                 data_stored))
+                          _("Data added: {}, Data stored: {}").format(format_bytes(summary.bytes_added),
+                                                                      format_bytes(summary.bytes_stored)))
         else:
+            log_and_email(self.backup_manager, self.logger, _("Backup summary: unknown"))
+        if parser.errors:
             log_and_email(self.backup_manager, self.logger,
-                          _("Files processed: {}, Backup size: unknown").format(files_processed))
+                          _("Restic could not read {} items, see log for details.").format(len(parser.errors)))
 
-    def _log_backup_size_info(self):
+    def log_backup_size_info(self):
         """
         Log information about the backup size.
         """
         log_and_email(self.backup_manager, self.logger, _("Backup Size Information"), section=True)
-        uncompressed_size = self.size_calculator.get_uncompressed_size()
-        compressed_size = self.size_calculator.get_compressed_size()
+        uncompressed_size, compressed_size = self.size_calculator.get_repository_sizes()
         total_backup_size = self.size_calculator.calculate_total_backup_size()
 
         log_and_email(self.backup_manager, self.logger,
@@ -0,0 +1,93 @@
+# backup_manager/restic_summary.py
+import json
+from dataclasses import dataclass
+
+
+@dataclass
+class ResticBackupSummary:
+    """
+    Result of a `restic backup` run, taken from its JSON summary message.
+    """
+    files_new: int = 0
+    files_changed: int = 0
+    files_unmodified: int = 0
+    bytes_processed: int = 0
+    bytes_added: int = 0
+    bytes_stored: int = 0
+    duration: float = 0.0
+    snapshot_id: str = None
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Create a summary from a decoded `summary` message.
+        :param message: Dictionary decoded from the JSON line.
+        :return: ResticBackupSummary instance.
+        """
+        bytes_added = message.get("data_added", 0)
+        return cls(files_new=message.get("files_new", 0),
+                   files_changed=message.get("files_changed", 0),
+                   files_unmodified=message.get("files_unmodified", 0),
+                   bytes_processed=message.get("total_bytes_processed", 0),
+                   bytes_added=bytes_added,
+                   # Restic before 0.17 does not report the packed size; fall back to the unpacked one
+                   bytes_stored=message.get("data_added_packed", bytes_added),
+                   duration=message.get("total_duration", 0.0),
+                   snapshot_id=message.get("snapshot_id"))
+
+    @classmethod
+    def combine(cls, summaries):
+        """
+        Combine the summaries of snapshots taken concurrently into one.
+        :param summaries: List of ResticBackupSummary instances.
+        :return: ResticBackupSummary with summed counts, the longest duration and a comma-separated snapshot id.
+        """
+        return cls(files_new=sum(summary.files_new for summary in summaries),
+                   files_changed=sum(summary.files_changed for summary in summaries),
+                   files_unmodified=sum(summary.files_unmodified for summary in summaries),
+                   bytes_processed=sum(summary.bytes_processed for summary in summaries),
+                   bytes_added=sum(summary.bytes_added for summary in summaries),
+                   bytes_stored=sum(summary.bytes_stored for summary in summaries),
+                   duration=max(summary.duration for summary in summaries),
+                   snapshot_id=",".join(str(summary.snapshot_id) for summary in summaries))
+
+
+class ResticJsonParser:
+    """
+    Line handler for CommandRunner.run_streaming that picks the summary and errors out of `restic backup --json`.
+    Progress messages are skipped without being decoded.
+    """
+    def __init__(self):
+        """
+        Initialize the ResticJsonParser class.
+        """
+        self.summary = None
+        self.errors = []
+
+    def __call__(self, line, stream):
+        """
+        Handle one line of output.
+        :param line: Output line.
+        :param stream: Name of the stream the line came from ('stdout' or 'stderr').
+        """
+        if '"message_type":"summary"' not in line and '"message_type":"error"' not in line:
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if message.get("message_type") == "summary":
+            self.summary = ResticBackupSummary.from_message(message)
+        elif message.get("message_type") == "error":
+            error = message.get("error") or {}
+            self.errors.append(f"{message.get('item', '')}: {error.get('message', '')}")
+
+    @staticmethod
+    def is_loggable(line, stream):
+        """
+        Log filter keeping the frequent progress messages out of the log.
+        :param line: Output line.
+        :param stream: Name of the stream the line came from.
+        :return: Boolean indicating if the line should be logged.
+        """
+        return '"message_type":"status"' not in line
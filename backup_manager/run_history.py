@@ -0,0 +1,138 @@
+# backup_manager/run_history.py
+import sqlite3
+
+
+class RunHistory:
+    """
+    Class to keep the history of backup runs in SQLite: one row per run with its result and Restic summary,
+    and one row per phase with its duration, bytes and command results.
+    The database runs in WAL mode, so the summary can read it while a backup writes to it. It must live on a
+    local file system. Runs older than the retention period are removed whenever a run is recorded.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, server TEXT NOT NULL, start_time REAL NOT NULL, "
+        "end_time REAL NOT NULL, duration REAL NOT NULL, success INTEGER NOT NULL, log_file TEXT, "
+        "snapshot_id TEXT, files_new INTEGER, files_changed INTEGER, bytes_added INTEGER, bytes_stored INTEGER, "
+        "reported INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS phases (run_id INTEGER NOT NULL, phase TEXT NOT NULL, duration REAL NOT NULL, "
+        "success INTEGER NOT NULL, bytes INTEGER, commands INTEGER NOT NULL DEFAULT 0, "
+        "failed_commands INTEGER NOT NULL DEFAULT 0, max_return_code INTEGER, PRIMARY KEY (run_id, phase)) "
+        "WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS runs_server_start ON runs (server, start_time)",
+        "CREATE INDEX IF NOT EXISTS runs_start ON runs (start_time)",
+        # Only the few runs still waiting for a summary are in this index
+        "CREATE INDEX IF NOT EXISTS runs_unreported ON runs (reported) WHERE reported = 0",
+    )
+
+    def __init__(self, db_file, retention_days=730):
+        """
+        Initialize the RunHistory class.
+        :param db_file: Path to the SQLite database.
+        :param retention_days: Number of days runs are kept.
+        """
+        self.db_file = db_file
+        self.retention_seconds = retention_days * 86400
+        self._connection = sqlite3.connect(db_file, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+
+    def record_run(self, server, start_time, end_time, success, log_file=None, restic_summary=None, phases=()):
+        """
+        Record a finished run and drop runs older than the retention period.
+        :param server: Server name.
+        :param start_time: Unix time the run started.
+        :param end_time: Unix time the run ended.
+        :param success: Whether the run succeeded.
+        :param log_file: Path to the run's log file.
+        :param restic_summary: ResticBackupSummary of the run, if there is one.
+        :param phases: Iterable of phase dictionaries with phase, duration, success, bytes, commands,
+                       failed_commands and max_return_code.
+        :return: ID of the run.
+        """
+        summary = restic_summary
+        with self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (server, start_time, end_time, duration, success, log_file, snapshot_id, "
+                "files_new, files_changed, bytes_added, bytes_stored) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (server, start_time, end_time, end_time - start_time, int(success), log_file,
+                 summary.snapshot_id if summary else None, summary.files_new if summary else None,
+                 summary.files_changed if summary else None, summary.bytes_added if summary else None,
+                 summary.bytes_stored if summary else None))
+            run_id = cursor.lastrowid
+            self._connection.executemany(
+                "INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((run_id, phase["phase"], phase["duration"], int(phase["success"]), phase.get("bytes"),
+                  phase.get("commands", 0), phase.get("failed_commands", 0), phase.get("max_return_code"))
+                 for phase in phases))
+            self._expire(end_time)
+        return run_id
+
+    def _expire(self, now):
+        """
+        Delete the runs that started before the retention period, with their phases.
+        :param now: Unix time the retention period is counted back from.
+        """
+        cutoff = now - self.retention_seconds
+        self._connection.execute("DELETE FROM phases WHERE run_id IN (SELECT id FROM runs WHERE start_time < ?)",
+                                 (cutoff,))
+        self._connection.execute("DELETE FROM runs WHERE start_time < ?", (cutoff,))
+
+    def unreported_runs(self):
+        """
+        Get the runs no summary has covered yet.
+        :return: List of run rows, ordered by server and start time.
+        """
+        return self._connection.execute(
+            "SELECT * FROM runs WHERE reported = 0 ORDER BY server, start_time").fetchall()
+
+    def mark_reported(self, run_ids):
+        """
+        Mark runs as covered by a summary.
+        :param run_ids: IDs of the runs.
+        """
+        with self._connection:
+            self._connection.executemany("UPDATE runs SET reported = 1 WHERE id = ?",
+                                         ((run_id,) for run_id in run_ids))
+
+    def phases(self, run_id):
+        """
+        Get the phases of a run.
+        :param run_id: ID of the run.
+        :return: List of phase rows.
+        """
+        return self._connection.execute("SELECT * FROM phases WHERE run_id = ?", (run_id,)).fetchall()
+
+    def runs_before(self, server, before_time, limit):
+        """
+        Get the latest successful runs of a server before a point in time.
+        :param server: Server name.
+        :param before_time: Unix time; only runs started before it are returned.
+        :param limit: Maximum number of runs.
+        :return: List of run rows, oldest first.
+        """
+        rows = self._connection.execute(
+            "SELECT * FROM runs WHERE server = ? AND start_time < ? AND success = 1 "
+            "ORDER BY start_time DESC LIMIT ?", (server, before_time, limit)).fetchall()
+        return rows[::-1]
+
+    def phases_before(self, server, before_time, limit):
+        """
+        Get the phases of the runs runs_before() returns.
+        :param server: Server name.
+        :param before_time: Unix time; only runs started before it are included.
+        :param limit: Maximum number of runs.
+        :return: List of phase rows.
+        """
+        return self._connection.execute(
+            "SELECT * FROM phases WHERE run_id IN (SELECT id FROM runs WHERE server = ? AND start_time < ? "
+            "AND success = 1 ORDER BY start_time DESC LIMIT ?)", (server, before_time, limit)).fetchall()
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self._connection.close()
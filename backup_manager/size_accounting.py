@@ -0,0 +1,85 @@
+# backup_manager/size_accounting.py
+import json
+import os
+from datetime import datetime, timedelta
+
+
+class RestoreSizeAccounting:
+    """
+    Class to keep the restore size of the repository up to date from per-snapshot figures,
+    so `restic stats --mode restore-size` only has to walk every snapshot now and then.
+    """
+    def __init__(self, cache_file, full_stats_interval_days):
+        """
+        Initialize the RestoreSizeAccounting class.
+        :param cache_file: Path to the JSON cache file.
+        :param full_stats_interval_days: Number of days after which a full stats run is due.
+        """
+        self.cache_file = cache_file
+        self.full_stats_interval = timedelta(days=full_stats_interval_days)
+        self.snapshots = {}
+        self.full_stats = None
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as cache:
+                    data = json.load(cache)
+                self.snapshots = data.get("snapshots", {})
+                self.full_stats = data.get("full_stats")
+            except (OSError, ValueError):
+                pass
+
+    def record_snapshot(self, snapshot_id, restore_size):
+        """
+        Record the restore size of a snapshot.
+        :param snapshot_id: Full snapshot id.
+        :param restore_size: Total size of the files in the snapshot, in bytes.
+        """
+        self.snapshots[snapshot_id] = restore_size
+
+    def incremental_total(self, snapshots):
+        """
+        Sum the restore sizes of the snapshots currently in the repository.
+        Sizes missing from the cache are taken from the summary restic 0.17 and later stores in each snapshot.
+        Cache entries of forgotten snapshots are dropped.
+        :param snapshots: List of snapshot dictionaries from `restic snapshots --json`.
+        :return: Total restore size in bytes, or None if the size of any snapshot is unknown.
+        """
+        current = {}
+        unknown = False
+        for snapshot in snapshots:
+            size = self.snapshots.get(snapshot["id"])
+            if size is None and snapshot.get("summary"):
+                size = snapshot["summary"].get("total_bytes_processed")
+            if size is None:
+                unknown = True
+            else:
+                current[snapshot["id"]] = size
+        self.snapshots = current
+        return None if unknown else sum(current.values())
+
+    def full_stats_due(self, now=None):
+        """
+        Check whether a full stats run is due.
+        :param now: Current time.
+        :return: Boolean indicating if the last full stats run is older than the interval.
+        """
+        if self.full_stats is None:
+            return True
+        return (now or datetime.now()) - datetime.fromisoformat(self.full_stats["time"]) >= self.full_stats_interval
+
+    def record_full_stats(self, restore_size, stats_time):
+        """
+        Record the result of a full stats run.
+        :param restore_size: Restore size of all snapshots, in bytes.
+        :param stats_time: Time of the stats run.
+        """
+        self.full_stats = {"restore_size": restore_size, "time": stats_time.isoformat(timespec="seconds")}
+
+    def save(self):
+        """
+        Write the cache file atomically.
+        """
+        temp_file = f"{self.cache_file}.tmp"
+        with open(temp_file, "w") as cache:
+            json.dump({"snapshots": self.snapshots, "full_stats": self.full_stats}, cache)
+        os.replace(temp_file, self.cache_file)
@@ -1,12 +1,26 @@
 # backup_manager/software_list_generator.py
-import subprocess
+import hashlib
+import json
+import os
+import time
 from i18n import _
 from utils import handle_error
 
 class SoftwareListGenerator:
     """
     Class to generate a list of installed software.
+    The list is only regenerated when the package database changed since the last run.
     """
+    OS_RELEASE_FILE = "/etc/os-release"
+    # Command listing the packages and the package database files it reads, per package manager
+    PACKAGE_MANAGERS = {
+        "dpkg": ("/usr/bin/dpkg --get-selections", ["/var/lib/dpkg/status"]),
+        "rpm": ("rpm -qa", ["/var/lib/rpm/rpmdb.sqlite", "/usr/lib/sysimage/rpm/rpmdb.sqlite",
+                            "/var/lib/rpm/Packages"]),
+    }
+    # Packages listed by name in the email; the log lists all of them
+    MAX_LISTED_PACKAGES = 50
+
     def __init__(self, config, logger, command_runner, backup_manager):
         """
         Initialize the SoftwareListGenerator class.
@@ -19,52 +33,164 @@ class SoftwareListGenerator:
         self.logger = logger
         self.command_runner = command_runner
         self.backup_manager = backup_manager
+        self.state_file = getattr(config, "SOFTWARE_LIST_STATE_FILE", f"{config.SOFTWARE_LIST_FILE}.state")
 
     def generate(self):
         """
-        Generate the list of installed software.
+        Generate the list of installed software, unless the package database has not changed since the last run.
         """
         self.logger.log(_("Generating List of Installed Software"), section=True)
         self.backup_manager.email_body += "<h2>" + _("Generating List of Installed Software") + "</h2>\n"
         self.logger.log(_("Generating list of installed software..."))
 
-        command = self._get_command_for_distro()
-        if command:
-            self._run_command(command)
-        else:
+        start = time.monotonic()
+        distro = self._get_distro_family()
+        if distro is None:
             self._handle_unsupported_distro()
+            return
+        command, databases = self.PACKAGE_MANAGERS[distro]
+        database = next((path for path in databases if os.path.exists(path)), None)
+        state = self._load_state()
+        fingerprint = self._fingerprint(database, state) if database else None
+        if (fingerprint and state.get("database") == database
+                and fingerprint["sha256"] == (state.get("fingerprint") or {}).get("sha256")
+                and os.path.exists(self.config.SOFTWARE_LIST_FILE)):
+            self.logger.event("software_list", "software_list", duration=time.monotonic() - start,
+                              byte_count=os.path.getsize(self.config.SOFTWARE_LIST_FILE), return_code=0,
+                              changed=False)
+            self.backup_manager.email_body += _("List of installed software is unchanged.") + "\n"
+            self.logger.log(_("Package database {} has not changed; keeping {}.").format(
+                database, self.config.SOFTWARE_LIST_FILE))
+            return
+        if self._run_command(command) and fingerprint:
+            self._save_state({"database": database, "fingerprint": fingerprint})
 
-    def _get_command_for_distro(self):
+    def _get_distro_family(self):
         """
-        Get the command to list installed software based on the distribution.
-        :return: Command to list installed software.
+        Get the package manager family of the distribution from /etc/os-release.
+        :return: 'dpkg', 'rpm' or None if the distribution is not supported.
         """
-        distro = subprocess.run(['/usr/bin/lsb_release', '-is'], capture_output=True, text=True).stdout.strip()
-        if distro in ['Ubuntu', 'Debian']:
-            return "/usr/bin/dpkg --get-selections"
-        elif distro in ['CentOS', 'RedHatEnterpriseServer', 'Fedora']:
-            return "rpm -qa"
+        release = {}
+        try:
+            with open(self.OS_RELEASE_FILE, "r") as os_release:
+                for line in os_release:
+                    name, _separator, value = line.strip().partition("=")
+                    release[name] = value.strip('"\'')
+        except OSError:
+            return None
+        # Derivatives name their parent in ID_LIKE, e.g. ID=linuxmint ID_LIKE="ubuntu debian"
+        for distro in [release.get("ID", "")] + release.get("ID_LIKE", "").split():
+            if distro in ("debian", "ubuntu"):
+                return "dpkg"
+            if distro in ("rhel", "centos", "fedora", "rocky", "almalinux", "suse", "opensuse"):
+                return "rpm"
         return None
 
+    def _fingerprint(self, database, state):
+        """
+        Fingerprint the package database. The file is only hashed when its mtime or size changed, so a database
+        that was rewritten without changes (e.g. by `apt-get update`) does not trigger a new list.
+        :param database: Path to the package database file.
+        :param state: State of the last run.
+        :return: Dictionary with the mtime, size and SHA-256 of the database.
+        """
+        stat = os.stat(database)
+        previous = state.get("fingerprint") or {}
+        if previous.get("mtime_ns") == stat.st_mtime_ns and previous.get("size") == stat.st_size:
+            return previous
+        digest = hashlib.sha256()
+        with open(database, "rb") as database_file:
+            for chunk in iter(lambda: database_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        fingerprint = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest.hexdigest()}
+        if previous.get("sha256") == fingerprint["sha256"] and state.get("database") == database:
+            # Same content: remember the new mtime so the next run does not hash again
+            self._save_state({**state, "fingerprint": fingerprint})
+        return fingerprint
+
     def _run_command(self, command):
         """
-        Run the command to list installed software.
+        Run the command to list installed software and report the packages added and removed since the last list.
         :param command: Command to run.
+        :return: Boolean indicating if the list was written.
         """
-        return_code, stdout, stderr = self.command_runner.run(f"{command} > {self.config.SOFTWARE_LIST_FILE}", verbose=True)
+        start = time.monotonic()
+        list_file = self.config.SOFTWARE_LIST_FILE
+        temp_file = f"{list_file}.tmp"
+        return_code, stdout, stderr = self.command_runner.run(f"{command} > {temp_file}", verbose=True)
+        list_size = os.path.getsize(temp_file) if os.path.exists(temp_file) else None
+        self.logger.event("software_list", "software_list", duration=time.monotonic() - start, byte_count=list_size,
+                          return_code=return_code, changed=True)
         if return_code != 0:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
             self._handle_error("Error: Generating list of installed software failed!", stderr)
-        else:
-            self.backup_manager.email_body += _("List of installed software generated successfully.") + "\n"
-            self.logger.log(_("List of installed software generated successfully."))
+            return False
+        previous = self._read_packages(list_file)
+        os.replace(temp_file, list_file)
+        self.backup_manager.email_body += _("List of installed software generated successfully.") + "\n"
+        self.logger.log(_("List of installed software generated successfully."))
+        if previous is not None:
+            self._report_changes(previous, self._read_packages(list_file))
+        return True
+
+    @staticmethod
+    def _read_packages(list_file):
+        """
+        Read the packages of a software list.
+        :param list_file: Path to the list.
+        :return: Set of package entries (the first field of each line), or None if there is no list.
+        """
+        if not os.path.exists(list_file):
+            return None
+        with open(list_file, "r", errors="replace") as packages:
+            return {line.split()[0] for line in packages if line.strip()}
+
+    def _report_changes(self, previous, current):
+        """
+        Report the packages added and removed since the last list.
+        :param previous: Set of packages in the last list.
+        :param current: Set of packages in the new list.
+        """
+        for message, packages in ((_("Packages added since the last run: {}"), current - previous),
+                                  (_("Packages removed since the last run: {}"), previous - current)):
+            if not packages:
+                continue
+            names = sorted(packages)
+            self.logger.log(message.format(", ".join(names)))
+            shown = ", ".join(names[:self.MAX_LISTED_PACKAGES])
+            if len(names) > self.MAX_LISTED_PACKAGES:
+                shown += " " + _("and {} more").format(len(names) - self.MAX_LISTED_PACKAGES)
+            self.backup_manager.email_body += f"<p>{message.format(shown)}</p>\n"
+
+    def _load_state(self):
+        """
+        Load the package database fingerprint of the last run.
+        :return: State dictionary, empty if there is none.
+        """
+        try:
+            with open(self.state_file, "r") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        """
+        Save the package database fingerprint.
+        :param state: State dictionary.
+        """
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_file, self.state_file)
 
     def _handle_unsupported_distro(self):
         """
         Handle the case where the distribution is not supported.
         """
-        error_message = _("Error: Unsupported distribution for generating software list! See log for details at line {}.").format(len(open(self.config.LOG_FILE).readlines()) + 1)
+        error_message = _("Error: Unsupported distribution for generating software list! See log for details at line {}.").format(self.logger.anchor()[0])
         self.backup_manager.email_body += f"<strong style='color: red;'>{error_message}</strong>\n"
-        self.logger.log(_("Error: Unsupported distribution for generating software list!"))
+        self.logger.log(_("Error: Unsupported distribution for generating software list!"), error=True)
         self.backup_manager.error_lines.append(error_message)
         self.backup_manager.backup_success = False
 
@@ -0,0 +1,141 @@
+# backup_manager/trend_analysis.py
+from dataclasses import dataclass
+from statistics import median
+
+SPARK_CHARACTERS = "▁▂▃▄▅▆▇█"
+# English names of the metrics; they are also the msgids of their translations
+METRIC_LABELS = {"run": "run duration", "dump_bytes": "database dump size", "bytes_added": "Restic data added"}
+PHASE_DURATION_LABEL = "duration of {}"
+
+
+def metric_label(metric, translate=lambda message: message):
+    """
+    Get the name of a metric, e.g. 'duration of restic_backup' for 'phase:restic_backup'.
+    :param metric: Metric name.
+    :param translate: Translation function; by default the English name is returned.
+    :return: Name of the metric.
+    """
+    if metric.startswith("phase:"):
+        return translate(PHASE_DURATION_LABEL).format(metric[len("phase:"):])
+    return translate(METRIC_LABELS[metric])
+
+
+@dataclass
+class Anomaly:
+    """
+    A value of a run that is far off the values of the runs before it.
+    """
+    metric: str
+    value: float
+    median: float
+    mad: float
+    score: float
+    runs: int
+
+    @property
+    def kind(self):
+        """
+        What the metric measures: 'duration' or 'bytes'.
+        """
+        return "bytes" if self.metric in ("dump_bytes", "bytes_added") else "duration"
+
+
+class TrendAnalyzer:
+    """
+    Class to compare a run against the successful runs of the same server before it, using the median and the
+    median absolute deviation (MAD) of each value over a window of runs.
+    A value is flagged when its robust z-score exceeds the threshold and it differs from the median by at least
+    the minimum relative change, so a run taking 3x as long or dumping half the usual bytes stands out while
+    the day-to-day noise of short phases does not.
+    """
+    # Values below these on both sides are too small to be worth a warning
+    MIN_DURATION_SECONDS = 30
+    MIN_BYTES = 1024 * 1024
+    # Scales the MAD to the standard deviation of normally distributed values
+    MAD_SCALE = 1.4826
+
+    def __init__(self, run_history, window=30, threshold=3.5, min_change=0.5, min_runs=5):
+        """
+        Initialize the TrendAnalyzer class.
+        :param run_history: RunHistory object.
+        :param window: Number of earlier runs to compare against.
+        :param threshold: Robust z-score above which a value is flagged.
+        :param min_change: Minimum relative difference from the median for a value to be flagged.
+        :param min_runs: Number of earlier runs needed before anything is flagged.
+        """
+        self.run_history = run_history
+        self.window = window
+        self.threshold = threshold
+        self.min_change = min_change
+        self.min_runs = min_runs
+
+    @staticmethod
+    def run_values(run_duration, bytes_added, phases):
+        """
+        Collect the values of a run that are tracked.
+        :param run_duration: Duration of the run in seconds.
+        :param bytes_added: Bytes Restic added, or None.
+        :param phases: Iterable of phase rows or dictionaries with phase, duration, success and bytes.
+        :return: Dictionary mapping metric names to values.
+        """
+        values = {"run": run_duration}
+        if bytes_added is not None:
+            values["bytes_added"] = bytes_added
+        for phase in phases:
+            if not phase["success"]:
+                continue
+            values[f"phase:{phase['phase']}"] = phase["duration"]
+            if phase["phase"] == "database_backup" and phase["bytes"] is not None:
+                values["dump_bytes"] = phase["bytes"]
+        return values
+
+    def baseline(self, server, before_time):
+        """
+        Get the values of the successful runs of a server before a point in time.
+        :param server: Server name.
+        :param before_time: Unix time; only runs started before it are used.
+        :return: List of value dictionaries, oldest first.
+        """
+        runs = self.run_history.runs_before(server, before_time, self.window)
+        phases = {}
+        for phase in self.run_history.phases_before(server, before_time, self.window):
+            phases.setdefault(phase["run_id"], []).append(phase)
+        return [self.run_values(run["duration"], run["bytes_added"], phases.get(run["id"], [])) for run in runs]
+
+    def check(self, values, baseline):
+        """
+        Compare the values of a run against a baseline.
+        :param values: Dictionary of the run's values, as returned by run_values().
+        :param baseline: List of value dictionaries of earlier runs, as returned by baseline().
+        :return: List of Anomaly objects, largest score first.
+        """
+        anomalies = []
+        for metric, value in values.items():
+            history = [run[metric] for run in baseline if metric in run]
+            if len(history) < self.min_runs:
+                continue
+            center = median(history)
+            mad = median(abs(past - center) for past in history)
+            floor = self.MIN_BYTES if metric in ("dump_bytes", "bytes_added") else self.MIN_DURATION_SECONDS
+            if max(value, center) < floor or abs(value - center) < self.min_change * max(center, floor):
+                continue
+            # Identical past values give a MAD of 0; any real change is then an anomaly
+            spread = max(self.MAD_SCALE * mad, 0.01 * max(center, floor))
+            score = (value - center) / spread
+            if abs(score) > self.threshold:
+                anomalies.append(Anomaly(metric, value, center, mad, score, len(history)))
+        return sorted(anomalies, key=lambda anomaly: -abs(anomaly.score))
+
+    @staticmethod
+    def sparkline(values):
+        """
+        Draw values as a line of block characters.
+        :param values: List of numbers.
+        :return: Sparkline string.
+        """
+        if not values:
+            return ""
+        low, high = min(values), max(values)
+        steps = len(SPARK_CHARACTERS) - 1
+        return "".join(SPARK_CHARACTERS[round((value - low) / (high - low) * steps) if high > low else 0]
+                       for value in values)
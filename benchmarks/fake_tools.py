@@ -0,0 +1,341 @@
+# benchmarks/fake_tools.py
+"""
+Stand-ins for restic, mysql and mysqldump used by the benchmark harness.
+The tool to emulate is the first argument; everything after it is passed as the tool would receive it.
+Behaviour is controlled through FAKE_* environment variables set by run_benchmark.py.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+INSERT_BLOCK_SIZE = 1024 * 1024
+
+
+def env_int(name, default=0):
+    """
+    Read an integer setting from the environment.
+    :param name: Variable name.
+    :param default: Value if the variable is not set.
+    :return: Integer value.
+    """
+    return int(float(os.environ.get(name, default)))
+
+
+def env_float(name, default=0.0):
+    """
+    Read a float setting from the environment.
+    :param name: Variable name.
+    :param default: Value if the variable is not set.
+    :return: Float value.
+    """
+    return float(os.environ.get(name, default))
+
+
+def print_json(message):
+    """
+    Print a JSON message the way restic does, without spaces; ResticJsonParser matches on that form.
+    :param message: Object to print.
+    """
+    print(json.dumps(message, separators=(",", ":")))
+
+
+def database_names():
+    """
+    Get the names of the fake databases.
+    :return: List of database names.
+    """
+    return [f"db_{number:05d}" for number in range(env_int("FAKE_DB_COUNT", 10))]
+
+
+def format_size(size):
+    """
+    Format a byte count the way restic prints it.
+    :param size: Size in bytes.
+    :return: Formatted size.
+    """
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024 or unit == "TiB":
+            return f"{size:.3f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+
+def option_value(argv, *names):
+    """
+    Get the value following an option.
+    :param argv: Argument list.
+    :param names: Option names.
+    :return: Option value, or None if the option is absent.
+    """
+    for index, argument in enumerate(argv[:-1]):
+        if argument in names:
+            return argv[index + 1]
+    return None
+
+
+def fake_mysql(argv):
+    """
+    Answer the queries DatabaseBackup runs against the server.
+    """
+    time.sleep(env_float("FAKE_MYSQL_DELAY"))
+    query = option_value(argv, "-e") or ""
+    databases = database_names()
+    tables_per_db = env_int("FAKE_TABLES_PER_DB", 5)
+    dump_bytes = env_int("FAKE_DUMP_BYTES", INSERT_BLOCK_SIZE)
+    if query.startswith("SHOW DATABASES"):
+        print("Database")
+        for name in ["information_schema", "performance_schema"] + databases:
+            print(name)
+    elif query.startswith("SELECT table_schema, SUM("):
+        for name in databases:
+            print(f"{name}\t{dump_bytes}")
+    elif query.startswith("SELECT table_schema, table_name"):
+        # Databases listed in FAKE_CHANGED_DBS report a fresh update time on every run
+        changed = set(os.environ.get("FAKE_CHANGED_DBS", "").split(","))
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for name in databases:
+            update_time = now if name in changed else "2024-01-01 00:00:00"
+            for table in range(tables_per_db):
+                size = dump_bytes // tables_per_db
+                print(f"{name}\ttable_{table}\tInnoDB\t2023-01-01 00:00:00\t{update_time}\t{size // 100}\t{size}\t0")
+    elif query.startswith("CHECKSUM TABLE"):
+        for table in query[len("CHECKSUM TABLE "):].rstrip(";").split(", "):
+            print(f"{table.replace('`', '')}\t{int(hashlib.md5(table.encode()).hexdigest()[:8], 16)}")
+    else:
+        print(f"ERROR 1064 (42000): unsupported query in fake mysql: {query}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def fake_mysqldump(argv):
+    """
+    Write a dump of FAKE_DUMP_BYTES bytes of INSERT statements for the requested database.
+    """
+    database = argv[-1]
+    if database not in database_names() or database in os.environ.get("FAKE_FAIL_DBS", "").split(","):
+        print(f"mysqldump: Got error: 1049: Unknown database '{database}' when selecting the database",
+              file=sys.stderr)
+        return 2
+    time.sleep(env_float("FAKE_DUMP_DELAY"))
+    output = sys.stdout.buffer
+    output.write(f"-- MySQL dump 10.13  Distrib 8.0.36\n-- Host: localhost    Database: {database}\n"
+                 f"CREATE TABLE `table_0` (`id` int NOT NULL, `payload` text, PRIMARY KEY (`id`));\n".encode())
+    row = b"(1234567,'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor')"
+    block = b"INSERT INTO `table_0` VALUES " + b",".join([row] * (INSERT_BLOCK_SIZE // (len(row) + 1))) + b";\n"
+    remaining = env_int("FAKE_DUMP_BYTES", INSERT_BLOCK_SIZE)
+    while remaining > 0:
+        chunk = block[:remaining]
+        output.write(chunk)
+        remaining -= len(chunk)
+    output.write(b"-- Dump completed\n")
+    return 0
+
+
+class FakeRepository:
+    """
+    Snapshot list and pack files of a fake restic repository.
+    Pack files are sparse, so they have the apparent size of the data added without using the disk space.
+    """
+    def __init__(self, path):
+        """
+        Initialize the FakeRepository class.
+        :param path: Repository directory.
+        """
+        self.path = path
+        self.snapshot_file = os.path.join(path, "snapshots.json")
+
+    def snapshots(self):
+        """
+        Load the snapshot list.
+        :return: List of snapshot dictionaries.
+        """
+        if not os.path.exists(self.snapshot_file):
+            return []
+        with open(self.snapshot_file, "r") as snapshot_file:
+            return json.load(snapshot_file)
+
+    def save_snapshots(self, snapshots):
+        """
+        Save the snapshot list.
+        :param snapshots: List of snapshot dictionaries.
+        """
+        temp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as snapshot_file:
+            json.dump(snapshots, snapshot_file)
+        os.replace(temp_file, self.snapshot_file)
+
+    def add_snapshot(self, paths, tags, summary):
+        """
+        Record a snapshot and write a pack file for the data it added.
+        :param paths: Backed-up paths.
+        :param tags: Snapshot tags.
+        :param summary: Summary dictionary as restic reports it.
+        :return: Snapshot id.
+        """
+        snapshot_id = hashlib.sha256(f"{time.time_ns()}{paths}{os.getpid()}".encode()).hexdigest()
+        os.makedirs(os.path.join(self.path, "data"), exist_ok=True)
+        with open(os.path.join(self.path, "data", snapshot_id), "wb") as pack_file:
+            pack_file.truncate(summary["data_added_packed"])
+        # Concurrent snapshots update the list one at a time
+        with open(os.path.join(self.path, "snapshots.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            snapshots = self.snapshots()
+            snapshots.append({"id": snapshot_id, "short_id": snapshot_id[:8],
+                              "time": datetime.now(timezone.utc).isoformat(), "paths": paths, "tags": tags,
+                              "hostname": "benchmark", "summary": summary})
+            self.save_snapshots(snapshots)
+        return snapshot_id
+
+
+def scan_paths(paths):
+    """
+    Count the files and bytes below the backed-up paths, as restic has to.
+    :param paths: Paths to scan.
+    :return: Tuple containing file count and total bytes.
+    """
+    file_count = total_bytes = 0
+    pending = [path for path in paths if os.path.exists(path)]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    else:
+                        file_count += 1
+                        total_bytes += entry.stat(follow_symlinks=False).st_size
+        except NotADirectoryError:
+            file_count += 1
+        except OSError:
+            continue
+    return file_count, total_bytes
+
+
+def fake_restic_backup(repository, argv, json_output):
+    """
+    Back up paths or stdin into the fake repository.
+    """
+    tags = [argv[index + 1] for index, argument in enumerate(argv[:-1]) if argument == "--tag"]
+    start = time.monotonic()
+    if "--stdin" in argv:
+        paths = ["/" + (option_value(argv, "--stdin-filename") or "stdin")]
+        total_bytes = 0
+        for chunk in iter(lambda: sys.stdin.buffer.read(INSERT_BLOCK_SIZE), b""):
+            total_bytes += len(chunk)
+        file_count = 1
+    else:
+        skip = {"--tag", "--exclude", "--files-from"}
+        paths = [argument for index, argument in enumerate(argv)
+                 if not argument.startswith("-") and (index == 0 or argv[index - 1] not in skip)]
+        file_count, total_bytes = scan_paths(paths)
+        if not file_count and not any(os.path.exists(path) for path in paths):
+            message = f"Fatal: unable to save snapshot: {' '.join(paths)} does not exist"
+            if json_output:
+                print_json({"message_type": "exit_error", "code": 1, "message": message})
+            print(message, file=sys.stderr)
+            return 1
+    time.sleep(env_float("FAKE_RESTIC_BACKUP_DELAY"))
+    changed_ratio = env_float("FAKE_RESTIC_CHANGED_RATIO", 0.05)
+    data_added = int(total_bytes * changed_ratio)
+    summary = {"files_new": int(file_count * changed_ratio / 2), "files_changed": int(file_count * changed_ratio / 2),
+               "files_unmodified": file_count - 2 * int(file_count * changed_ratio / 2), "dirs_new": 0,
+               "dirs_changed": 1, "dirs_unmodified": 0, "data_blobs": 0, "tree_blobs": 1, "data_added": data_added,
+               "data_added_packed": int(data_added * 0.6), "total_files_processed": file_count,
+               "total_bytes_processed": total_bytes, "total_duration": round(time.monotonic() - start, 3)}
+    snapshot_id = repository.add_snapshot(paths, tags, summary)
+    if json_output:
+        print_json({"message_type": "status", "percent_done": 0, "total_files": file_count,
+                    "total_bytes": total_bytes})
+        print_json({"message_type": "status", "percent_done": 1, "total_files": file_count,
+                    "files_done": file_count, "total_bytes": total_bytes, "bytes_done": total_bytes})
+        print_json({"message_type": "summary", **summary, "snapshot_id": snapshot_id})
+    else:
+        print(f"Files:        {summary['files_new']} new, {summary['files_changed']} changed, "
+              f"{summary['files_unmodified']} unmodified")
+        print(f"Added to the repository: {format_size(data_added)} ({format_size(summary['data_added_packed'])} stored)")
+        print(f"processed {file_count} files, {format_size(total_bytes)} in 0:01")
+        print(f"snapshot {snapshot_id[:8]} saved")
+    return 0
+
+
+def fake_restic(argv):
+    """
+    Run a restic subcommand against the fake repository.
+    """
+    repository_path = option_value(argv, "-r", "--repo")
+    repository = FakeRepository(repository_path)
+    json_output = "--json" in argv
+    value_options = {"-r", "--repo", "--password-file"}
+    arguments = [argument for index, argument in enumerate(argv)
+                 if argument not in value_options and (index == 0 or argv[index - 1] not in value_options)
+                 and argument not in ("--no-lock", "--json")]
+    if not arguments:
+        print("Usage: restic [command]", file=sys.stderr)
+        return 1
+    command, arguments = arguments[0], arguments[1:]
+    time.sleep(env_float("FAKE_RESTIC_DELAY"))
+
+    if command == "init":
+        os.makedirs(repository_path, exist_ok=True)
+        print(f"created restic repository 0123456789 at {repository_path}")
+    elif command == "list":
+        # No locks are ever held in the fake repository
+        pass
+    elif command == "backup":
+        return fake_restic_backup(repository, arguments, json_output)
+    elif command == "snapshots":
+        snapshots = repository.snapshots()
+        if json_output:
+            print_json(snapshots)
+        else:
+            for snapshot in snapshots:
+                print(f"{snapshot['short_id']}  {snapshot['time'][:19]}  benchmark  {' '.join(snapshot['paths'])}")
+            print(f"{len(snapshots)} snapshots")
+    elif command == "stats":
+        snapshots = repository.snapshots()
+        total_size = sum(snapshot["summary"]["total_bytes_processed"] for snapshot in snapshots)
+        total_files = sum(snapshot["summary"]["total_files_processed"] for snapshot in snapshots)
+        time.sleep(env_float("FAKE_RESTIC_STATS_DELAY_PER_SNAPSHOT") * len(snapshots))
+        if json_output:
+            print_json({"total_size": total_size, "total_file_count": total_files,
+                        "snapshots_count": len(snapshots)})
+        else:
+            print("Stats in restore-size mode:")
+            print(f"     Snapshots processed:  {len(snapshots)}")
+            print(f"        Total File Count:  {total_files}")
+            print(f"              Total Size:  {format_size(total_size)}")
+    elif command == "forget":
+        snapshots = repository.snapshots()
+        forget_ids = [argument for argument in arguments if not argument.startswith("-") and not argument.isdigit()]
+        if forget_ids:
+            kept = [snapshot for snapshot in snapshots
+                    if not any(snapshot["id"].startswith(snapshot_id) for snapshot_id in forget_ids)]
+            repository.save_snapshots(kept)
+            print(f"removed {len(snapshots) - len(kept)} snapshots")
+        else:
+            print("Applying Policy: keep 7 daily, 4 weekly, 12 monthly, 1 yearly snapshots")
+            print(f"keep {len(snapshots)} snapshots:")
+    elif command == "prune":
+        stored = sum(snapshot["summary"]["data_added_packed"] for snapshot in repository.snapshots())
+        unused = int(stored * env_float("FAKE_RESTIC_UNUSED_RATIO", 0.1))
+        if "--dry-run" not in arguments:
+            time.sleep(env_float("FAKE_RESTIC_PRUNE_DELAY"))
+        print("loading indexes...")
+        print(f"to repack:            120 blobs / {format_size(unused // 10)}")
+        print(f"total prune:          480 blobs / {format_size(unused)}")
+        print(f"remaining:           4000 blobs / {format_size(stored - unused)}")
+        print("done" if "--dry-run" not in arguments else "would have removed the above")
+    else:
+        print(f"Fatal: unknown command {command!r}", file=sys.stderr)
+        return 1
+    return 0
+
+
+TOOLS = {"restic": fake_restic, "mysql": fake_mysql, "mysqldump": fake_mysqldump}
+
+
+if __name__ == "__main__":
+    sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
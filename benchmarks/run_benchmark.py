@@ -0,0 +1,302 @@
+# benchmarks/run_benchmark.py
+"""
+Run BackupManager.backup against fake restic, mysql and mysqldump binaries and report, per phase,
+the wall time, CPU time, peak RSS and I/O of the script and of the commands it ran.
+
+Examples:
+    python benchmarks/run_benchmark.py --scale small
+    python benchmarks/run_benchmark.py --scale databases --set MYSQL_DUMP_WORKERS=8
+    python benchmarks/run_benchmark.py --scale dumps --set MYSQL_DUMP_TARGET='"restic"'
+    python benchmarks/run_benchmark.py --scale tree --workdir /var/tmp/backup-bench
+"""
+import argparse
+import ast
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import types
+from contextlib import contextmanager, redirect_stdout
+
+from smtp_sink import SmtpSink
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_ROOT = os.path.dirname(BENCHMARK_DIR)
+
+# Databases, dump size per database and files in the backed-up tree for each scale
+SCALES = {
+    "small": (20, 1024 * 1024, 10_000),
+    "databases": (1000, 64 * 1024, 10_000),
+    "dumps": (1, 10 * 1024 ** 3, 10_000),
+    "tree": (5, 1024 * 1024, 1_000_000),
+}
+FILES_PER_DIRECTORY = 1000
+
+
+def write_fake_binaries(bin_dir):
+    """
+    Create restic, mysql and mysqldump wrappers around fake_tools.py.
+    :param bin_dir: Directory for the wrappers.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in ("restic", "mysql", "mysqldump"):
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as wrapper:
+            wrapper.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCHMARK_DIR, "fake_tools.py")}" '
+                          f'{tool} "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def build_tree(root, file_count):
+    """
+    Create a tree of sparse files to back up, or reuse it if an earlier run built the same tree.
+    :param root: Root of the tree.
+    :param file_count: Number of files.
+    """
+    marker = os.path.join(root, ".benchmark-files")
+    if os.path.exists(marker):
+        with open(marker, "r") as marker_file:
+            if int(marker_file.read()) == file_count:
+                return
+        shutil.rmtree(root)
+    for number in range(file_count):
+        directory = os.path.join(root, f"dir_{number // FILES_PER_DIRECTORY // 100:03d}",
+                                 f"dir_{number // FILES_PER_DIRECTORY:05d}")
+        if number % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file_{number:07d}"), "wb") as tree_file:
+            tree_file.truncate(number % 8192)
+    with open(marker, "w") as marker_file:
+        marker_file.write(str(file_count))
+
+
+def build_config(workdir, bin_dir, tree_root, overrides):
+    """
+    Build a configuration pointing every path into the work directory.
+    :param workdir: Work directory.
+    :param bin_dir: Directory holding the fake binaries.
+    :param tree_root: Tree to back up.
+    :param overrides: Dictionary of settings overriding the defaults.
+    :return: Configuration module.
+    """
+    base_dir = os.path.join(workdir, "backup")
+    config = types.ModuleType("config")
+    settings = {
+        "SERVER_NAME": "benchmark.example.com",
+        "BASE_BACKUP_DIR": base_dir,
+        "MYSQL_BACKUP_DIR": os.path.join(base_dir, "mysql"),
+        "MYSQL_USER": "benchmark",
+        "MYSQL_PASSWORD": "benchmark",
+        "MYSQL_BINARY": os.path.join(bin_dir, "mysql"),
+        "MYSQLDUMP_BINARY": os.path.join(bin_dir, "mysqldump"),
+        "MYSQL_DUMP_COMPRESSION": "none",
+        "RESTIC_REPOSITORY": os.path.join(base_dir, "restic"),
+        "RESTIC_PASSWORD_FILE": os.path.join(workdir, "restic-pw"),
+        "DEFAULT_PATHS": [tree_root],
+        "SERVICE_CONFIGS": {},
+        "EMAIL_TO": "benchmark@example.com",
+        "EMAIL_FROM": "benchmark@example.com",
+        "EMAIL_BODY_PATH": os.path.join(workdir, "email-body.html"),
+        "LOG_DIR": os.path.join(workdir, "logs"),
+        "LOG_FILE": os.path.join(workdir, "logs", f"{time.strftime('%Y-%m-%d_%H-%M-%S')}-backup-log.txt"),
+        "SOFTWARE_LIST_FILE": os.path.join(base_dir, "software-installed.txt"),
+        "STATUS_FILE_DIR": os.path.join(workdir, "status"),
+        "RETENTION_DAYS": 30,
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": 25,
+        "SMTP_USERNAME": "",
+        "SMTP_PASSWORD": "",
+        "SMTP_STARTTLS": False,
+        "MAIL_SPOOL_DIR": os.path.join(workdir, "mail-spool"),
+        "LANGUAGE": "en",
+        "SIMULATE_FAILURES": False,
+    }
+    settings.update(overrides)
+    for name, value in settings.items():
+        setattr(config, name, value)
+    for directory in (config.MYSQL_BACKUP_DIR, config.RESTIC_REPOSITORY, config.LOG_DIR, config.STATUS_FILE_DIR):
+        os.makedirs(directory, exist_ok=True)
+    with open(config.RESTIC_PASSWORD_FILE, "w") as password_file:
+        password_file.write("benchmark")
+    return config
+
+
+def sample_resources():
+    """
+    Take a snapshot of the resource usage of this process and of the commands it has waited for.
+    The I/O counters of /proc/self/io include the commands that have exited, so they cover the whole run;
+    'chars' count every byte passed through read and write calls, 'disk' only what reached the block layer.
+    :return: Dictionary of counters.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sample = {"time": time.monotonic(), "cpu": own.ru_utime + own.ru_stime,
+              "children_cpu": children.ru_utime + children.ru_stime,
+              "peak_rss_kib": own.ru_maxrss, "children_peak_rss_kib": children.ru_maxrss}
+    counters = {}
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+    except OSError:
+        pass
+    for name, counter in (("read_chars", "rchar"), ("write_chars", "wchar"), ("disk_read_bytes", "read_bytes"),
+                          ("disk_write_bytes", "write_bytes")):
+        sample[name] = int(counters.get(counter, 0))
+    return sample
+
+
+def measure_spans(metrics, report):
+    """
+    Wrap BackupMetrics.span so every phase also records its resource usage.
+    Phases that overlap share the counters of this process, so their I/O and CPU figures add up to more
+    than the run used.
+    :param metrics: BackupMetrics instance of the BackupManager.
+    :param report: Dictionary receiving one entry per phase.
+    """
+    original_span = metrics.span
+
+    @contextmanager
+    def span(phase):
+        # Reserve the phase's place so phases are listed in the order they started
+        report[phase] = None
+        before = sample_resources()
+        try:
+            with original_span(phase):
+                yield
+        finally:
+            # A phase that raised is measured too; the scheduler reports it as failed
+            after = sample_resources()
+            report[phase] = {
+                "wall_seconds": after["time"] - before["time"],
+                "cpu_seconds": after["cpu"] - before["cpu"],
+                "children_cpu_seconds": after["children_cpu"] - before["children_cpu"],
+                "read_chars": after["read_chars"] - before["read_chars"],
+                "write_chars": after["write_chars"] - before["write_chars"],
+                "disk_read_bytes": after["disk_read_bytes"] - before["disk_read_bytes"],
+                "disk_write_bytes": after["disk_write_bytes"] - before["disk_write_bytes"],
+                "peak_rss_kib": after["peak_rss_kib"],
+                "children_peak_rss_kib": after["children_peak_rss_kib"],
+            }
+
+    metrics.span = span
+
+
+def run(args):
+    """
+    Set up the work directory, run one backup and return the report.
+    :param args: Parsed command-line arguments.
+    :return: Dictionary with the run's settings, totals and phases.
+    """
+    db_count, dump_bytes, file_count = SCALES[args.scale]
+    db_count = args.databases if args.databases is not None else db_count
+    dump_bytes = args.dump_bytes if args.dump_bytes is not None else dump_bytes
+    file_count = args.files if args.files is not None else file_count
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="backup-benchmark-"))
+    bin_dir = os.path.join(workdir, "bin")
+    tree_root = os.path.join(workdir, "tree")
+    write_fake_binaries(bin_dir)
+    build_tree(tree_root, file_count)
+
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ.update({"FAKE_DB_COUNT": str(db_count), "FAKE_DUMP_BYTES": str(dump_bytes),
+                       "FAKE_DUMP_DELAY": str(args.delay), "FAKE_RESTIC_DELAY": str(args.delay),
+                       "FAKE_MYSQL_DELAY": str(args.delay)})
+    overrides = {name: ast.literal_eval(value) for name, value in (setting.split("=", 1) for setting in args.set)}
+    # Mail goes through the spool to a local SMTP stand-in
+    smtp_sink = SmtpSink(delay=args.smtp_delay).start()
+    overrides = {"SMTP_PORT": smtp_sink.port, **overrides}
+    config = build_config(workdir, bin_dir, tree_root, overrides)
+
+    # The modules translate their messages at import time, so the logger and translation come first
+    os.chdir(REPOSITORY_ROOT)
+    sys.path.insert(0, REPOSITORY_ROOT)
+    from logger import Logger
+    from i18n import setup_translation
+    logger = Logger.get_instance(config.LOG_FILE, False, False, getattr(config, "LOG_QUEUED", False),
+                                 getattr(config, "LOG_FLUSH_INTERVAL", 1.0), getattr(config, "LOG_JSON", False))
+    setup_translation(config.LANGUAGE)
+    from backup_manager.backup_manager import BackupManager
+    from command_runner import CommandRunner
+
+    backup_manager = BackupManager(config, logger, CommandRunner(logger))
+    phases = {}
+    measure_spans(backup_manager.metrics, phases)
+    before = sample_resources()
+    # Commands echo their output to stdout; keep it out of the report unless asked for
+    with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+        backup_manager.backup()
+    after = sample_resources()
+    logger.close()
+    smtp_sink.shutdown()
+
+    return {
+        "scale": args.scale, "databases": db_count, "dump_bytes": dump_bytes, "files": file_count,
+        "workdir": workdir, "success": backup_manager.backup_success, "email_bytes": sum(smtp_sink.messages),
+        "smtp_connections": smtp_sink.connections,
+        "wall_seconds": after["time"] - before["time"], "cpu_seconds": after["cpu"] - before["cpu"],
+        "children_cpu_seconds": after["children_cpu"] - before["children_cpu"],
+        "read_chars": after["read_chars"] - before["read_chars"],
+        "write_chars": after["write_chars"] - before["write_chars"],
+        "disk_read_bytes": after["disk_read_bytes"] - before["disk_read_bytes"],
+        "disk_write_bytes": after["disk_write_bytes"] - before["disk_write_bytes"],
+        "peak_rss_kib": after["peak_rss_kib"], "children_peak_rss_kib": after["children_peak_rss_kib"],
+        "phases": phases,
+    }
+
+
+def print_report(report):
+    """
+    Print the report as a table.
+    :param report: Dictionary returned by run().
+    """
+    print(f"Scale {report['scale']}: {report['databases']} databases, {report['dump_bytes']} bytes per dump, "
+          f"{report['files']} files, success: {report['success']}")
+    header = (f"{'Phase':<18} {'Wall s':>9} {'CPU s':>8} {'Cmd CPU s':>10} {'Chars R MB':>11} {'Chars W MB':>11} "
+              f"{'Disk R MB':>10} {'Disk W MB':>10} {'RSS MB':>8} {'Cmd RSS MB':>10}")
+    print(header)
+    print("-" * len(header))
+    for phase, values in report["phases"].items():
+        print(f"{phase:<18} {values['wall_seconds']:>9.2f} {values['cpu_seconds']:>8.2f} "
+              f"{values['children_cpu_seconds']:>10.2f} {values['read_chars'] / 1e6:>11.1f} "
+              f"{values['write_chars'] / 1e6:>11.1f} {values['disk_read_bytes'] / 1e6:>10.1f} "
+              f"{values['disk_write_bytes'] / 1e6:>10.1f} {values['peak_rss_kib'] / 1024:>8.1f} "
+              f"{values['children_peak_rss_kib'] / 1024:>10.1f}")
+    print("-" * len(header))
+    print(f"{'total':<18} {report['wall_seconds']:>9.2f} {report['cpu_seconds']:>8.2f} "
+          f"{report['children_cpu_seconds']:>10.2f} {report['read_chars'] / 1e6:>11.1f} "
+          f"{report['write_chars'] / 1e6:>11.1f} {report['disk_read_bytes'] / 1e6:>10.1f} "
+          f"{report['disk_write_bytes'] / 1e6:>10.1f} {report['peak_rss_kib'] / 1024:>8.1f} "
+          f"{report['children_peak_rss_kib'] / 1024:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BackupManager.backup against fake binaries")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="Preset size of the run")
+    parser.add_argument("--databases", type=int, help="Number of databases, overriding the preset")
+    parser.add_argument("--dump-bytes", type=int, help="Size of each database dump in bytes, overriding the preset")
+    parser.add_argument("--files", type=int, help="Number of files in the backed-up tree, overriding the preset")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds each fake command sleeps")
+    parser.add_argument("--smtp-delay", type=float, default=0.0,
+                        help="Seconds the SMTP stand-in waits before every reply")
+    parser.add_argument("--workdir", help="Work directory, kept between runs to reuse the tree (default: new temp dir)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="Override a config setting with a Python literal, e.g. MYSQL_DUMP_WORKERS=8")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the commands")
+    parser.add_argument("--json", metavar="FILE", help="Also write the report as JSON")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
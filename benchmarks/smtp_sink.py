@@ -0,0 +1,126 @@
+# benchmarks/smtp_sink.py
+"""
+Local stand-in for an SMTP relay, used by the benchmark harness to measure mail delivery through the spool.
+It speaks enough SMTP for smtplib (no STARTTLS or AUTH), keeps the size of every message it accepts and can
+be made slow or flaky to exercise the retry path.
+
+Example:
+    python benchmarks/smtp_sink.py --port 2525 --delay 0.5
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Class accepting SMTP connections on localhost and recording the messages delivered to it.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, delay=0.0, drop_after=None, reject=()):
+        """
+        Initialize the SmtpSink class.
+        :param port: Port to listen on; 0 picks a free one.
+        :param delay: Seconds to wait before every reply.
+        :param drop_after: Close each connection after accepting this many messages.
+        :param reject: Recipient addresses answered with a permanent error.
+        """
+        super().__init__(("127.0.0.1", port), _SmtpHandler)
+        self.delay = delay
+        self.drop_after = drop_after
+        self.reject = set(reject)
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serve connections from a background thread.
+        :return: The SmtpSink itself.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        time.sleep(self.server.delay)
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        accepted = 0
+        recipients = []
+        self.reply("220 sink ESMTP")
+        for raw in self.rfile:
+            command = raw.decode("utf-8", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 sink")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip().strip("<>")
+                if address in self.server.reject:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                if not recipients:
+                    self.reply("554 No valid recipients")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for line in self.rfile:
+                    if line == b".\r\n":
+                        break
+                    size += len(line)
+                with self.server.lock:
+                    self.server.messages.append(size)
+                accepted += 1
+                self.reply("250 OK queued")
+                if self.server.drop_after is not None and accepted >= self.server.drop_after:
+                    return
+            elif verb == "RSET" or verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accept SMTP mail on localhost and print the message sizes")
+    parser.add_argument("--port", type=int, default=2525, help="Port to listen on")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before every reply")
+    parser.add_argument("--drop-after", type=int, help="Close each connection after this many messages")
+    args = parser.parse_args()
+
+    sink = SmtpSink(args.port, args.delay, args.drop_after).start()
+    print(f"Listening on 127.0.0.1:{sink.port}")
+    seen = 0
+    try:
+        while True:
+            time.sleep(1)
+            with sink.lock:
+                new = sink.messages[seen:]
+            for size in new:
+                print(f"Accepted a message of {size} bytes")
+            seen += len(new)
+    except KeyboardInterrupt:
+        sink.shutdown()
+
+
+if __name__ == "__main__":
+    main()
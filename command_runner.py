@@ -1,7 +1,44 @@
 # command_runner.py
+import os
+import signal
 import subprocess
+import tempfile
+import threading
+from collections import deque
 from i18n import _
 
+# Every command runs in its own session; SIGTERM is passed on to the process groups running
+ACTIVE_PROCESS_GROUPS = set()
+# Set on SIGTERM; commands asked for afterwards are not started, so the running phases end promptly
+STOP_REQUESTED = threading.Event()
+
+
+def terminate_active_commands():
+    """
+    Stop starting commands and send SIGTERM to every running one, so a terminated backup does not wait for them.
+    Safe to call from a signal handler.
+    """
+    STOP_REQUESTED.set()
+    for process_group in list(ACTIVE_PROCESS_GROUPS):
+        try:
+            os.killpg(process_group, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def track_process_group(pid):
+    """
+    Record a command's process group, terminating it at once if SIGTERM arrived while it was starting.
+    :param pid: Process ID of a command started in its own session.
+    """
+    ACTIVE_PROCESS_GROUPS.add(pid)
+    if STOP_REQUESTED.is_set():
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
 class CommandRunner:
     """
     Class to run shell commands and log the output.
@@ -12,6 +49,18 @@ class CommandRunner:
         :param logger: Logger object for logging messages.
         """
         self.logger = logger
+        logger.add_sigterm_handler(terminate_active_commands)
+
+    def _stopped(self, command):
+        """
+        Check whether commands may no longer be started because the backup is being terminated.
+        :param command: Command that was asked for.
+        :return: Boolean indicating if the command must not be started.
+        """
+        if STOP_REQUESTED.is_set():
+            self.logger.log(_("Not started, the backup is being terminated: {}").format(command))
+            return True
+        return False
 
     def run(self, command, verbose=False, timeout=3600):
         """
@@ -21,13 +70,132 @@ class CommandRunner:
         :param timeout: Timeout for the command execution.
         :return: Tuple containing return code, stdout, and stderr.
         """
+        if self._stopped(command):
+            return 143, "", "Terminated"
         self.logger.log(_("Running command: {}").format(command))
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   start_new_session=True)
+        track_process_group(process.pid)
         try:
-            result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+            stdout, stderr = process.communicate(timeout=timeout)
         except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
             self.logger.log(_("Command timed out: {}").format(command))
             return 1, "", "TimeoutExpired"
+        finally:
+            ACTIVE_PROCESS_GROUPS.discard(process.pid)
         if verbose or self.logger.verbose:
-            print(result.stdout)
-            print(result.stderr)
-        return result.returncode, result.stdout, result.stderr
+            print(stdout)
+            print(stderr)
+        return process.returncode, stdout, stderr
+
+    def run_pipeline(self, commands, verbose=False, timeout=3600):
+        """
+        Run shell commands connected by pipes, keeping the return code of every stage.
+        :param commands: List of commands; each one's stdout feeds the next one's stdin.
+        :param verbose: Whether to print command output to stdout.
+        :param timeout: Timeout for the whole pipeline.
+        :return: Tuple containing the first non-zero return code (or 0), stdout of the last command and the combined stderr.
+        """
+        if self._stopped(" | ".join(commands)):
+            return 143, "", "Terminated"
+        self.logger.log(_("Running command: {}").format(" | ".join(commands)))
+        processes = []
+        stderr_files = []
+        try:
+            for command in commands:
+                # stderr goes to temporary files so no stage can block on a full pipe
+                stderr_file = tempfile.TemporaryFile(mode="w+")
+                stderr_files.append(stderr_file)
+                stdin = processes[-1].stdout if processes else subprocess.DEVNULL
+                processes.append(subprocess.Popen(command, shell=True, stdin=stdin, stdout=subprocess.PIPE,
+                                                  stderr=stderr_file, text=True, start_new_session=True))
+                track_process_group(processes[-1].pid)
+                if stdin is not subprocess.DEVNULL:
+                    # Let the upstream stage get SIGPIPE if this one exits early
+                    stdin.close()
+            try:
+                stdout, _unused = processes[-1].communicate(timeout=timeout)
+                return_codes = [process.wait(timeout=timeout) for process in processes]
+            except subprocess.TimeoutExpired:
+                for process in processes:
+                    process.kill()
+                for process in processes:
+                    process.wait()
+                self.logger.log(_("Command timed out: {}").format(" | ".join(commands)))
+                return 1, "", "TimeoutExpired"
+            stderr = ""
+            for stderr_file in stderr_files:
+                stderr_file.seek(0)
+                stderr += stderr_file.read()
+        finally:
+            for stderr_file in stderr_files:
+                stderr_file.close()
+            for process in processes:
+                ACTIVE_PROCESS_GROUPS.discard(process.pid)
+        if verbose or self.logger.verbose:
+            print(stdout)
+            print(stderr)
+        return next((code for code in return_codes if code != 0), 0), stdout, stderr
+
+    def run_streaming(self, command, line_handlers=None, verbose=False, timeout=3600, tail_lines=200, log_filter=None):
+        """
+        Run a shell command, processing its output line by line while it runs.
+        Every line is written to the log as it arrives and passed to the line handlers;
+        only the last lines of each stream are kept in memory.
+        :param command: Command to execute.
+        :param line_handlers: List of callables invoked as handler(line, stream) with stream 'stdout' or 'stderr'.
+        :param verbose: Whether to print command output to stdout.
+        :param timeout: Timeout for the command execution.
+        :param tail_lines: Number of trailing lines kept per stream.
+        :param log_filter: Callable invoked as log_filter(line, stream); lines for which it returns False
+                           still reach the handlers but are neither logged, printed nor kept in the tail.
+        :return: Tuple containing return code, tail of stdout, and tail of stderr.
+        """
+        if self._stopped(command):
+            return 143, "", "Terminated"
+        self.logger.log(_("Running command: {}").format(command))
+        line_handlers = line_handlers or []
+        echo = verbose or self.logger.verbose
+        tails = {"stdout": deque(maxlen=tail_lines), "stderr": deque(maxlen=tail_lines)}
+
+        def pump(pipe, stream):
+            for line in pipe:
+                line = line.rstrip("\n")
+                if log_filter is None or log_filter(line, stream):
+                    tails[stream].append(line)
+                    self.logger.log(line)
+                    if echo:
+                        print(line)
+                for handler in line_handlers:
+                    handler(line, stream)
+            pipe.close()
+
+        # A new session lets a timeout kill the whole pipeline, not just the shell holding our pipes
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   errors="replace", start_new_session=True)
+        track_process_group(process.pid)
+        readers = [threading.Thread(target=pump, args=(process.stdout, "stdout"), daemon=True),
+                   threading.Thread(target=pump, args=(process.stderr, "stderr"), daemon=True)]
+        for reader in readers:
+            reader.start()
+        try:
+            return_code = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # SIGTERM first: restic removes its repository lock when it is allowed to shut down
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+            self.logger.log(_("Command timed out: {}").format(command))
+            return_code = None
+        finally:
+            ACTIVE_PROCESS_GROUPS.discard(process.pid)
+        for reader in readers:
+            reader.join()
+        if return_code is None:
+            return 1, "\n".join(tails["stdout"]), "TimeoutExpired"
+        return return_code, "\n".join(tails["stdout"]), "\n".join(tails["stderr"])
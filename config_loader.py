@@ -1,18 +1,113 @@
 # config_loader.py
 import importlib.util
 import os
-from i18n import _
+import socket
+import threading
+import time
+from contextlib import contextmanager
+import i18n
+
+CONFIG_PATH_TEMPLATE = "/root/backup_config_{}.py"
+# Holds "<hostname>\t<server name>" from the last lookup
+SERVER_NAME_CACHE_FILE = "/root/.backup_server_name"
+SERVER_NAME_CACHE_SECONDS = 86400
+# The real lookup, also while _resolved_fqdn() answers socket.getfqdn() calls of a configuration file
+_getfqdn = socket.getfqdn
+
+
+def _(message):
+    """
+    Translate a message once translation is set up; the configuration is loaded before that.
+    :param message: Message to translate.
+    :return: Translated message.
+    """
+    return i18n._(message) if i18n._ else message
+
+
+def _lookup_fqdn(timeout):
+    """
+    Look up the FQDN with socket.getfqdn() in a helper thread, giving up after a timeout.
+    :param timeout: Seconds to wait for the lookup.
+    :return: FQDN, or None if the lookup did not finish in time.
+    """
+    result = []
+    lookup = threading.Thread(target=lambda: result.append(_getfqdn()), daemon=True)
+    lookup.start()
+    lookup.join(timeout)
+    return result[0] if result else None
+
+
+def resolve_server_name(override=None, cache_file=SERVER_NAME_CACHE_FILE, timeout=2.0):
+    """
+    Get the name of this server without waiting on slow reverse DNS.
+    The name is taken from the override, the BACKUP_SERVER_NAME environment variable, or the cache file written
+    by an earlier lookup on the same host, in that order. Otherwise socket.getfqdn() is tried with a timeout and
+    the result is cached; if it times out, a stale cached name or the hostname is used.
+    :param override: Server name given on the command line.
+    :param cache_file: Path to the cache file, or None to disable it.
+    :param timeout: Seconds to wait for the FQDN lookup.
+    :return: Server name.
+    """
+    name = override or os.environ.get("BACKUP_SERVER_NAME")
+    if name:
+        return name
+    hostname = socket.gethostname()
+    cached = None
+    if cache_file:
+        try:
+            with open(cache_file, "r") as cache:
+                cached_hostname, _separator, cached_name = cache.read().strip().partition("\t")
+            if cached_hostname == hostname and cached_name:
+                cached = cached_name
+                if time.time() - os.path.getmtime(cache_file) < SERVER_NAME_CACHE_SECONDS:
+                    return cached
+        except OSError:
+            pass
+    name = _lookup_fqdn(timeout)
+    if name is None:
+        return cached or hostname
+    if cache_file:
+        try:
+            temp_file = f"{cache_file}.tmp"
+            with open(temp_file, "w") as cache:
+                cache.write(f"{hostname}\t{name}\n")
+            os.replace(temp_file, cache_file)
+        except OSError:
+            pass
+    return name
+
+
+@contextmanager
+def _resolved_fqdn(resolve):
+    """
+    Answer socket.getfqdn() calls without an argument from a resolver, so a configuration setting
+    SERVER_NAME = socket.getfqdn() does not repeat a slow lookup.
+    :param resolve: Callable returning the server name.
+    """
+    getfqdn = socket.getfqdn
+    socket.getfqdn = lambda name="": resolve() if not name else _getfqdn(name)
+    try:
+        yield
+    finally:
+        socket.getfqdn = getfqdn
+
 
 class ConfigLoader:
     """
     Class to load configuration dynamically based on server name.
+    A configuration file is executed once per process; later loaders for the same unchanged file share it.
     """
-    def __init__(self, server_name):
+    _cache = {}
+
+    def __init__(self, server_name=None, config_path=None):
         """
         Initialize the ConfigLoader class.
-        :param server_name: Fully qualified domain name of the server.
+        :param server_name: Fully qualified domain name of the server; None to take it from the SERVER_NAME
+                            of the configuration file given as config_path.
+        :param config_path: Path to the configuration file, instead of the one named after the server.
         """
         self.server_name = server_name
+        self.config_path = config_path
         self.config = self.load_config()
 
     def load_config(self):
@@ -20,15 +115,36 @@ class ConfigLoader:
         Load the configuration file.
         :return: Configuration module.
         """
-        config_path = f'/root/backup_config_{self.server_name}.py'
+        config_path = self.config_path or CONFIG_PATH_TEMPLATE.format(self.server_name)
         if not os.path.exists(config_path):
             raise FileNotFoundError(
                 _("Configuration file {} does not exist. Ensure the correct config file is present.").format(config_path))
 
-        spec = importlib.util.spec_from_file_location("config", config_path)
-        config = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(config)
-        if self.server_name != config.SERVER_NAME:
+        key = (os.path.abspath(config_path), os.stat(config_path).st_mtime_ns)
+        config = self._cache.get(key)
+        if config is None:
+            spec = importlib.util.spec_from_file_location("config", config_path)
+            config = importlib.util.module_from_spec(spec)
+            with _resolved_fqdn((lambda: self.server_name) if self.server_name else resolve_server_name):
+                spec.loader.exec_module(config)
+            self._cache[key] = config
+        if self.server_name is None:
+            self.server_name = config.SERVER_NAME
+        elif self.server_name != config.SERVER_NAME:
             raise EnvironmentError(
                 _("The configuration file {} is not intended for this server ({}).").format(config_path, self.server_name))
         return config
+
+    @classmethod
+    def for_this_server(cls, server_name=None, config_path=None):
+        """
+        Load the configuration of this server. An explicit configuration file (the argument or the BACKUP_CONFIG
+        environment variable) names the server itself; otherwise the server name is resolved first.
+        :param server_name: Server name given on the command line.
+        :param config_path: Configuration file given on the command line.
+        :return: ConfigLoader object.
+        """
+        config_path = config_path or os.environ.get("BACKUP_CONFIG")
+        if config_path:
+            return cls(server_name, config_path)
+        return cls(resolve_server_name(server_name))
@@ -1,6 +1,14 @@
 # logger.py
 from datetime import datetime
-import inspect
+import atexit
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import deque
 
 class Logger:
     """
@@ -9,26 +17,32 @@ class Logger:
     _instance = None
 
     @staticmethod
-    def get_instance(log_file=None, verbose=False, debug=False):
+    def get_instance(log_file=None, verbose=False, debug=False, queued=False, flush_interval=1.0, json_log=False):
         """
         Static access method to get the singleton instance of the Logger.
         :param log_file: Path to the log file.
         :param verbose: Whether to print log messages to stdout.
         :param debug: Whether to print debug messages.
+        :param queued: Whether a background thread writes the log through a single open file handle.
+        :param flush_interval: Seconds between flushes of the queued writer.
+        :param json_log: Whether to record structured events in a JSON-lines file next to the log file.
         :return: Singleton instance of Logger.
         """
         if Logger._instance is None:
             if log_file is None:
                 raise ValueError("Logger has not been initialized. Provide log_file, verbose, and debug parameters.")
-            Logger(log_file, verbose, debug)
+            Logger(log_file, verbose, debug, queued, flush_interval, json_log)
         return Logger._instance
 
-    def __init__(self, log_file, verbose=False, debug=False):
+    def __init__(self, log_file, verbose=False, debug=False, queued=False, flush_interval=1.0, json_log=False):
         """
         Virtually private constructor.
         :param log_file: Path to the log file.
         :param verbose: Whether to print log messages to stdout.
         :param debug: Whether to print debug messages.
+        :param queued: Whether a background thread writes the log through a single open file handle.
+        :param flush_interval: Seconds between flushes of the queued writer.
+        :param json_log: Whether to record structured events in a JSON-lines file next to the log file.
         """
         if Logger._instance is not None:
             raise Exception("This class is a singleton!")
@@ -36,21 +50,303 @@ class Logger:
             Logger._instance = self
 
         self.log_file = log_file
+        self.index_file = f"{log_file}.idx"
+        self.event_file = f"{log_file}.jsonl" if json_log else None
+        self._event_listeners = []
+        self._sigterm_handlers = []
         self.verbose = verbose
         self.debug = debug
+        self._lock = threading.Lock()
+        self.line_count, self.byte_offset = self._count_existing_lines()
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._writer_thread = None
+        if queued:
+            self._start_writer()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._handle_sigterm)
 
-    def log(self, message, section=False):
+    def _start_writer(self):
+        """
+        Start the background writer and make sure it is drained on exit, including the exit after SIGTERM.
+        """
+        self._queue = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+        self._writer_thread.start()
+        atexit.register(self.close)
+
+    def add_sigterm_handler(self, handler):
+        """
+        Register a callable run on SIGTERM before the process exits, e.g. to stop running commands.
+        It runs in signal context and must not log or take locks.
+        :param handler: Callable taking no arguments.
+        """
+        if handler not in self._sigterm_handlers:
+            self._sigterm_handlers.append(handler)
+
+    def _handle_sigterm(self, signum, frame):
+        """
+        Stop the running commands and exit. Nothing is written here: the main thread may be inside the
+        logger, so the queue is drained by the atexit handler once the phases have returned.
+        """
+        for handler in self._sigterm_handlers:
+            handler()
+        sys.exit(128 + signum)
+
+    def _writer(self):
+        """
+        Write queued entries in batches, flushing at most every flush_interval seconds and on request.
+        Each target file is opened on its first entry and kept open until the writer stops.
+        An entry that cannot be written is retried directly; if the writer itself fails, the logger falls
+        back to writing directly.
+        """
+        entries = self._queue
+        handles = {}
+        batch = deque()
+        synced = []
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    batch.append(entries.get(timeout=self.flush_interval))
+                except queue.Empty:
+                    pass
+                while True:
+                    try:
+                        batch.append(entries.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = False
+                synced = []
+                while batch:
+                    kind, target, data = batch.popleft()
+                    if kind == "write":
+                        try:
+                            if target not in handles:
+                                handles[target] = open(target, "a", encoding="utf-8")
+                            handles[target].write(data)
+                        except OSError:
+                            self._drop_handle(handles, target)
+                            self._write_direct(target, data)
+                    else:
+                        synced.append(data)
+                        stop = stop or kind == "stop"
+                if synced or time.monotonic() - last_flush >= self.flush_interval:
+                    for target, handle in list(handles.items()):
+                        try:
+                            handle.flush()
+                            if synced:
+                                os.fsync(handle.fileno())
+                        except OSError as e:
+                            self._drop_handle(handles, target)
+                            self._report_write_error(target, e)
+                    last_flush = time.monotonic()
+                for event in synced:
+                    event.set()
+                if stop:
+                    return
+        except Exception as e:
+            self._report_write_error(self.log_file, e)
+            # What the writer already wrote is flushed before the rest is appended
+            for target in list(handles):
+                self._drop_handle(handles, target)
+            # Entries taken from the queue but not handled yet go first
+            batch.extend(("sync", None, event) for event in synced)
+            while True:
+                try:
+                    batch.append(entries.get_nowait())
+                except queue.Empty:
+                    break
+            self._stop_queueing(batch)
+        finally:
+            for target in list(handles):
+                self._drop_handle(handles, target)
+
+    @staticmethod
+    def _drop_handle(handles, target):
+        """
+        Close a file the writer keeps open and forget it, ignoring errors.
+        :param handles: Dictionary mapping paths to open files.
+        :param target: Path of the file.
+        """
+        try:
+            handles.pop(target).close()
+        except (KeyError, OSError):
+            pass
+
+    @staticmethod
+    def _report_write_error(target, error):
+        """
+        Report on stderr that the log could not be written, as the log itself may be what fails.
+        :param target: Path of the file.
+        :param error: Exception raised.
+        """
+        print(f"Could not write to {target}: {error}", file=sys.stderr)
+
+    def _write_direct(self, target, data):
+        """
+        Append data to a file without the background writer, reporting on stderr if that fails too.
+        :param target: Path of the file.
+        :param data: Text to append.
+        """
+        try:
+            with open(target, "a", encoding="utf-8") as target_file:
+                target_file.write(data)
+        except OSError as e:
+            self._report_write_error(target, e)
+            sys.stderr.write(data)
+
+    def _stop_queueing(self, batch):
+        """
+        Switch to direct writes after the background writer failed and write what is still queued.
+        :param batch: Deque of the entries the writer has not handled.
+        """
+        entries = self._queue
+        # close() holds the lock while it waits for this thread; it appends nothing meanwhile
+        locked = self._lock.acquire(timeout=1)
+        try:
+            self._queue = None
+            # Entries appended before the lock was taken
+            while True:
+                try:
+                    batch.append(entries.get_nowait())
+                except queue.Empty:
+                    break
+            while batch:
+                kind, target, data = batch.popleft()
+                if kind == "write":
+                    self._write_direct(target, data)
+                else:
+                    data.set()
+        finally:
+            if locked:
+                self._lock.release()
+
+    def sync(self):
+        """
+        Wait until every queued entry is written and flushed to disk.
+        """
+        entries = self._queue
+        if entries is None or not self._writer_thread.is_alive():
+            return
+        event = threading.Event()
+        entries.put(("sync", None, event))
+        event.wait()
+
+    def close(self):
+        """
+        Write every queued entry, flush it to disk and stop the background writer.
+        Entries logged afterwards are written directly.
+        """
+        if self._writer_thread is None or not self._writer_thread.is_alive():
+            return
+        event = threading.Event()
+        # Holding the lock keeps later entries from being written before the queued ones
+        with self._lock:
+            self._queue.put(("stop", None, event))
+            self._writer_thread.join()
+            self._queue = None
+
+    def _count_existing_lines(self):
+        """
+        Count the lines already in the log file, reading it in chunks.
+        :return: Tuple containing the number of lines and the size of the file in bytes.
+        """
+        if not os.path.exists(self.log_file):
+            return 0, 0
+        line_count = 0
+        with open(self.log_file, "rb") as log_file:
+            for chunk in iter(lambda: log_file.read(1024 * 1024), b""):
+                line_count += chunk.count(b"\n")
+        return line_count, os.path.getsize(self.log_file)
+
+    def anchor(self):
+        """
+        Get the position the next log entry will be written at.
+        :return: Tuple containing the 1-based line number and the byte offset of the next entry.
+        """
+        with self._lock:
+            return self.line_count + 1, self.byte_offset
+
+    def _append(self, path, data):
+        """
+        Append data to a file, or hand it to the background writer. Must be called with the lock held.
+        :param path: Path of the file.
+        :param data: Text to append.
+        """
+        entries = self._queue
+        if entries is not None:
+            entries.put(("write", path, data))
+        else:
+            with open(path, "a", encoding="utf-8") as target:
+                target.write(data)
+
+    def _write(self, formatted_message, error=False):
+        """
+        Append an entry to the log file and keep the line count and byte offset up to date.
+        :param formatted_message: Formatted entry, without the trailing newline.
+        :param error: Whether to record the entry in the error index next to the log file.
+        """
+        data = formatted_message + "\n"
+        with self._lock:
+            if error:
+                summary = formatted_message.replace("\t", " ").replace("\n", " ")
+                index_entry = f"{self.line_count + 1}\t{self.byte_offset}\t{summary}\n"
+            self._append(self.log_file, data)
+            if error:
+                self._append(self.index_file, index_entry)
+            self.line_count += data.count("\n")
+            self.byte_offset += len(data.encode("utf-8"))
+
+    def add_event_listener(self, listener):
+        """
+        Register a callable that receives every event dictionary, whether or not the JSON-lines log is enabled.
+        :param listener: Callable taking the event dictionary.
+        """
+        self._event_listeners.append(listener)
+
+    def event(self, event_type, phase, name=None, duration=None, byte_count=None, return_code=None, **fields):
+        """
+        Record a structured event in the JSON-lines log next to the log file, if it is enabled,
+        and pass it to the registered event listeners. Fields that are None are left out.
+        :param event_type: Kind of event, e.g. 'database_dump' or 'restic_backup'.
+        :param phase: Backup phase the event belongs to.
+        :param name: Database or service the event is about.
+        :param duration: Duration in seconds.
+        :param byte_count: Number of bytes written or added.
+        :param return_code: Return code of the command.
+        :param fields: Further fields to record.
+        """
+        if self.event_file is None and not self._event_listeners:
+            return
+        record = {"time": datetime.now().isoformat(timespec="milliseconds"), "phase": phase, "event": event_type,
+                  "name": name, "duration": round(duration, 3) if duration is not None else None, "bytes": byte_count,
+                  "return_code": return_code, **fields}
+        record = {key: value for key, value in record.items() if value is not None}
+        for listener in self._event_listeners:
+            listener(record)
+        if self.event_file is None:
+            return
+        # One compact object per line, so readers can parse the stream line by line
+        data = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._append(self.event_file, data)
+
+    def log(self, message, section=False, error=False):
         """
         Log a message.
         :param message: Message to log.
         :param section: Whether to format the message as a section header.
+        :param error: Whether the message reports an error; its position is then recorded in the error index.
         """
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         formatted_message = f"{timestamp} - {message}" if not section else f"\n{'#' * 22}\n# {message.center(18)} #\n{'#' * 22}\n"
-        with open(self.log_file, "a") as log_file:
-            log_file.write(formatted_message + "\n")
+        self._write(formatted_message, error)
         if self.verbose:
             print(formatted_message)
+        if section:
+            # Section headers mark phase boundaries
+            self.sync()
 
     def debug_log(self, message):
         """
@@ -58,11 +354,11 @@ class Logger:
         :param message: Debug message to log.
         """
         if self.debug:
-            frame = inspect.currentframe().f_back
-            filename = inspect.getframeinfo(frame).filename
+            # The caller's code object already knows its file name; no need to read the source
+            frame = sys._getframe(1)
+            filename = frame.f_code.co_filename
             lineno = frame.f_lineno
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             formatted_message = f"{timestamp} - DEBUG: {filename}:{lineno} - {message}"
             print(formatted_message)
-            with open(self.log_file, "a") as log_file:
-                log_file.write(formatted_message + "\n")
+            self._write(formatted_message)
@@ -1,11 +1,48 @@
 # main.py
+import time
+
+# Taken before the other imports so --profile-startup can include them
+STARTUP_TIME = time.perf_counter()
+
 import argparse
-import socket
 import os
 from i18n import setup_translation
 from config_loader import ConfigLoader
 from logger import Logger
 
+
+class StartupProfiler:
+    """
+    Class to time the steps of the startup for --profile-startup.
+    """
+    def __init__(self, start_time):
+        """
+        Initialize the StartupProfiler class.
+        :param start_time: time.perf_counter() value the first step started at.
+        """
+        self.start_time = start_time
+        self.last_time = start_time
+        self.steps = []
+
+    def checkpoint(self, step):
+        """
+        Record the time since the previous checkpoint.
+        :param step: Name of the step that just finished.
+        """
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last_time))
+        self.last_time = now
+
+    def report(self):
+        """
+        Print the time of each step and the total.
+        """
+        print(f"{'Step':<52} {'ms':>9}")
+        for step, seconds in self.steps:
+            print(f"{step:<52} {seconds * 1000:>9.1f}")
+        print(f"{'total':<52} {(self.last_time - self.start_time) * 1000:>9.1f}")
+        print("Run with python3 -X importtime main.py --profile-startup for the time of each module.")
+
 def log_config_settings(config):
     """
     Log all configuration settings using the debug logger.
@@ -16,21 +53,49 @@ def log_config_settings(config):
         if not attribute.startswith("__") and not callable(getattr(config, attribute)):
             logger.debug_log(f"{attribute}: {getattr(config, attribute)}")
 
+def run_compression_benchmark(config, sample_path):
+    """
+    Print throughput and compression ratio of each installed backend for a sample dump.
+    :param config: Configuration object containing settings.
+    :param sample_path: Path to the sample dump.
+    """
+    from backup_manager.compression import benchmark_compressors
+
+    results = benchmark_compressors(sample_path, getattr(config, "MYSQL_DUMP_COMPRESSION_THREADS", None),
+                                    getattr(config, "MYSQL_DUMP_COMPRESSION_LEVEL", None))
+    print(f"{'Backend':<8} {'MB/s':>10} {'Ratio':>8}")
+    for backend, throughput, ratio in results:
+        if throughput is None:
+            print(f"{backend:<8} {'failed':>10}")
+        else:
+            print(f"{backend:<8} {throughput:>10.1f} {ratio:>8.2f}")
+
 def main():
+    profiler = StartupProfiler(STARTUP_TIME)
+    profiler.checkpoint("import main, i18n, config_loader, logger")
     script_dir = os.path.dirname(os.path.abspath(__file__))
     os.chdir(script_dir)
 
-    server_name = socket.getfqdn()
-    config = ConfigLoader(server_name).config
-
     parser = argparse.ArgumentParser(description="Backup script for server")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     parser.add_argument("--simulate-failures", action="store_true", help="Simulate failures in the backup process")
+    parser.add_argument("--rescan", action="store_true", help="Rebuild the size index of the backup directory")
+    parser.add_argument("--benchmark-compression", metavar="SAMPLE_DUMP",
+                        help="Benchmark the installed compression backends on a sample dump and exit")
+    parser.add_argument("--server-name", help="Name of this server, instead of looking up its FQDN")
+    parser.add_argument("--config", help="Configuration file, instead of /root/backup_config_<server name>.py")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Report the import and initialization times and exit without running the backup")
     args = parser.parse_args()
 
+    config = ConfigLoader.for_this_server(args.server_name, args.config).config
+    profiler.checkpoint(f"server name and configuration ({config.SERVER_NAME})")
+
     # Initialize the logger singleton
-    logger = Logger.get_instance(config.LOG_FILE, args.verbose, args.debug)
+    logger = Logger.get_instance(config.LOG_FILE, args.verbose, args.debug, getattr(config, "LOG_QUEUED", False),
+                                 getattr(config, "LOG_FLUSH_INTERVAL", 1.0), getattr(config, "LOG_JSON", False))
+    profiler.checkpoint("logger")
 
     if args.debug:
         log_config_settings(config)
@@ -41,12 +106,26 @@ def main():
     # Override config value with command-line argument if provided
     if args.simulate_failures:
         config.SIMULATE_FAILURES = True
+    if args.rescan:
+        config.SIZE_INDEX_RESCAN = True
 
     setup_translation(config.LANGUAGE)
+    profiler.checkpoint("translation")
+
+    if args.benchmark_compression:
+        run_compression_benchmark(config, args.benchmark_compression)
+        return
 
     from backup_manager.backup_manager import BackupManager
     from backup_manager.repository_initializer import RepositoryInitializer
     from command_runner import CommandRunner
+    profiler.checkpoint("import backup_manager, command_runner")
+
+    if args.profile_startup:
+        BackupManager(config, logger, CommandRunner(logger))
+        profiler.checkpoint("BackupManager initialization")
+        profiler.report()
+        return
 
     repository_initializer = RepositoryInitializer(config)
     repository_initializer.ensure_directories()
@@ -0,0 +1,114 @@
+# size_index.py
+import json
+import os
+import sqlite3
+import threading
+import time
+from size_scanner import DirectoryListing
+
+
+class SizeIndex:
+    """
+    Class to persist directory listings between size scans, keyed by each directory's device, inode and mtime.
+    A directory whose key is unchanged is taken from the index instead of being listed again.
+
+    Directory mtimes only change when entries are added, removed or renamed, not when a file is rewritten in
+    place. So only directories below the cacheable paths are indexed, which must hold files that are written
+    once and never modified, like the packs, indexes and snapshots of a Restic repository; everything else is
+    listed on every scan, keeping the totals equal to a full scan. A directory holding a file newer than the
+    directory itself (still being written) is not cached either.
+    """
+    # Allowance for a file still being written right after it was created
+    MTIME_GRACE_NS = 10 * 10 ** 9
+
+    def __init__(self, index_file, full_rescan_days=7, cacheable_paths=()):
+        """
+        Initialize the SizeIndex class.
+        :param index_file: Path to the SQLite index file.
+        :param full_rescan_days: Number of days after which the index is ignored and rebuilt.
+        :param cacheable_paths: Directories whose files are never modified in place; only directories at or
+                                below them are indexed.
+        """
+        self.index_file = index_file
+        self.cacheable_paths = [os.path.abspath(path) for path in cacheable_paths]
+        self.full_rescan_seconds = full_rescan_days * 86400
+        self._entries = {}
+        self._updates = {}
+        self._visited = set()
+        self._lock = threading.Lock()
+        self._rescan = False
+        self._connection = sqlite3.connect(index_file)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, dev INTEGER, "
+                                 "ino INTEGER, mtime_ns INTEGER, listing TEXT)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        row = self._connection.execute("SELECT value FROM meta WHERE name = 'last_full_scan'").fetchone()
+        if row is None or time.time() - float(row[0]) >= self.full_rescan_seconds:
+            self._rescan = True
+        else:
+            for path, dev, ino, mtime_ns, listing in self._connection.execute("SELECT * FROM directories"):
+                self._entries[path] = ((dev, ino, mtime_ns), listing)
+
+    def rescan(self):
+        """
+        Ignore the stored listings and rebuild the index during the next scan.
+        """
+        self._rescan = True
+        self._entries = {}
+
+    def is_cacheable(self, path):
+        """
+        Check whether a directory lies below one of the cacheable paths.
+        :param path: Absolute directory path.
+        :return: Boolean indicating if the directory may be indexed.
+        """
+        return any(path == root or path.startswith(root + os.sep) for root in self.cacheable_paths)
+
+    def lookup(self, path, key):
+        """
+        Get the stored listing of a directory if it has not changed.
+        :param path: Directory path.
+        :param key: Tuple of the directory's device, inode and mtime in nanoseconds.
+        :return: DirectoryListing, or None if the directory is unknown or changed.
+        """
+        with self._lock:
+            self._visited.add(path)
+        if not self.is_cacheable(path):
+            return None
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != key:
+            return None
+        listing = DirectoryListing(**json.loads(entry[1]))
+        listing.hardlinks = [tuple(link) for link in listing.hardlinks]
+        return listing
+
+    def store(self, path, key, listing):
+        """
+        Remember the listing of a directory that was just scanned.
+        :param path: Directory path.
+        :param key: Tuple of the directory's device, inode and mtime in nanoseconds, taken before the scan.
+        :param listing: DirectoryListing of the directory.
+        """
+        cacheable = (self.is_cacheable(path) and not listing.error_count
+                     and listing.newest_mtime_ns <= key[2] + self.MTIME_GRACE_NS)
+        with self._lock:
+            self._updates[path] = (key, json.dumps(listing.__dict__)) if cacheable else None
+
+    def save(self):
+        """
+        Write the listings gathered during the scan and drop directories that no longer exist.
+        """
+        with self._connection:
+            if self._rescan:
+                self._connection.execute("DELETE FROM directories")
+            else:
+                removed = [(path,) for path in self._entries if path not in self._visited]
+                self._connection.executemany("DELETE FROM directories WHERE path = ?", removed)
+            self._connection.executemany(
+                "DELETE FROM directories WHERE path = ?",
+                ((path,) for path, update in self._updates.items() if update is None))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+                ((path, *update[0], update[1]) for path, update in self._updates.items() if update))
+            if self._rescan:
+                self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('last_full_scan', ?)", (str(time.time()),))
+        self._connection.close()
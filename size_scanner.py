@@ -0,0 +1,148 @@
+# size_scanner.py
+import os
+import stat
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+
+@dataclass
+class ScanResult:
+    """
+    Totals of a directory tree.
+    total_bytes is the apparent size of the files, allocated_bytes the disk space they use (as `du` reports it).
+    """
+    total_bytes: int = 0
+    allocated_bytes: int = 0
+    file_count: int = 0
+    dir_count: int = 0
+    error_count: int = 0
+    subtrees: dict = field(default_factory=dict)
+
+    def add(self, listing, hardlinks=()):
+        """
+        Add the files of one directory listing to the totals.
+        :param listing: DirectoryListing to add.
+        :param hardlinks: The listing's hard-linked files not yet counted elsewhere in the tree.
+        """
+        self.total_bytes += listing.total_bytes + sum(link[2] for link in hardlinks)
+        self.allocated_bytes += listing.allocated_bytes + sum(link[3] for link in hardlinks)
+        self.file_count += listing.file_count + len(hardlinks)
+        self.dir_count += 1
+        self.error_count += listing.error_count
+
+
+@dataclass
+class DirectoryListing:
+    """
+    The files directly inside one directory, excluding files with several hard links, which are listed
+    separately so they can be counted once per tree.
+    """
+    total_bytes: int = 0
+    allocated_bytes: int = 0
+    file_count: int = 0
+    error_count: int = 0
+    newest_mtime_ns: int = 0
+    subdirs: list = field(default_factory=list)
+    hardlinks: list = field(default_factory=list)
+
+
+def scan_directory(path, device):
+    """
+    List one directory using the stat results cached by os.scandir.
+    Entries that vanish while the directory is read are skipped.
+    :param path: Directory path.
+    :param device: Device of the tree root; subdirectories on other devices are not descended into.
+    :return: DirectoryListing of the directory.
+    """
+    listing = DirectoryListing()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    listing.error_count += 1
+                    continue
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    if device is None or entry_stat.st_dev == device:
+                        listing.subdirs.append(entry.path)
+                    continue
+                listing.newest_mtime_ns = max(listing.newest_mtime_ns, entry_stat.st_mtime_ns)
+                size = entry_stat.st_size
+                allocated = entry_stat.st_blocks * 512
+                if entry_stat.st_nlink > 1 and not stat.S_ISLNK(entry_stat.st_mode):
+                    listing.hardlinks.append((entry_stat.st_dev, entry_stat.st_ino, size, allocated))
+                    continue
+                listing.total_bytes += size
+                listing.allocated_bytes += allocated
+                listing.file_count += 1
+    except FileNotFoundError:
+        pass
+    except OSError:
+        listing.error_count += 1
+    return listing
+
+
+def list_directory(path, device, index=None):
+    """
+    List one directory, reusing the listing stored in a size index if the directory has not changed.
+    :param path: Directory path.
+    :param device: Device of the tree root, or None to cross file systems.
+    :param index: SizeIndex instance, or None to always scan.
+    :return: DirectoryListing of the directory.
+    """
+    if index is None:
+        return scan_directory(path, device)
+    try:
+        directory_stat = os.lstat(path)
+    except FileNotFoundError:
+        return DirectoryListing()
+    # The key is taken before scanning, so a change made during the scan shows up next time
+    key = (directory_stat.st_dev, directory_stat.st_ino, directory_stat.st_mtime_ns)
+    listing = index.lookup(path, key)
+    if listing is None:
+        listing = scan_directory(path, device)
+        index.store(path, key, listing)
+    return listing
+
+
+def scan_tree(root, subtrees=(), workers=8, one_file_system=True, index=None):
+    """
+    Scan a directory tree with a pool of threads, each listing one directory at a time.
+    Hard-linked files are counted once, by (device, inode).
+    :param root: Root directory of the tree.
+    :param subtrees: Directories inside the tree whose own totals should be reported as well.
+    :param workers: Number of scanning threads.
+    :param one_file_system: Whether to stay on the file system of the root.
+    :param index: SizeIndex holding listings from earlier scans, or None to scan every directory.
+    :return: ScanResult of the tree, with a ScanResult per requested subtree in its subtrees attribute.
+    """
+    result = ScanResult()
+    root = os.path.abspath(root)
+    subtrees = [os.path.abspath(subtree) for subtree in subtrees]
+    for subtree in subtrees:
+        result.subtrees[subtree] = ScanResult()
+    try:
+        device = os.lstat(root).st_dev if one_file_system else None
+    except FileNotFoundError:
+        return result
+
+    seen_hardlinks = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_directory, root, device, index): root}
+        while pending:
+            done, _unused = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                listing = future.result()
+                new_hardlinks = [link for link in listing.hardlinks if link[:2] not in seen_hardlinks]
+                seen_hardlinks.update(link[:2] for link in new_hardlinks)
+                result.add(listing, new_hardlinks)
+                for subtree in subtrees:
+                    if path == subtree or path.startswith(subtree + os.sep):
+                        result.subtrees[subtree].add(listing, new_hardlinks)
+                for subdir in listing.subdirs:
+                    pending[executor.submit(list_directory, subdir, device, index)] = subdir
+    return result
@@ -1,7 +1,13 @@
 # utils.py
+import json
 import os
 import secrets
+import shlex
 import string
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from size_index import SizeIndex
+from size_scanner import scan_tree
 from i18n import _
 
 def generate_secure_password(length=20):
@@ -31,7 +37,28 @@ def format_duration(duration):
     else:
         hours, remainder = divmod(total_seconds, 3600)
         minutes, seconds = divmod(remainder, 60)
-        return f"{hours} hours {minutes} minutes {seconds}"
+        return f"{hours} hours {minutes} minutes {seconds} seconds"
+
+def format_bytes(size):
+    """
+    Format a byte count as a human-readable string.
+    :param size: Size in bytes.
+    :return: Formatted size string.
+    """
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(size) < 1024 or unit == "TiB":
+            return f"{size:.2f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+
+def parse_size(size_string):
+    """
+    Parse a human-readable size as printed by Restic, such as '1.234 GiB'.
+    :param size_string: Size string.
+    :return: Size in bytes.
+    """
+    units = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4, "PiB": 1024 ** 5}
+    value, unit = size_string.split()
+    return int(float(value) * units[unit])
 
 def log_and_email(backup_manager, logger, message, section=False, error=False):
     """
@@ -53,7 +80,16 @@ def log_and_email(backup_manager, logger, message, section=False, error=False):
         backup_manager.backup_success = False
 
     backup_manager.email_body += formatted_message + "\n"
-    logger.log(message)
+    logger.log(message, error=error)
+
+def restic_command(config, *args):
+    """
+    Build the argument list for a Restic command against the configured repository.
+    :param config: Configuration object.
+    :param args: Restic subcommand and its arguments.
+    :return: Argument list; join it with shlex.join() for CommandRunner.
+    """
+    return ["restic", "-r", config.RESTIC_REPOSITORY, "--password-file", config.RESTIC_PASSWORD_FILE, *args]
 
 def is_restic_locked(repository, password_file, command_runner, logger):
     """
@@ -75,19 +111,6 @@ def is_restic_locked(repository, password_file, command_runner, logger):
     logger.log(f"Restic repository {repository} is not locked.")
     return False
 
-def get_dir_size(directory):
-    """
-    Get the total size of a directory.
-    :param directory: Directory path.
-    :return: Total size of the directory in bytes.
-    """
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
-
 class BackupSizeCalculator:
     """
     Class to calculate the size of backups.
@@ -102,39 +125,144 @@ class BackupSizeCalculator:
         self.config = config
         self.command_runner = command_runner
         self.logger = logger
+        self._backup_tree_scan = None
 
-    def extract_backup_size(self, backup_size_line):
+    def scan_backup_tree(self):
         """
-        Extract the size of the backup from the output line.
-        :param backup_size_line: Line containing backup size information.
-        :return: Tuple containing data transferred and data stored.
+        Scan the backup directory once, keeping the repository's own totals from the same pass.
+        :return: ScanResult of the backup directory.
         """
-        data_transferred = backup_size_line.split("Added to the repository:")[1].split(" (")[0].strip()
-        data_stored = backup_size_line.split("(")[1].split(" stored")[0].strip()
-        return data_transferred, data_stored
+        if self._backup_tree_scan is None:
+            index = self._open_size_index()
+            self._backup_tree_scan = scan_tree(self.config.BASE_BACKUP_DIR, [self.config.RESTIC_REPOSITORY],
+                                               getattr(self.config, "SIZE_SCAN_WORKERS", 8), index=index)
+            if index:
+                index.save()
+        return self._backup_tree_scan
 
-    def get_uncompressed_size(self):
+    def _open_size_index(self):
         """
-        Get the uncompressed size of the backup.
-        :return: Uncompressed size of the backup.
+        Open the persistent size index if it is enabled.
+        :return: SizeIndex instance, or None if every directory should be scanned.
+        """
+        if not getattr(self.config, "SIZE_INDEX_ENABLED", False):
+            return None
+        index_file = getattr(self.config, "SIZE_INDEX_FILE", os.path.join(self.config.BASE_BACKUP_DIR, "size-index.sqlite"))
+        index = SizeIndex(index_file, getattr(self.config, "SIZE_INDEX_FULL_RESCAN_DAYS", 7),
+                          getattr(self.config, "SIZE_INDEX_PATHS", [self.config.RESTIC_REPOSITORY]))
+        if getattr(self.config, "SIZE_INDEX_RESCAN", False):
+            index.rescan()
+        return index
+
+    def _format_compressed_size(self, scan):
+        """
+        Format the repository's disk usage from a scan of the backup directory.
+        :param scan: ScanResult of the backup directory.
+        :return: Compressed size of the backup.
+        """
+        repository = os.path.abspath(self.config.RESTIC_REPOSITORY)
+        if not repository.startswith(os.path.abspath(self.config.BASE_BACKUP_DIR) + os.sep):
+            repository_scan = scan_tree(repository, workers=getattr(self.config, "SIZE_SCAN_WORKERS", 8))
+        else:
+            repository_scan = scan.subtrees[repository]
+        return format_bytes(repository_scan.allocated_bytes)
+
+    def get_repository_sizes(self):
         """
-        stats_command = f"restic -r {self.config.RESTIC_REPOSITORY} --password-file {self.config.RESTIC_PASSWORD_FILE} stats --mode restore-size"
-        return_code, stdout, stderr = self.command_runner.run(stats_command, verbose=True, timeout=3600)
+        Get the uncompressed and compressed size of the backup, scanning the backup directory while Restic runs.
+        :return: Tuple containing uncompressed and compressed size of the backup.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            scan_future = executor.submit(self.scan_backup_tree)
+            if getattr(self.config, "SIZE_ACCOUNTING_MODE", "full") == "incremental":
+                snapshots_result = self.command_runner.run(
+                    shlex.join(restic_command(self.config, "--no-lock", "snapshots", "--json")), timeout=3600)
+                uncompressed_size = self._get_incremental_uncompressed_size(*snapshots_result)
+            else:
+                # Without a lock the stats can run while the retention policy is applied
+                stats_result = self.command_runner.run(
+                    shlex.join(restic_command(self.config, "--no-lock", "stats", "--mode", "restore-size")),
+                    verbose=True, timeout=3600)
+                uncompressed_size = self._parse_uncompressed_size(*stats_result)
+            return uncompressed_size, self._format_compressed_size(scan_future.result())
+
+    def _get_size_accounting(self):
+        """
+        Open the per-snapshot restore size cache.
+        :return: RestoreSizeAccounting instance.
+        """
+        # Imported here: the backup_manager package depends on utils, not the other way round
+        from backup_manager.size_accounting import RestoreSizeAccounting
+        cache_file = getattr(self.config, "SIZE_ACCOUNTING_CACHE_FILE",
+                             os.path.join(self.config.BASE_BACKUP_DIR, "restic-size-cache.json"))
+        return RestoreSizeAccounting(cache_file, getattr(self.config, "SIZE_FULL_STATS_INTERVAL_DAYS", 7))
+
+    def record_snapshot(self, summary):
+        """
+        Remember the restore size of a new snapshot for incremental size accounting.
+        :param summary: ResticBackupSummary of the snapshot.
+        """
+        if getattr(self.config, "SIZE_ACCOUNTING_MODE", "full") != "incremental" or not summary.snapshot_id:
+            return
+        accounting = self._get_size_accounting()
+        accounting.record_snapshot(summary.snapshot_id, summary.bytes_processed)
+        accounting.save()
+
+    def _get_incremental_uncompressed_size(self, return_code, stdout, stderr):
+        """
+        Get the uncompressed size from cached per-snapshot sizes, running a full `restic stats` only when it is due:
+        when it has never run or its last run is older than SIZE_FULL_STATS_INTERVAL_DAYS.
+        :param return_code: Return code of `restic snapshots --json`.
+        :param stdout: Standard output of `restic snapshots --json`.
+        :param stderr: Error output of `restic snapshots --json`.
+        :return: Uncompressed size of the backup, with an 'as of' note if the figure is not fresh.
+        """
+        accounting = self._get_size_accounting()
+        total = None
         if return_code == 0:
-            uncompressed_size_line = next((line for line in stdout.splitlines() if "Total Size" in line), None)
-            if uncompressed_size_line:
-                return uncompressed_size_line.split(":")[1].strip()
+            try:
+                total = accounting.incremental_total(json.loads(stdout))
+            except (ValueError, KeyError, TypeError):
+                self.logger.log(_("Could not parse the snapshot list: {}").format(stderr))
+        else:
+            self.logger.log(_("Could not list snapshots: {}").format(stderr))
+
+        if accounting.full_stats_due():
+            stats_time = datetime.now()
+            return_code, stdout, stderr = self.command_runner.run(
+                shlex.join(restic_command(self.config, "--no-lock", "stats", "--mode", "restore-size", "--json")),
+                timeout=3600)
+            try:
+                full_size = json.loads(stdout)["total_size"] if return_code == 0 else None
+            except (ValueError, KeyError, TypeError):
+                full_size = None
+            if full_size is not None:
+                if total is not None:
+                    self.logger.log(_("Incremental restore size {} bytes, full stats {} bytes.").format(total, full_size))
+                accounting.record_full_stats(full_size, stats_time)
+                total = full_size
+        accounting.save()
+
+        if total is not None:
+            return format_bytes(total)
+        if accounting.full_stats:
+            return _("{} (as of {})").format(format_bytes(accounting.full_stats["restore_size"]),
+                                             accounting.full_stats["time"].replace("T", " "))
         return _("unknown")
 
-    def get_compressed_size(self):
+    @staticmethod
+    def _parse_uncompressed_size(return_code, stdout, stderr):
         """
-        Get the compressed size of the backup.
-        :return: Compressed size of the backup.
+        Parse the output of `restic stats --mode restore-size`.
+        :param return_code: Return code of the command.
+        :param stdout: Standard output of the command.
+        :param stderr: Error output of the command.
+        :return: Uncompressed size of the backup.
         """
-        du_command = f"du -sh {self.config.RESTIC_REPOSITORY}"
-        return_code, stdout, stderr = self.command_runner.run(du_command, verbose=True, timeout=3600)
         if return_code == 0:
-            return stdout.split()[0]
+            uncompressed_size_line = next((line for line in stdout.splitlines() if "Total Size" in line), None)
+            if uncompressed_size_line:
+                return uncompressed_size_line.split(":")[1].strip()
         return _("unknown")
 
     def calculate_total_backup_size(self):
@@ -142,7 +270,7 @@ class BackupSizeCalculator:
         Calculate the total size of the backup directory.
         :return: Total size of the backup directory in MB.
         """
-        backup_dir_size = get_dir_size(self.config.BASE_BACKUP_DIR)
+        backup_dir_size = self.scan_backup_tree().total_bytes
         size_in_mb = backup_dir_size / (1024 * 1024)
         return size_in_mb
 
@@ -155,8 +283,8 @@ def handle_error(message, stderr, config, logger, backup_manager):
     :param logger: Logger object.
     :param backup_manager: BackupManager object.
     """
-    error_message = _(message + " See log for details at line {}.").format(len(open(config.LOG_FILE).readlines()) + 1)
+    error_message = _(message + " See log for details at line {}.").format(logger.anchor()[0])
     backup_manager.email_body += f"<strong style='color: red;'>{error_message}</strong><br>\n"
-    logger.log(f"{message} {stderr}")
+    logger.log(f"{message} {stderr}", error=True)
     backup_manager.error_lines.append(error_message)
     backup_manager.backup_success = False
\ No newline at end of file